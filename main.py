@@ -1,12 +1,34 @@
 #!/usr/bin/python3
 
+import argparse
+import array
+import asyncio
+import bisect
+import collections
+import contextlib
+import fcntl
+import functools
+import http.server
+import json
+import math
+import mmap
+from multiprocessing import resource_tracker, shared_memory
+import random
+import selectors
+import signal
 import sys
 import time
 import dbus
 import dbus.service
 from dbus.mainloop.glib import DBusGMainLoop
+from gi.repository import GLib
 import os
 import socket
+import socketserver
+import stat
+import struct
+import threading
+import zlib
 
 """
 Controller MAC will be detected automatically
@@ -14,8 +36,361 @@ Controller MAC will be detected automatically
 CONTROLLER_MAC = None  # Will be auto-detected
 
 
-# SDP record embedded so the script is fully self-contained
-HID_SERVICE_RECORD = """<?xml version="1.0" encoding="UTF-8" ?>
+# Top-level collections of the embedded device
+_KEYBOARD_DESCRIPTOR = bytes.fromhex(
+    "05010906a101850175019508050719e029e715002501810295017508810395057501050819012905910295017503910395067508150026ff000507190029ff8100c0")
+_CONSUMER_DESCRIPTOR = bytes.fromhex(
+    "050c0901a1018503150025017501950b0a23020a21020ab10109b809b609cd09b509e209ea09e9093081029501750d8103c0")
+_MOUSE_DESCRIPTOR = bytes.fromhex(
+    "05010902a1010901a100850295037501050919012903150025018102950175058103750895020501093009311581257f46670c3699f36513550c8106c0c0")
+# 5 buttons, 16-bit relative X/Y (-32767..32767), wheel and AC Pan (-127..127)
+_EXTENDED_MOUSE_DESCRIPTOR = bytes.fromhex(
+    "05010902a1010901a100850205091901290515002501950575018102950175038103"
+    "05010930093116018026ff7f75109502810609381581257f750895018106050c0a3802950175088106c0c0")
+# Absolute pointer on report ID 4 (tablet style): 3 buttons, X/Y 0..32767 across the screen
+_ABSOLUTE_POINTER_DESCRIPTOR = bytes.fromhex(
+    "05010902a1010901a100850405091901290315002501950375018102950175058103"
+    "050109300931150026ff7f751095028102c0c0")
+
+# HID report descriptor of the embedded device:
+#   report ID 1  boot-style keyboard (8 modifier bits, reserved byte, 5 LEDs out, 6 keys)
+#   report ID 2  mouse (3 buttons, 8-bit relative X/Y)
+#   report ID 3  consumer control (11 media keys)
+HID_REPORT_DESCRIPTOR = _KEYBOARD_DESCRIPTOR + _CONSUMER_DESCRIPTOR + _MOUSE_DESCRIPTOR
+
+# Same device with the extended mouse on report ID 2 (--extended-mouse): long moves
+# take ~250x fewer reports, and there are vertical and horizontal wheels
+HID_REPORT_DESCRIPTOR_EXTENDED = _KEYBOARD_DESCRIPTOR + _CONSUMER_DESCRIPTOR + _EXTENDED_MOUSE_DESCRIPTOR
+
+# Either of them plus the absolute pointer (--absolute): move_to() is one report
+HID_REPORT_DESCRIPTOR_ABSOLUTE = HID_REPORT_DESCRIPTOR + _ABSOLUTE_POINTER_DESCRIPTOR
+
+# Main item kinds (short item tags)
+HID_INPUT = 0x8
+HID_OUTPUT = 0x9
+HID_FEATURE = 0xB
+HID_COLLECTION = 0xA
+HID_END_COLLECTION = 0xC
+
+# Interrupt channel header byte per report kind (DATA | Input / Output)
+HID_DATA_HEADERS = {HID_INPUT: 0xA1, HID_OUTPUT: 0xA2, HID_FEATURE: 0xA3}
+
+# Names of usages the generated encoders use for their arguments
+_USAGE_NAMES = {
+    (0x01, 0x30): "x", (0x01, 0x31): "y", (0x01, 0x32): "z", (0x01, 0x38): "wheel",
+    (0x07, 0xE0): "modifiers", (0x0C, 0x238): "pan",
+}
+_USAGE_PAGE_NAMES = {0x07: "keys", 0x08: "leds", 0x09: "buttons", 0x0C: "consumer"}
+
+
+class ReportField(object):
+    """
+    One value of a report. Kinds:
+        "bits"      count 1-bit variables packed as one bitmask (buttons, modifiers)
+        "value"     a single variable of size bits (X, Y, wheel...)
+        "array"     count slots of size bits holding usage indexes (pressed keys)
+        "padding"   constant bits
+    """
+    __slots__ = ("name", "kind", "bit_offset", "size", "count", "logical_min", "logical_max",
+                 "usage_page", "usage")
+
+    def __init__(self, name, kind, bit_offset, size, count, logical_min, logical_max, usage_page, usage):
+        self.name = name
+        self.kind = kind
+        self.bit_offset = bit_offset
+        self.size = size
+        self.count = count
+        self.logical_min = logical_min
+        self.logical_max = logical_max
+        self.usage_page = usage_page
+        self.usage = usage
+
+    @property
+    def bit_size(self):
+        return self.size * self.count
+
+    @property
+    def signed(self):
+        return self.logical_min < 0
+
+    def __repr__(self):
+        return (f"ReportField({self.name!r}, {self.kind}, offset={self.bit_offset}, size={self.size}, "
+                f"count={self.count}, range={self.logical_min}..{self.logical_max})")
+
+
+class ReportLayout(object):
+    """
+    Layout of one report (kind + report ID), with a packing function
+    generated for it on first use:
+
+        layout.pack(*values)    complete interrupt-channel message, header
+                                byte and report ID included. One argument per
+                                non-padding field, in arg_names order: ints for
+                                "bits"/"value" fields (values are clamped to the
+                                logical range), sequences for "array" fields.
+        layout.unpack(body)     dict of field values from the report data
+                                following the report ID
+    """
+    def __init__(self, kind, report_id, fields):
+        self.kind = kind
+        self.report_id = report_id
+        self.fields = fields
+        self.bit_size = sum(f.bit_size for f in fields)
+        self.size = (self.bit_size + 7) // 8
+        self.arg_names = [f.name for f in fields if f.kind != "padding"]
+        self.struct = self._struct_format()
+        # Same with the header byte and report ID in front: a whole interrupt-channel message
+        self.message_struct = struct.Struct("<BB" + self.struct.format[1:]) if self.struct else None
+        self._pack = None
+        self._unpack = None
+
+    def _struct_format(self):
+        """
+        Precompiled struct for the report body when every field falls on
+        byte boundaries, None if bit-level packing is needed. A bitmask
+        followed by enough padding is widened to the next whole byte(s).
+        """
+        formats = {8: "b", 16: "h", 32: "i"}
+        fmt = "<"
+        skip = 0  # padding bits already swallowed by a widened bitmask
+        for field in self.fields:
+            if field.kind == "padding":
+                bits = field.bit_size - skip
+                skip = 0
+                if bits < 0 or bits % 8:
+                    return None
+                fmt += "x" * (bits // 8)
+                continue
+            if skip or field.bit_offset % 8:
+                return None
+            if field.kind == "bits":
+                width = (field.bit_size + 7) // 8 * 8
+                if width not in formats:
+                    return None
+                skip = width - field.bit_size
+                fmt += formats[width].upper()
+            elif field.size in formats:
+                code = formats[field.size] if field.signed else formats[field.size].upper()
+                fmt += code * field.count
+            else:
+                return None
+        if skip:
+            # Widened past the end of the report
+            return None
+        return struct.Struct(fmt)
+
+    def _compile_pack(self):
+        header = HID_DATA_HEADERS[self.kind]
+        args = []
+        namespace = {}
+        lines = []
+        if self.struct is not None:
+            namespace["_pack"] = self.message_struct.pack
+            values = [str(header), str(self.report_id)]
+        else:
+            namespace["_prefix"] = bytes([header, self.report_id])
+            terms = []
+        for i, field in enumerate(self.fields):
+            if field.kind == "padding":
+                continue
+            arg = f"a{i}"
+            args.append(arg)
+            if field.kind == "bits":
+                expr = f"({arg} & {(1 << field.bit_size) - 1})"
+                exprs = [expr]
+            elif field.kind == "value":
+                lo = field.logical_min
+                hi = field.logical_max
+                lines.append(f"    {arg} = {lo} if {arg} < {lo} else ({hi} if {arg} > {hi} else {arg})")
+                exprs = [arg]
+            else:
+                namespace[f"_zeros{i}"] = (0,) * field.count
+                lines.append(f"    {arg} = (tuple({arg}) + _zeros{i})[:{field.count}]")
+                exprs = [f"{arg}[{j}]" for j in range(field.count)]
+            if self.struct is not None:
+                values.extend(exprs)
+            else:
+                mask = (1 << field.size) - 1 if field.kind != "bits" else (1 << field.bit_size) - 1
+                step = field.size if field.kind != "bits" else field.bit_size
+                for j, expr in enumerate(exprs):
+                    terms.append(f"(({expr} & {mask}) << {field.bit_offset + j * step})")
+        if self.struct is not None:
+            lines.append(f"    return _pack({', '.join(values)})")
+        else:
+            lines.append(f"    return _prefix + ({' | '.join(terms) or '0'}).to_bytes({self.size}, 'little')")
+        source = f"def pack({', '.join(args)}):\n" + "\n".join(lines) + "\n"
+        exec(compile(source, f"<hid report {self.report_id} encoder>", "exec"), namespace)
+        return namespace["pack"]
+
+    @property
+    def pack(self):
+        if self._pack is None:
+            self._pack = self._compile_pack()
+        return self._pack
+
+    def unpack(self, body):
+        """Decode the report data following the report ID into {field name: value}"""
+        if self.struct is not None:
+            raw = iter(self.struct.unpack_from(body))
+            values = {}
+            for field in self.fields:
+                if field.kind == "padding":
+                    continue
+                if field.kind == "array":
+                    values[field.name] = tuple(next(raw) for _ in range(field.count))
+                else:
+                    values[field.name] = next(raw)
+            return values
+        bits = int.from_bytes(bytes(body[:self.size]), "little")
+        values = {}
+        for field in self.fields:
+            if field.kind == "padding":
+                continue
+            if field.kind == "bits":
+                values[field.name] = (bits >> field.bit_offset) & ((1 << field.bit_size) - 1)
+                continue
+            mask = (1 << field.size) - 1
+            items = []
+            for j in range(field.count):
+                v = (bits >> (field.bit_offset + j * field.size)) & mask
+                if field.signed and v >> (field.size - 1):
+                    v -= 1 << field.size
+                items.append(v)
+            values[field.name] = tuple(items) if field.kind == "array" else items[0]
+        return values
+
+
+def _item_value(data, signed):
+    if not data:
+        return 0
+    return int.from_bytes(data, "little", signed=signed)
+
+
+class HIDReportDescriptor(object):
+    """
+    Parsed HID report descriptor. reports maps (kind, report ID) to a
+    ReportLayout, kind being HID_INPUT, HID_OUTPUT or HID_FEATURE.
+    """
+    def __init__(self, data):
+        self.data = bytes(data)
+        self.reports = {}
+        self._parse()
+
+    def _parse(self):
+        data = self.data
+        globals_ = {"usage_page": 0, "logical_min": 0, "logical_max": b"", "report_size": 0,
+                    "report_count": 0, "report_id": 0}
+        stack = []
+        usages = []
+        usage_min = None
+        offsets = collections.defaultdict(int)
+        fields = collections.defaultdict(list)
+        names = collections.defaultdict(set)
+        i = 0
+        while i < len(data):
+            prefix = data[i]
+            if prefix == 0xFE:
+                # Long item, nothing in HID 1.11 uses them
+                i += 3 + data[i + 1]
+                continue
+            size = (0, 1, 2, 4)[prefix & 0x3]
+            item_type = (prefix >> 2) & 0x3
+            tag = prefix >> 4
+            raw = data[i + 1:i + 1 + size]
+            i += 1 + size
+            if item_type == 1:  # Global
+                if tag == 0x0:
+                    globals_["usage_page"] = _item_value(raw, False)
+                elif tag == 0x1:
+                    globals_["logical_min"] = _item_value(raw, True)
+                elif tag == 0x2:
+                    # Raw, its sign depends on the minimum (see _main_fields)
+                    globals_["logical_max"] = raw
+                elif tag == 0x7:
+                    globals_["report_size"] = _item_value(raw, False)
+                elif tag == 0x8:
+                    globals_["report_id"] = _item_value(raw, False)
+                elif tag == 0x9:
+                    globals_["report_count"] = _item_value(raw, False)
+                elif tag == 0xA:
+                    stack.append(dict(globals_))
+                elif tag == 0xB:
+                    globals_ = stack.pop()
+            elif item_type == 2:  # Local
+                value = _item_value(raw, False)
+                if tag == 0x0:
+                    usages.append(value)
+                elif tag == 0x1:
+                    usage_min = value
+                elif tag == 0x2 and usage_min is not None:
+                    usages.extend(range(usage_min, value + 1))
+                    usage_min = None
+            elif item_type == 0:  # Main
+                if tag in (HID_INPUT, HID_OUTPUT, HID_FEATURE):
+                    flags = _item_value(raw, False)
+                    key = (tag, globals_["report_id"])
+                    for field in self._main_fields(flags, globals_, usages, names[key]):
+                        field.bit_offset = offsets[key]
+                        offsets[key] += field.bit_size
+                        fields[key].append(field)
+                usages = []
+                usage_min = None
+        for (kind, report_id), report_fields in fields.items():
+            self.reports[(kind, report_id)] = ReportLayout(kind, report_id, report_fields)
+
+    @staticmethod
+    def _main_fields(flags, g, usages, taken):
+        size = g["report_size"]
+        count = g["report_count"]
+        lo = g["logical_min"]
+        # Unsigned unless the minimum is negative, as Linux reads it: devices
+        # write 0..255 as 15 00 25 ff, -127..127 as 15 81 25 7f
+        hi = _item_value(g["logical_max"], lo < 0)
+        page = g["usage_page"]
+        if hi < lo and not flags & 0x01:
+            raise ValueError(f"Logical Maximum {hi} below Logical Minimum {lo}")
+
+        def name_for(usage):
+            name = _USAGE_NAMES.get((page, usage)) or _USAGE_PAGE_NAMES.get(page) or "field"
+            base = name
+            n = 2
+            while name in taken:
+                name = f"{base}{n}"
+                n += 1
+            taken.add(name)
+            return name
+
+        if flags & 0x01:  # Constant
+            return [ReportField("padding", "padding", 0, size, count, lo, hi, page, None)]
+        if not flags & 0x02:  # Array
+            return [ReportField(name_for(None), "array", 0, size, count, lo, hi, page, None)]
+        if size == 1:
+            return [ReportField(name_for(usages[0] if usages else None), "bits", 0, 1, count, 0, 1, page,
+                                usages[0] if usages else None)]
+        result = []
+        for j in range(count):
+            usage = usages[min(j, len(usages) - 1)] if usages else None
+            result.append(ReportField(name_for(usage), "value", 0, size, 1, lo, hi, page, usage))
+        return result
+
+    def report(self, report_id, kind=HID_INPUT):
+        return self.reports[(kind, report_id)]
+
+    def encoder(self, report_id, kind=HID_INPUT):
+        """Generated packing function of a report, see ReportLayout"""
+        return self.reports[(kind, report_id)].pack
+
+    def report_ids(self, kind=HID_INPUT):
+        return sorted(report_id for k, report_id in self.reports if k == kind)
+
+
+@functools.lru_cache(maxsize=16)
+def parse_report_descriptor(data):
+    """Parse (and cache) a HID report descriptor given as bytes"""
+    return HIDReportDescriptor(bytes(data))
+
+
+_SERVICE_RECORD_TEMPLATE = """<?xml version="1.0" encoding="UTF-8" ?>
 
 <record>
     <attribute id="0x0001">
@@ -68,13 +443,13 @@ HID_SERVICE_RECORD = """<?xml version="1.0" encoding="UTF-8" ?>
         </sequence>
     </attribute>
     <attribute id="0x0100">
-        <text value="A Virtual Keyboard" />
+        <text value="{name}" />
     </attribute>
     <attribute id="0x0101">
-        <text value="Keyboard > BT Keyboard" />
+        <text value="{description}" />
     </attribute>
     <attribute id="0x0102">
-        <text value="Durgesh" />
+        <text value="{provider}" />
     </attribute>
     <attribute id="0x0200">
         <uint16 value="0x0100" />
@@ -83,29 +458,29 @@ HID_SERVICE_RECORD = """<?xml version="1.0" encoding="UTF-8" ?>
         <uint16 value="0x0111" />
     </attribute>
     <attribute id="0x0202">
-        <uint8 value="0x40" />
+        <uint8 value="0x{subclass:02x}" />
     </attribute>
     <attribute id="0x0203">
-        <uint8 value="0x00" />
+        <uint8 value="0x{country_code:02x}" />
     </attribute>
     <attribute id="0x0204">
-        <boolean value="true" />
+        <boolean value="{virtual_cable}" />
     </attribute>
     <attribute id="0x0205">
-        <boolean value="true" />
+        <boolean value="{reconnect_initiate}" />
     </attribute>
     <attribute id="0x0206">
         <sequence>
             <sequence>
                 <uint8 value="0x22" />
-                <text encoding="hex" value="05010906a101850175019508050719e029e715002501810295017508810395057501050819012905910295017503910395067508150026ff000507190029ff8100c0050c0901a1018503150025017501950b0a23020a21020ab10109b809b609cd09b509e209ea09e9093081029501750d8103c005010902a1010901a100850295037501050919012903150025018102950175058103750895020501093009311581257f46670c3699f36513550c8106c0c0" />
+                <text encoding="hex" value="{descriptor}" />
             </sequence>
         </sequence>
     </attribute>
     <attribute id="0x0207">
         <sequence>
             <sequence>
-                <uint16 value="0x0409" />
+                <uint16 value="0x{language:04x}" />
                 <uint16 value="0x0100" />
             </sequence>
         </sequence>
@@ -114,28 +489,73 @@ HID_SERVICE_RECORD = """<?xml version="1.0" encoding="UTF-8" ?>
         <uint16 value="0x0100" />
     </attribute>
     <attribute id="0x020c">
-        <uint16 value="0x0c80" />
+        <uint16 value="0x{supervision_timeout:04x}" />
     </attribute>
     <attribute id="0x020d">
-        <boolean value="false" />
+        <boolean value="{normally_connectable}" />
     </attribute>
     <attribute id="0x020e">
-        <boolean value="true" />
+        <boolean value="{boot_device}" />
     </attribute>
     <attribute id="0x020f">
-        <uint16 value="0x0640" />
+        <uint16 value="0x{ssr_host_max_latency:04x}" />
     </attribute>
     <attribute id="0x0210">
-        <uint16 value="0x0320" />
+        <uint16 value="0x{ssr_host_min_timeout:04x}" />
     </attribute>
 </record>
 """
 
+# Device info that goes into the SDP record next to the report descriptor
+DEVICE_INFO = {
+    "name": "A Virtual Keyboard",
+    "description": "Keyboard > BT Keyboard",
+    "provider": "Durgesh",
+    "subclass": 0x40,  # HIDDeviceSubclass, 0x40 keyboard, 0x80 pointer, 0xC0 combo
+    "country_code": 0x00,
+    "virtual_cable": True,
+    "reconnect_initiate": True,
+    "language": 0x0409,
+    "supervision_timeout": 0x0c80,
+    "normally_connectable": False,
+    "boot_device": True,
+    "ssr_host_max_latency": 0x0640,
+    "ssr_host_min_timeout": 0x0320,
+}
+
+
+def build_service_record(descriptor, **device_info):
+    """
+    Build the HID SDP record XML for a report descriptor (bytes).
+    Keyword arguments override entries of DEVICE_INFO.
+    """
+    info = dict(DEVICE_INFO, **device_info)
+    for key, value in info.items():
+        if isinstance(value, bool):
+            info[key] = "true" if value else "false"
+        elif isinstance(value, str):
+            # '>' is fine inside an XML attribute value
+            info[key] = value.replace("&", "&amp;").replace("<", "&lt;").replace('"', "&quot;")
+    return _SERVICE_RECORD_TEMPLATE.format(descriptor=bytes(descriptor).hex(), **info)
+
+
+HID_DESCRIPTOR = parse_report_descriptor(HID_REPORT_DESCRIPTOR)
+
+# SDP record embedded so the script is fully self-contained
+HID_SERVICE_RECORD = build_service_record(HID_REPORT_DESCRIPTOR)
+
+HID_DESCRIPTOR_EXTENDED = parse_report_descriptor(HID_REPORT_DESCRIPTOR_EXTENDED)
+HID_SERVICE_RECORD_EXTENDED = build_service_record(HID_REPORT_DESCRIPTOR_EXTENDED)
+
 
 class BluetoothHIDProfile(dbus.service.Object):
-    def __init__(self, bus, path):
+    def __init__(self, bus, path, on_connection=None, on_disconnect=None):
         super(BluetoothHIDProfile, self).__init__(bus, path)
         self.fd = -1
+        # on_connection(device_path, sock, properties) takes over the socket
+        # BlueZ accepted for us, on_disconnect(device_path) when BlueZ asks for it back
+        self.on_connection = on_connection
+        self.on_disconnect = on_disconnect
 
     @dbus.service.method("org.bluez.Profile1", in_signature="", out_signature="")
     def Release(self):
@@ -154,11 +574,17 @@ class BluetoothHIDProfile(dbus.service.Object):
                 print("    %s = 0x%04x " % (k, v))
             else:
                 print("    %s = %s" % (k, v))
+        if self.on_connection is not None:
+            sock = socket.socket(fileno=self.fd)
+            self.fd = -1
+            self.on_connection(str(path), sock, properties)
 
     @dbus.service.method("org.bluez.Profile1",
                          in_signature="o", out_signature="")
     def RequestDisconnection(self, path):
         print("RequestDisconnection(%s)" % (path))
+        if self.on_disconnect is not None:
+            self.on_disconnect(str(path))
 
         if (self.fd > 0):
             os.close(self.fd)
@@ -169,376 +595,4500 @@ def error_handler(e):
     raise RuntimeError(str(e))
 
 
-class BluetoothHIDService(object):
-    PROFILE_PATH = "/org/bluez/bthid_profile_mouse"
+class StartupTimer(object):
+    """How long each startup phase took, reported as one line"""
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = []
 
-    HOST = 0
-    PORT = 1
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
 
-    def __init__(self, service_record, MAC, remote_mac=None):
-        self.P_CTRL = 0x0011
-        self.P_INTR = 0x0013
-        self.SELFMAC = MAC
-        self.service_record = service_record
-        self.remote_mac = remote_mac
-        self.bus = dbus.SystemBus()
-        self.manager = None
-        self.ccontrol = None
-        self.cinter = None
-        self.connected = False
-        self.sock_control_listen = None
-        self.sock_inter_listen = None
-        
-        # Initial connection
-        self._connect()
-    
-    def _connect(self):
-        """Internal method to establish connection"""
-        # Try to cleanup any existing profile first
-        self.cleanup_profile()
-        
-        bluez_obj = self.bus.get_object("org.bluez", "/org/bluez")
-        self.manager = dbus.Interface(bluez_obj, "org.bluez.ProfileManager1")
-
-        BluetoothHIDProfile(self.bus, self.PROFILE_PATH)
-        opts = {
-            "ServiceRecord": self.service_record,
-            "Name": "BTMouseProfile",
-            "RequireAuthentication": False,
-            "RequireAuthorization": False,
-            "Service": "MY BTHID MOUSE",
-            "Role": "server"
-        }
+    def report(self):
+        parts = ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in self.phases)
+        return f"Startup: {parts} | total {(time.perf_counter() - self.started) * 1000:.0f} ms"
 
-        self.manager.RegisterProfile(self.PROFILE_PATH, "00001124-0000-1000-8000-00805f9b34fb", opts)
-        print("Registered")
 
-        # If remote_mac is provided, try to connect to existing device
-        if self.remote_mac:
-            print(f"Attempting to connect to existing device: {self.remote_mac}")
-            try:
-                sock_control = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_SEQPACKET, socket.BTPROTO_L2CAP)
-                sock_control.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                sock_inter = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_SEQPACKET, socket.BTPROTO_L2CAP)
-                sock_inter.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                
-                print(f"Connecting control channel to {self.remote_mac}:{self.P_CTRL}...")
-                sock_control.connect((self.remote_mac, self.P_CTRL))
-                print("Control channel connected!")
-                
-                print(f"Connecting interrupt channel to {self.remote_mac}:{self.P_INTR}...")
-                sock_inter.connect((self.remote_mac, self.P_INTR))
-                print("Interrupt channel connected!")
-                
-                self.ccontrol = sock_control
-                self.cinter = sock_inter
-                self.connected = True
-                return
-            except Exception as e:
-                print(f"Failed to connect to existing device: {e}")
-                print("Falling back to waiting for incoming connection...")
-        
-        # Fall back to waiting for incoming connection
-        self.sock_control_listen = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_SEQPACKET, socket.BTPROTO_L2CAP)
-        self.sock_control_listen.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock_inter_listen = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_SEQPACKET, socket.BTPROTO_L2CAP)
-        self.sock_inter_listen.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock_control_listen.bind((self.SELFMAC, self.P_CTRL))
-        self.sock_inter_listen.bind((self.SELFMAC, self.P_INTR))
-        
-        self.sock_control_listen.listen(1)
-        self.sock_inter_listen.listen(1)
-        print(f"Waiting for connection at controller {self.SELFMAC}...")
-        self.ccontrol, cinfo = self.sock_control_listen.accept()
-        print("Control channel connected to " + cinfo[self.HOST])
-        self.remote_mac = cinfo[self.HOST]  # Save remote MAC for reconnection
-        self.cinter, cinfo = self.sock_inter_listen.accept()
-        print("Interrupt channel connected to " + cinfo[self.HOST])
-        self.connected = True
-    
-    def reconnect(self, max_attempts=5, delay=2):
-        """Attempt to reconnect after connection loss"""
-        print(f"\n⚠️  Connection lost! Attempting to reconnect to {self.remote_mac}...")
-        
-        # Close existing connections
-        try:
-            if self.ccontrol:
-                self.ccontrol.close()
-            if self.cinter:
-                self.cinter.close()
-        except:
-            pass
-        
-        self.connected = False
-        
-        for attempt in range(1, max_attempts + 1):
-            try:
-                print(f"Reconnection attempt {attempt}/{max_attempts}...")
-                
-                # Try to connect to the known remote device
-                if self.remote_mac:
-                    sock_control = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_SEQPACKET, socket.BTPROTO_L2CAP)
-                    sock_control.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                    sock_inter = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_SEQPACKET, socket.BTPROTO_L2CAP)
-                    sock_inter.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                    
-                    sock_control.connect((self.remote_mac, self.P_CTRL))
-                    print("✓ Control channel reconnected!")
-                    
-                    sock_inter.connect((self.remote_mac, self.P_INTR))
-                    print("✓ Interrupt channel reconnected!")
-                    
-                    self.ccontrol = sock_control
-                    self.cinter = sock_inter
-                    self.connected = True
-                    print("✓ Reconnection successful!\n")
-                    return True
-                    
-            except Exception as e:
-                print(f"✗ Attempt {attempt} failed: {e}")
-                if attempt < max_attempts:
-                    print(f"Waiting {delay} seconds before retry...")
-                    time.sleep(delay)
-        
-        print(f"✗ Failed to reconnect after {max_attempts} attempts")
-        return False
+class BlueZContext(object):
+    """
+    One system bus connection, a cache of proxies/interfaces and a single
+    GetManagedObjects snapshot, shared by everything that talks to BlueZ so
+    each round trip happens once per process. The snapshot is dropped when
+    BlueZ signals InterfacesAdded/InterfacesRemoved. Waits are driven by
+    D-Bus signals (dispatched through the GLib context DBusGMainLoop
+    installs) instead of fixed sleeps.
+    """
+    def __init__(self, bus=None):
+        self.bus = bus if bus is not None else dbus.SystemBus()
+        self._interfaces = {}
+        self._objects = None
+        self.loop = None
+        self.loop_thread = None
+        for signal in ("InterfacesAdded", "InterfacesRemoved"):
+            self.bus.add_signal_receiver(self._invalidate, signal_name=signal, bus_name="org.bluez",
+                                         dbus_interface="org.freedesktop.DBus.ObjectManager")
 
-    def send(self, bytes_buf):
-        if self.cinter and self.connected:
-            try:
-                self.cinter.send(bytes_buf)
-            except (ConnectionResetError, BrokenPipeError, OSError) as e:
-                print(f"\n⚠️  Send failed: {e}")
-                self.connected = False
-                raise  # Re-raise to let caller handle reconnection
-            
-    def cleanup_profile(self):
-        """Unregister the profile if it exists"""
-        try:
-            bluez_obj = self.bus.get_object("org.bluez", "/org/bluez")
-            manager = dbus.Interface(bluez_obj, "org.bluez.ProfileManager1")
-            manager.UnregisterProfile(self.PROFILE_PATH)
-            print(f"Cleaned up existing profile at {self.PROFILE_PATH}")
-            time.sleep(0.5)  # Give it time to unregister
-        except dbus.exceptions.DBusException as e:
-            if "Does Not Exist" not in str(e):
-                print(f"Note: {e}")
-        except Exception as e:
-            pass
+    def _invalidate(self, *args):
+        self._objects = None
 
-class MouseEmulator:
-    def __init__(self, bthid_service):
-        self.bthid_service = bthid_service
-        self.mouse_state = bytearray([
-            0xA1,
-            0x02,  # Report ID
-            0x00,  # mouse button, in this byte XXXXX(button2)(button1)(button0)
-            0x00,  # X displacement
-            0x00,  # Y displacement
-        ])
-    
-    def send_with_reconnect(self, data):
-        """Send data with automatic reconnection on failure"""
-        max_retries = 3
-        for retry in range(max_retries):
-            try:
-                self.bthid_service.send(data)
-                return True
-            except (ConnectionResetError, BrokenPipeError, OSError) as e:
-                if retry < max_retries - 1:
-                    print(f"Attempting to reconnect (retry {retry + 1}/{max_retries})...")
-                    if self.bthid_service.reconnect():
-                        continue  # Try sending again
-                    else:
-                        print("Reconnection failed!")
-                        return False
-                else:
-                    print("Max retries reached!")
-                    return False
-        return False
-        
-    def move_mouse(self, x_displacement, y_displacement):
-        """
-        Move mouse by specified displacement
-        x_displacement: horizontal movement (-128 to 127, negative is left, positive is right)
-        y_displacement: vertical movement (-128 to 127, negative is up, positive is down)
-        """
-        # Clamp values to valid range
-        x_displacement = max(-128, min(x_displacement, 127))
-        y_displacement = max(-128, min(y_displacement, 127))
-        
-        # Convert negative values to unsigned byte representation
-        self.mouse_state[3] = x_displacement if x_displacement >= 0 else (256 + x_displacement)
-        self.mouse_state[4] = y_displacement if y_displacement >= 0 else (256 + y_displacement)
-        
-        print(f"Moving mouse: X={x_displacement}, Y={y_displacement}")
-        if not self.send_with_reconnect(bytes(self.mouse_state)):
-            raise Exception("Failed to send mouse movement after reconnection attempts")
-        
-        # Reset to zero movement after sending
-        self.mouse_state[3] = 0x00
-        self.mouse_state[4] = 0x00
-        
-    def click(self, button=1):
-        """
-        Click a mouse button (1=left, 2=right, 3=middle)
-        """
-        # Press button
-        self.mouse_state[2] |= 1 << (button - 1)
-        if not self.send_with_reconnect(bytes(self.mouse_state)):
-            raise Exception("Failed to send mouse click after reconnection attempts")
-        time.sleep(0.05)  # Small delay
-        
-        # Release button
-        self.mouse_state[2] &= ~(1 << (button - 1))
-        if not self.send_with_reconnect(bytes(self.mouse_state)):
-            raise Exception("Failed to send mouse release after reconnection attempts")
-        
-    def demo_movement(self):
+    def interface(self, path, name, service="org.bluez"):
+        key = (service, path, name)
+        iface = self._interfaces.get(key)
+        if iface is None:
+            iface = self._interfaces[key] = dbus.Interface(self.bus.get_object(service, path), name)
+        return iface
+
+    def profile_manager(self):
+        return self.interface("/org/bluez", "org.bluez.ProfileManager1")
+
+    def managed_objects(self, refresh=False):
+        """The GetManagedObjects snapshot, fetched once and reused"""
+        if self._objects is None or refresh:
+            self._objects = self.interface("/", "org.freedesktop.DBus.ObjectManager").GetManagedObjects()
+        return self._objects
+
+    def adapters(self):
+        """{object path: Adapter1 properties}"""
+        return {str(path): interfaces["org.bluez.Adapter1"]
+                for path, interfaces in self.managed_objects().items() if "org.bluez.Adapter1" in interfaces}
+
+    def devices(self, connected=True):
+        """{object path: Device1 properties}, only connected ones by default"""
+        return {str(path): interfaces["org.bluez.Device1"]
+                for path, interfaces in self.managed_objects().items()
+                if "org.bluez.Device1" in interfaces
+                and (not connected or interfaces["org.bluez.Device1"].get("Connected", False))}
+
+    def wait_for(self, ready, timeout, **match):
         """
-        Demo: Draw circles with the mouse continuously
+        Wait until ready() returns true, re-checking it on every D-Bus
+        signal matching **match (add_signal_receiver arguments). Returns
+        ready()'s final value, False on timeout.
         """
-        import math
-        
-        print("\n=== Starting Infinite Circle Demo ===")
-        print("Drawing circles continuously... Press Ctrl+C to stop")
-        
-        # Draw circles - 3x larger radius
-        radius = 60  # 3x larger (was effectively 20)
-        steps = 36   # Number of steps to complete the circle
-        
-        circle_num = 0
+        if self.loop is not None:
+            return self._wait_threaded(ready, timeout, match)
+        signalled = []
+        receiver = self.bus.add_signal_receiver(lambda *args: signalled.append(True), **match)
+        expired = []
+        timer = GLib.timeout_add(int(timeout * 1000), lambda: expired.append(True) and False)
+        context = GLib.MainContext.default()
         try:
-            while True:  # Infinite loop
-                circle_num += 1
-                print(f"Circle {circle_num}")
-                for step in range(steps):
-                    angle = (2 * math.pi * step) / steps
-                    
-                    # Calculate the next position
-                    next_angle = (2 * math.pi * (step + 1)) / steps
-                    
-                    # Calculate displacement from current to next point
-                    dx = int(radius * (math.cos(next_angle) - math.cos(angle)))
-                    dy = int(radius * (math.sin(next_angle) - math.sin(angle)))
-                    
-                    self.move_mouse(dx, dy)
-                    time.sleep(0.05)  # Small delay between movements
-                
-                # No pause between circles - continuous drawing
-                
-        except KeyboardInterrupt:
-            print(f"\n=== Demo stopped after {circle_num} circles ===")
-        
-    def continuous_demo(self):
+            # Subscribed before the first check, so nothing slips through
+            result = ready()
+            while not result and not expired:
+                context.iteration(True)
+                if signalled:
+                    del signalled[:]
+                    result = ready()
+            return result
+        finally:
+            receiver.remove()
+            if not expired:
+                GLib.source_remove(timer)
+
+    def _wait_threaded(self, ready, timeout, match):
+        # The main loop thread owns the GLib context and dispatches the signals
+        signalled = threading.Event()
+        receiver = self.bus.add_signal_receiver(lambda *args: signalled.set(), **match)
+        deadline = time.monotonic() + timeout
+        try:
+            result = ready()
+            while not result:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not signalled.wait(remaining):
+                    return False
+                signalled.clear()
+                result = ready()
+            return result
+        finally:
+            receiver.remove()
+
+    def start_loop(self):
         """
-        Continuously move mouse in a pattern every few seconds
+        Run the GLib main loop on a daemon thread, so D-Bus calls into this
+        process (profile NewConnection/RequestDisconnection) and IO watches
+        get dispatched while the rest of the program does its own thing.
         """
-        print("\n=== Starting Continuous Mouse Demo ===")
-        print("Press Ctrl+C to stop")
-        
+        if self.loop is None:
+            dbus.mainloop.glib.threads_init()
+            self.loop = GLib.MainLoop()
+            self.loop_thread = threading.Thread(target=self.loop.run, name="bluez-mainloop", daemon=True)
+            self.loop_thread.start()
+
+    def stop_loop(self):
+        if self.loop is not None:
+            self.loop.quit()
+            self.loop_thread.join()
+            self.loop = None
+            self.loop_thread = None
+
+    def wait_for_bluez(self, timeout=10):
+        """Wait for bluetoothd to own org.bluez (e.g. right after a service restart)"""
+        return self.wait_for(lambda: self.bus.name_has_owner("org.bluez"), timeout,
+                             signal_name="NameOwnerChanged", dbus_interface="org.freedesktop.DBus",
+                             arg0="org.bluez")
+
+    def wait_for_adapter(self, timeout=10):
+        """Wait until at least one adapter exists, returns its Adapter1 properties or False"""
+        def ready():
+            adapters = self.adapters()
+            return next(iter(adapters.values())) if adapters else False
+        return self.wait_for(ready, timeout, signal_name="InterfacesAdded", bus_name="org.bluez",
+                             dbus_interface="org.freedesktop.DBus.ObjectManager")
+
+
+def register_hid_profile(bluez, service_record, path, on_connection=None, on_disconnect=None):
+    """
+    Register the HID profile with BlueZ, returns the ProfileManager1 interface.
+    With on_connection BlueZ itself listens on the control PSM and passes
+    every accepted control channel to it (see ProfileConnector).
+    """
+    manager = bluez.profile_manager()
+
+    BluetoothHIDProfile(bluez.bus, path, on_connection, on_disconnect)
+    opts = {
+        "ServiceRecord": service_record,
+        "Name": "BTMouseProfile",
+        "RequireAuthentication": False,
+        "RequireAuthorization": False,
+        "Service": "MY BTHID MOUSE",
+        "Role": "server"
+    }
+    if on_connection is not None:
+        opts["PSM"] = dbus.UInt16(L2CAPTransport.P_CTRL)
+
+    manager.RegisterProfile(path, "00001124-0000-1000-8000-00805f9b34fb", opts)
+    print("Registered")
+    return manager
+
+
+class L2CAPTransport(object):
+    """HID control and interrupt channels over real Bluetooth L2CAP sockets"""
+    uses_bluez = True
+
+    P_CTRL = 0x0011
+    P_INTR = 0x0013
+
+    HOST = 0
+    PORT = 1
+
+    def __init__(self, controller_mac, listener=None):
+        self.controller_mac = controller_mac
+        # accept() waits on the listener's sockets, pass another transport of
+        # the same adapter to let several hosts share one pair of PSMs
+        self.listener = listener if listener is not None else self
+        self.control = None
+        self.interrupt = None
+        self.sock_control_listen = None
+        self.sock_inter_listen = None
+
+    def _new_socket(self):
+        sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_SEQPACKET, socket.BTPROTO_L2CAP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        return sock
+
+    def connect(self, remote_mac):
+        """Open both channels to an already paired host"""
+        sock_control = self._new_socket()
+        sock_inter = self._new_socket()
         try:
-            while True:
-                print("\nMoving RIGHT...")
-                for i in range(3):
-                    self.move_mouse(30, 0)
-                    time.sleep(0.3)
-                
-                time.sleep(2)
-                
-                print("Moving LEFT...")
-                for i in range(3):
-                    self.move_mouse(-30, 0)
-                    time.sleep(0.3)
-                
-                time.sleep(2)
-                
-        except KeyboardInterrupt:
-            print("\n\nDemo stopped by user")
+            if self.controller_mac:
+                # Leave from our adapter, unbound sockets take the first one that is up
+                sock_control.bind((self.controller_mac, 0))
+                sock_inter.bind((self.controller_mac, 0))
+            print(f"Connecting control channel to {remote_mac}:{self.P_CTRL}...")
+            sock_control.connect((remote_mac, self.P_CTRL))
+            print("Control channel connected!")
 
+            print(f"Connecting interrupt channel to {remote_mac}:{self.P_INTR}...")
+            sock_inter.connect((remote_mac, self.P_INTR))
+            print("Interrupt channel connected!")
+        except Exception:
+            sock_control.close()
+            sock_inter.close()
+            raise
 
-def get_controller_mac():
-    """Get MAC address of the local Bluetooth adapter"""
-    try:
-        bus = dbus.SystemBus()
-        manager = dbus.Interface(bus.get_object("org.bluez", "/"), "org.freedesktop.DBus.ObjectManager")
-        objects = manager.GetManagedObjects()
-        
-        for path, interfaces in objects.items():
-            if "org.bluez.Adapter1" in interfaces:
-                adapter = interfaces["org.bluez.Adapter1"]
-                mac = adapter.get("Address")
-                name = adapter.get("Name", "Unknown")
-                print(f"Found Bluetooth adapter: {name} ({mac})")
-                return mac
-        return None
-    except Exception as e:
-        print(f"Error finding Bluetooth adapter: {e}")
-        return None
+        self.control = sock_control
+        self.interrupt = sock_inter
 
+    def listen(self):
+        if self.sock_control_listen is None:
+            self.sock_control_listen = self._new_socket()
+            self.sock_inter_listen = self._new_socket()
+            self.sock_control_listen.bind((self.controller_mac, self.P_CTRL))
+            self.sock_inter_listen.bind((self.controller_mac, self.P_INTR))
+            self.sock_control_listen.listen(1)
+            self.sock_inter_listen.listen(1)
 
-def get_connected_device_mac():
-    """Get MAC address of connected Bluetooth device"""
-    try:
-        bus = dbus.SystemBus()
-        manager = dbus.Interface(bus.get_object("org.bluez", "/"), "org.freedesktop.DBus.ObjectManager")
-        objects = manager.GetManagedObjects()
-        
-        for path, interfaces in objects.items():
-            if "org.bluez.Device1" in interfaces:
-                device = interfaces["org.bluez.Device1"]
-                if device.get("Connected", False):
-                    mac = device.get("Address")
-                    name = device.get("Name", "Unknown")
-                    print(f"Found connected device: {name} ({mac})")
-                    return mac
-        return None
-    except Exception as e:
-        print(f"Error finding connected device: {e}")
-        return None
+    def accept(self):
+        """Wait for the host to open both channels, returns the host MAC"""
+        listener = self.listener
+        listener.listen()
+
+        print(f"Waiting for connection at controller {self.controller_mac}...")
+        self.control, cinfo = listener.sock_control_listen.accept()
+        print("Control channel connected to " + cinfo[self.HOST])
+        remote_mac = cinfo[self.HOST]
+        self.interrupt, cinfo = listener.sock_inter_listen.accept()
+        print("Interrupt channel connected to " + cinfo[self.HOST])
+        return remote_mac
 
+    def close(self):
+        """Close the connected channels, listening sockets stay open"""
+        for sock in (self.control, self.interrupt):
+            if sock:
+                try:
+                    sock.close()
+                except OSError:
+                    pass
+        self.control = None
+        self.interrupt = None
 
-def cleanup_profile():
-    """Cleanup any existing Bluetooth profile registration"""
-    import dbus
-    PROFILE_PATH = "/org/bluez/bthid_profile_mouse"
-    try:
-        bus = dbus.SystemBus()
-        bluez_obj = bus.get_object("org.bluez", "/org/bluez")
-        manager = dbus.Interface(bluez_obj, "org.bluez.ProfileManager1")
-        manager.UnregisterProfile(PROFILE_PATH)
-        print("Cleaned up existing profile registration")
-        time.sleep(0.5)
-    except:
-        pass  # Profile wasn't registered, which is fine
+    def shutdown(self):
+        """Close everything, including the listening sockets"""
+        self.close()
+        for sock in (self.sock_control_listen, self.sock_inter_listen):
+            if sock:
+                sock.close()
+        self.sock_control_listen = None
+        self.sock_inter_listen = None
 
 
-if __name__ == '__main__':
-    DBusGMainLoop(set_as_default=True)
-    service_record = HID_SERVICE_RECORD
-    
-    # Clean up any existing profile first
-    cleanup_profile()
-    
-    bthid_srv = None
-    try:
-        print("Initializing Bluetooth HID Service...")
-        
-        # Auto-detect controller MAC if not specified
-        controller_mac = CONTROLLER_MAC
-        if not controller_mac:
-            controller_mac = get_controller_mac()
-            if not controller_mac:
-                print("ERROR: Could not detect Bluetooth adapter MAC address!")
-                sys.exit(1)
-        
-        # Try to find already connected device
-        remote_mac = get_connected_device_mac()
-        
-        bthid_srv = BluetoothHIDService(service_record, controller_mac, remote_mac)
-        
-        print("\nBluetooth HID Service connected!")
-        emulator = MouseEmulator(bthid_srv)
+class LoopbackTransport(object):
+    """
+    Local stand-in for the L2CAP channels built from AF_UNIX SOCK_SEQPACKET
+    socket pairs. Message boundaries are kept just like on L2CAP, so every
+    send() still is exactly one HID report.
+
+    The far ends are exposed as host_control / host_interrupt so a reader in
+    the same process can play the host. No BlueZ, D-Bus or radio is needed.
+    """
+    uses_bluez = False
+
+    def __init__(self, remote_mac="00:00:00:00:00:00"):
+        self.remote_mac = remote_mac
+        self.control = None
+        self.interrupt = None
+        self.host_control = None
+        self.host_interrupt = None
+        self.reports_received = 0
+        self.bytes_received = 0
+        self._drain_thread = None
+
+    def _open(self):
+        self.close()
+        self.control, self.host_control = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.interrupt, self.host_interrupt = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+    def connect(self, remote_mac):
+        self.remote_mac = remote_mac
+        self._open()
+
+    def accept(self):
+        self._open()
+        return self.remote_mac
+
+    def close(self):
+        for sock in (self.control, self.interrupt, self.host_control, self.host_interrupt):
+            if sock:
+                try:
+                    # shutdown() first so a drain thread blocked in recv wakes up
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                sock.close()
+        self.control = None
+        self.interrupt = None
+        self.host_control = None
+        self.host_interrupt = None
+
+    def shutdown(self):
+        self.close()
+
+    def hang_up(self):
+        """
+        Drop the link from the host's side, like a host that went away: our
+        channels see end of file and sends fail. The sockets are closed by
+        the next connect()/accept(), not here under a reader's feet.
+        """
+        for sock in (self.host_control, self.host_interrupt):
+            if sock:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def start_drain(self):
+        """Read and discard everything the host side receives on a daemon thread"""
+        if self._drain_thread is None:
+            self._drain_thread = threading.Thread(target=self._drain, daemon=True)
+            self._drain_thread.start()
+
+    def _drain(self):
+        buf = bytearray(64)
+        while True:
+            sock = self.host_interrupt
+            if sock is None:
+                time.sleep(0.01)
+                continue
+            try:
+                n = sock.recv_into(buf)
+            except OSError:
+                n = 0
+            if n == 0:
+                # Channel closed, wait for the next connect()/accept()
+                while self.host_interrupt is sock:
+                    time.sleep(0.01)
+                continue
+            self.reports_received += 1
+            self.bytes_received += n
+
+
+class HostSimulator(object):
+    """
+    Plays the host at the far end of a LoopbackTransport's interrupt
+    channel. Every input report is decoded with the report descriptor and
+    folded into what a host would make of it: the cursor position (relative
+    motion summed up without pointer acceleration, absolute reports setting
+    it in logical units), buttons, wheel and pan totals, held keys and
+    modifiers, and the consumer usage. Each arrival is stamped with
+    time.perf_counter_ns(). Follows the transport across reconnects.
+
+    Usage:
+        transport = LoopbackTransport()
+        service = BluetoothHIDService(HID_SERVICE_RECORD, None, transport=transport)
+        host = HostSimulator(transport).start()
+        MouseEmulator(service).move_mouse(10, 5)
+        host.wait_for(1)
+        print(host.x, host.y)  # 10 5
+    """
+    POLL = 0.1  # s, how often the reader thread checks for stop()
+
+    def __init__(self, transport, descriptor=HID_DESCRIPTOR, keep_trace=False):
+        self.transport = transport
+        self.descriptor = descriptor
+        self.keep_trace = keep_trace
+        self.boot_protocol = False  # decode keyboard and mouse by their boot layouts
+        self._decoders = {report_id: (descriptor.report(report_id).size, descriptor.report(report_id).unpack)
+                          for report_id in descriptor.report_ids()}
+        self.cond = threading.Condition()
+        self.running = False
+        self._thread = None
+        self.reset()
+
+    def reset(self):
+        """Back to a freshly connected host: nothing held, cursor at 0, 0, no arrivals"""
+        with self.cond:
+            self.x = 0
+            self.y = 0
+            self.buttons = 0
+            self.wheel = 0
+            self.pan = 0
+            self.modifiers = 0
+            self.keys = ()
+            self.consumer = 0
+            self.reports = 0
+            self.unknown = 0
+            self.presses = 0  # button press edges, i.e. clicks
+            self.arrivals = array.array("q")  # perf_counter_ns of every decoded report
+            self.trace = array.array("q") if self.keep_trace else None  # x, y after every mouse report
+
+    def start(self):
+        if self._thread is None:
+            self.running = True
+            self._thread = threading.Thread(target=self._run, name="host-simulator", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        buf = bytearray(64)
+        feed = self.feed
+        while self.running:
+            current = self.transport.host_interrupt
+            try:
+                # A descriptor of our own: the transport closes its one on
+                # reconnect, and a number reused meanwhile would be read here
+                sock = current.dup()
+            except (AttributeError, OSError):
+                time.sleep(0.001)
+                continue
+            sock.settimeout(self.POLL)
+            with sock:
+                while self.running:
+                    try:
+                        n = sock.recv_into(buf)
+                    except socket.timeout:
+                        continue
+                    except OSError:
+                        n = 0
+                    if n == 0:
+                        break
+                    feed(buf[:n], time.perf_counter_ns())
+            # Channel closed, pick up the next one after a reconnect
+            while self.running and self.transport.host_interrupt is current:
+                time.sleep(0.001)
+
+    def _boot_values(self, report_id, message):
+        fields = _BOOT_REPORTS[report_id].unpack_from(message)
+        if report_id == 1:
+            return {"modifiers": fields[2], "keys": fields[3:]}
+        return {"buttons": fields[2], "x": fields[3], "y": fields[4]}
+
+    def feed(self, message, timestamp=None):
+        """Decode one interrupt-channel message as the host would"""
+        if timestamp is None:
+            timestamp = time.perf_counter_ns()
+        with self.cond:
+            report_id = message[1] if len(message) > 1 and message[0] == 0xA1 else None
+            size, decode = self._decoders.get(report_id, (None, None))
+            if self.boot_protocol and report_id in _BOOT_REPORTS:
+                size = _BOOT_REPORTS[report_id].size - 2
+            if decode is None or len(message) - 2 < size:
+                self.unknown += 1
+                return
+            if self.boot_protocol and report_id in _BOOT_REPORTS:
+                values = self._boot_values(report_id, message)
+            else:
+                values = decode(message[2:])
+            if report_id == 1:
+                self.modifiers = values["modifiers"]
+                self.keys = tuple(key for key in values["keys"] if key)
+            elif report_id == 2:
+                buttons = values["buttons"]
+                self.presses += bin(buttons & ~self.buttons).count("1")
+                self.buttons = buttons
+                self.x += values["x"]
+                self.y += values["y"]
+                self.wheel += values.get("wheel", 0)
+                self.pan += values.get("pan", 0)
+                if self.trace is not None:
+                    self.trace.append(self.x)
+                    self.trace.append(self.y)
+            elif report_id == 3:
+                self.consumer = values["consumer"]
+            elif report_id == AbsolutePointerEncoder.REPORT_ID:
+                buttons = values["buttons"]
+                self.presses += bin(buttons & ~self.buttons).count("1")
+                self.buttons = buttons
+                self.x = values["x"]
+                self.y = values["y"]
+            self.reports += 1
+            self.arrivals.append(timestamp)
+            self.cond.notify_all()
+
+    def wait_for(self, reports, timeout=5.0):
+        """Wait until reports reports have arrived in total, False on timeout"""
+        with self.cond:
+            return self.cond.wait_for(lambda: self.reports >= reports, timeout)
+
+
+class ProfileConnector(object):
+    """
+    Event-driven host connections, nothing ever blocks in accept().
+
+    BlueZ listens on the control PSM for the registered profile and hands
+    every accepted control channel over through
+    BluetoothHIDProfile.NewConnection. The interrupt channel is accepted
+    from a non-blocking listening socket watched by the same GLib main
+    loop, which runs on the BlueZContext thread. Once both channels of a
+    host are up, on_host(remote_mac, controller_mac, control, interrupt)
+    is called from that thread. When BlueZ asks for a host's connection
+    back (RequestDisconnection) its half-open channels are closed and
+    on_disconnect(remote_mac) closes whatever was made of the open ones.
+    """
+    PAIR_TIMEOUT = 10.0  # s a host may take between opening its two channels
+
+    def __init__(self, bluez, service_record, on_host, path=None, on_disconnect=None):
+        self.bluez = bluez
+        self.on_host = on_host
+        self.on_disconnect = on_disconnect
+        self.path = path or BluetoothHIDService.PROFILE_PATH
+        self.controls = {}    # remote MAC -> (control channel, opened at)
+        self.interrupts = {}  # remote MAC -> (interrupt channel, opened at)
+        self.lock = threading.Lock()
+        self.listener = self._listen()
+        self._watch = GLib.io_add_watch(self.listener.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN,
+                                        self._accept_interrupt)
+        self.manager = register_hid_profile(bluez, service_record, self.path,
+                                            on_connection=self._new_connection,
+                                            on_disconnect=self._disconnect)
+        self._own_loop = bluez.loop is None
+        bluez.start_loop()
+
+    def _listen(self):
+        sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_SEQPACKET, socket.BTPROTO_L2CAP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Any adapter, the accepted socket tells which one
+        sock.bind((socket.BDADDR_ANY, L2CAPTransport.P_INTR))
+        sock.listen(5)
+        sock.setblocking(False)
+        return sock
+
+    @staticmethod
+    def device_mac(device_path):
+        """/org/bluez/hci0/dev_AA_BB_CC_DD_EE_FF -> AA:BB:CC:DD:EE:FF"""
+        return device_path.rsplit("/", 1)[-1][len("dev_"):].replace("_", ":")
+
+    def _new_connection(self, device_path, sock, properties):
+        mac = self.device_mac(device_path)
+        print("Control channel connected to " + mac)
+        self._add(mac, self.controls, sock)
+
+    def _accept_interrupt(self, fd, condition):
+        try:
+            sock, address = self.listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError as e:
+            print(f"⚠️  Interrupt channel accept failed: {e}")
+            return True
+        sock.setblocking(True)
+        print("Interrupt channel connected to " + address[0])
+        self._add(address[0], self.interrupts, sock)
+        return True  # keep watching
+
+    def _add(self, mac, channels, sock):
+        now = time.monotonic()
+        with self.lock:
+            # Drop half-open hosts that never opened their other channel
+            for table in (self.controls, self.interrupts):
+                for stale in [m for m, (_, opened) in table.items() if now - opened > self.PAIR_TIMEOUT]:
+                    table.pop(stale)[0].close()
+            previous = channels.pop(mac, None)
+            if previous is not None:
+                previous[0].close()
+            channels[mac] = (sock, now)
+            if mac not in self.controls or mac not in self.interrupts:
+                return
+            control = self.controls.pop(mac)[0]
+            interrupt = self.interrupts.pop(mac)[0]
+        try:
+            self.on_host(mac, control.getsockname()[0], control, interrupt)
+        except Exception as e:
+            print(f"⚠️  Could not take over host {mac}: {e}")
+            control.close()
+            interrupt.close()
+
+    def _disconnect(self, device_path):
+        mac = self.device_mac(device_path)
+        with self.lock:
+            for table in (self.controls, self.interrupts):
+                pending = table.pop(mac, None)
+                if pending is not None:
+                    pending[0].close()
+        # Channels already handed over belong to on_host's taker
+        if self.on_disconnect is not None:
+            self.on_disconnect(mac)
+
+    def close(self):
+        GLib.source_remove(self._watch)
+        self.listener.close()
+        with self.lock:
+            for table in (self.controls, self.interrupts):
+                for sock, _ in table.values():
+                    sock.close()
+                table.clear()
+        if self._own_loop:
+            self.bluez.stop_loop()
+
+
+class LatencyHistogram(object):
+    """
+    Fixed-bucket latency histogram (Prometheus style). Recording is a
+    bisect and two increments, cheap enough to leave on all the time.
+    """
+    # Upper bounds in nanoseconds, 5 us .. 1 s
+    BOUNDS_NS = [5000, 10000, 25000, 50000, 100000, 250000, 500000, 1000000, 2500000,
+                 5000000, 10000000, 25000000, 50000000, 100000000, 250000000, 1000000000]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS_NS) + 1)  # last one is +Inf
+        self.count = 0
+        self.sum_ns = 0
+
+    def record(self, ns):
+        self.counts[bisect.bisect_left(self.BOUNDS_NS, ns)] += 1
+        self.count += 1
+        self.sum_ns += ns
+
+    def percentile(self, q):
+        """Upper bound (seconds) of the bucket holding the q-th quantile, None if empty"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return self.BOUNDS_NS[i] / 1e9 if i < len(self.BOUNDS_NS) else float("inf")
+        return float("inf")
+
+
+class HIDMetrics(object):
+    """
+    Runtime counters of one link: per-report send latency, reports and
+    bytes sent, send errors, reconnect count/duration and gauges such as
+    queue depth (registered as callables). Updated without locks, a rare
+    lost increment under thread contention is the price of staying off the
+    hot path. Served by MetricsServer in Prometheus text or JSON.
+    """
+    def __init__(self):
+        self.started = time.monotonic()
+        self.send_latency = LatencyHistogram()
+        self.reports_sent = 0
+        self.bytes_sent = 0
+        self.send_errors = 0
+        self.reconnects = 0
+        self.reconnect_seconds = LatencyHistogram()
+        self.control_latency = LatencyHistogram()  # control request in -> reply out
+        self.schedule_lateness = LatencyHistogram()  # ReportScheduler: send start - deadline
+        self.counters = collections.defaultdict(int)  # anything else, e.g. mouse_moves
+        self.gauges = {}
+        self._last_sample = (self.started, 0, 0)
+
+    def record_send(self, ns, size):
+        self.send_latency.record(ns)
+        self.reports_sent += 1
+        self.bytes_sent += size
+
+    def record_reconnect(self, seconds):
+        self.reconnects += 1
+        self.reconnect_seconds.record(int(seconds * 1e9))
+
+    def add_gauge(self, name, func):
+        """Register a callable sampled at scrape time, e.g. a queue length"""
+        self.gauges[name] = func
+
+    def rates(self):
+        """reports/s and bytes/s since the previous call (or since start)"""
+        now = time.monotonic()
+        then, reports, sent_bytes = self._last_sample
+        self._last_sample = (now, self.reports_sent, self.bytes_sent)
+        elapsed = max(now - then, 1e-9)
+        return (self.reports_sent - reports) / elapsed, (self.bytes_sent - sent_bytes) / elapsed
+
+    def snapshot(self):
+        """Everything as a JSON-friendly dict"""
+        reports_per_sec, bytes_per_sec = self.rates()
+        latency = self.send_latency
+        return {
+            "uptime_s": time.monotonic() - self.started,
+            "reports_sent": self.reports_sent,
+            "bytes_sent": self.bytes_sent,
+            "reports_per_sec": reports_per_sec,
+            "bytes_per_sec": bytes_per_sec,
+            "send_errors": self.send_errors,
+            "send_latency_s": {
+                "count": latency.count,
+                "mean": latency.sum_ns / latency.count / 1e9 if latency.count else None,
+                "p50": latency.percentile(0.5),
+                "p90": latency.percentile(0.9),
+                "p99": latency.percentile(0.99),
+            },
+            "reconnects": self.reconnects,
+            "reconnect_seconds_total": self.reconnect_seconds.sum_ns / 1e9,
+            "control_latency_s": {
+                "count": self.control_latency.count,
+                "p99": self.control_latency.percentile(0.99),
+            },
+            "schedule_lateness_s": {
+                "count": self.schedule_lateness.count,
+                "p50": self.schedule_lateness.percentile(0.5),
+                "p99": self.schedule_lateness.percentile(0.99),
+            },
+            "counters": dict(self.counters),
+            "gauges": {name: func() for name, func in self.gauges.items()},
+        }
+
+    def prometheus(self, labels=""):
+        """Prometheus text exposition lines, labels like 'source="mouse"'"""
+        sel = "{" + labels + "}" if labels else ""
+        sep = labels + "," if labels else ""
+        lines = []
+
+        def histogram(name, hist):
+            seen = 0
+            for bound, n in zip(hist.BOUNDS_NS + [None], hist.counts):
+                seen += n
+                le = "+Inf" if bound is None else repr(bound / 1e9)
+                lines.append(f'{name}_bucket{{{sep}le="{le}"}} {seen}')
+            lines.append(f"{name}_sum{sel} {hist.sum_ns / 1e9}")
+            lines.append(f"{name}_count{sel} {hist.count}")
+
+        lines.append(f"bthid_reports_sent_total{sel} {self.reports_sent}")
+        lines.append(f"bthid_bytes_sent_total{sel} {self.bytes_sent}")
+        lines.append(f"bthid_send_errors_total{sel} {self.send_errors}")
+        lines.append(f"bthid_reconnects_total{sel} {self.reconnects}")
+        histogram("bthid_send_latency_seconds", self.send_latency)
+        histogram("bthid_reconnect_duration_seconds", self.reconnect_seconds)
+        histogram("bthid_control_latency_seconds", self.control_latency)
+        histogram("bthid_schedule_lateness_seconds", self.schedule_lateness)
+        for name, value in self.counters.items():
+            lines.append(f"bthid_{name}_total{sel} {value}")
+        for name, func in self.gauges.items():
+            lines.append(f"bthid_{name}{sel} {func()}")
+        return lines
+
+
+REPORT_LOG_MAGIC = b"BTHIDRC1"
+REPORT_INDEX_MAGIC = b"BTHIDIX1"
+
+
+class ReportRecorder(object):
+    """
+    Append-only binary log of every report sent on a link. Attach with
+    service.recorder = ReportRecorder(path).
+
+    File layout: the 8 byte magic REPORT_LOG_MAGIC, then one record per
+    report: uint32 microseconds since the previous record (monotonic clock,
+    saturates after ~71 minutes of silence), uint8 message length, then the
+    interrupt-channel message itself (header byte, report ID, data).
+    Appending to an existing log continues it. Buffered records are
+    flushed at least every FLUSH_NS while reports keep coming, and on close.
+    """
+    RECORD = struct.Struct("<IB")
+    MAX_DELTA_US = 0xFFFFFFFF
+    FLUSH_NS = 1_000_000_000
+
+    def __init__(self, path):
+        self.path = path
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, "ab")
+        if new:
+            self.file.write(REPORT_LOG_MAGIC)
+            self.file.flush()  # a valid (empty) log even if we never get to close()
+        self.last_ns = None
+        self.flushed_ns = time.monotonic_ns()
+        self.records = 0
+
+    def record(self, message):
+        now = time.monotonic_ns()
+        delta_us = 0 if self.last_ns is None else (now - self.last_ns) // 1000
+        if delta_us > self.MAX_DELTA_US:
+            delta_us = self.MAX_DELTA_US
+        self.last_ns = now
+        self.file.write(self.RECORD.pack(delta_us, len(message)))
+        self.file.write(message)
+        self.records += 1
+        if now - self.flushed_ns >= self.FLUSH_NS:
+            self.flush()
+
+    def flush(self):
+        self.file.flush()
+        self.flushed_ns = time.monotonic_ns()
+
+    def close(self):
+        self.file.close()
+
+
+class ReportReplayer(object):
+    """
+    Memory-mapped reader for ReportRecorder logs.
+
+    The record offsets and absolute timestamps are kept in a sidecar index
+    (path + ".idx", a header identifying the log, then pairs of uint64)
+    which is itself mmap'd; it is built on first use, extended incrementally
+    when the log has grown since and rebuilt when it belongs to another log.
+    Where it can't be written the index is only kept in memory.
+    Records are handed out as memoryview slices of the mapped log, no copy.
+
+    Usage:
+        replayer = ReportReplayer("session.bthid")
+        replayer.replay(service.send)              # original timing
+        replayer.replay(service.send, speed=None)  # as fast as the link allows
+    """
+    INDEX = struct.Struct("<QQ")  # record offset, time since start of log in ns
+    # Index file header: magic, st_dev and st_ino of the log, bytes of the log
+    # indexed so far, CRC-32 of the first and last IDENTITY_WINDOW of those
+    INDEX_HEADER = struct.Struct("<8sQQQQ")
+    IDENTITY_WINDOW = 4096
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        if size < len(REPORT_LOG_MAGIC):
+            raise ValueError(f"{path} is not a report log (too short)")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        if self.map[:len(REPORT_LOG_MAGIC)] != REPORT_LOG_MAGIC:
+            raise ValueError(f"{path} is not a report log (bad magic)")
+        self._index_file = None
+        self._index_map = None
+        self.index = self._load_index()
+
+    def _identity(self, covered):
+        """What an index header has to match to belong to the first covered bytes of this log"""
+        st = os.fstat(self.file.fileno())
+        window = self.IDENTITY_WINDOW
+        crc = zlib.crc32(self.map[:min(covered, window)])
+        crc = zlib.crc32(self.map[max(covered - window, 0):covered], crc)
+        return REPORT_INDEX_MAGIC, st.st_dev, st.st_ino, covered, crc
+
+    def _read_index(self, index_path):
+        """Entries and indexed log size of a matching index file, ([], None) if there is none"""
+        entries = array.array("Q")
+        try:
+            with open(index_path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return entries, None
+        header = self.INDEX_HEADER
+        if len(data) < header.size:
+            return entries, None
+        fields = header.unpack_from(data)
+        covered = fields[3]
+        # Another log at this path, or this one rewritten: start over
+        if covered > len(self.map) or fields != self._identity(covered):
+            return entries, None
+        entries.frombytes(data[header.size:header.size + (len(data) - header.size) // self.INDEX.size * self.INDEX.size])
+        # Entries written after the header was last updated (interrupted run)
+        while entries and entries[-2] >= covered:
+            del entries[-2:]
+        return entries, covered
+
+    def _load_index(self):
+        index_path = self.path + ".idx"
+        record = ReportRecorder.RECORD
+        entries, covered = self._read_index(index_path)
+        valid = covered is not None
+        # Continue after the last indexed record (the log is append-only)
+        if valid:
+            offset = covered
+            t = entries[-1] if entries else 0
+        else:
+            offset = len(REPORT_LOG_MAGIC)
+            t = 0
+        first_new = len(entries)
+        size = len(self.map)
+        while offset + record.size <= size:
+            delta_us, length = record.unpack_from(self.map, offset)
+            if offset + record.size + length > size:
+                break  # record still being written
+            t += delta_us * 1000
+            entries.append(offset)
+            entries.append(t)
+            offset += record.size + length
+        header = self.INDEX_HEADER
+        if not valid or len(entries) > first_new:
+            try:
+                with open(index_path, "r+b" if valid else "wb") as f:
+                    # Entries first, the header only once they are complete
+                    f.seek(header.size + first_new * 8)
+                    f.write(entries[first_new:].tobytes())
+                    f.truncate()
+                    f.seek(0)
+                    f.write(header.pack(*self._identity(offset)))
+            except OSError as e:
+                # Read-only directory or someone else's index: keep it in memory
+                print(f"⚠️ Cannot write {index_path} ({e}), indexing in memory")
+                return entries
+        if not entries:
+            return entries
+        self._index_file = open(index_path, "rb")
+        self._index_map = mmap.mmap(self._index_file.fileno(), header.size + len(entries) * 8, access=mmap.ACCESS_READ)
+        with memoryview(self._index_map) as whole:
+            return whole[header.size:].cast("Q")
+
+    def __len__(self):
+        return len(self.index) // 2
+
+    def duration(self):
+        """Time covered by the log in seconds"""
+        return self.index[-1] / 1e9 if len(self.index) else 0.0
+
+    def message(self, i):
+        """Record i as (time since start in ns, memoryview of the message)"""
+        offset = self.index[2 * i]
+        length = self.map[offset + 4]
+        start = offset + ReportRecorder.RECORD.size
+        return self.index[2 * i + 1], self.view[start:start + length]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.message(i)
+
+    def replay(self, send, speed=1.0, start=0, stop=None, scheduler=None):
+        """
+        Push records [start, stop) through send(message). speed=1.0 keeps
+        the original timing (2.0 twice as fast...), speed=None sends back to
+        back. Pacing is against absolute deadlines by a ReportScheduler
+        (pass one to read its lateness stats afterwards), so send() time
+        doesn't accumulate into drift. Returns the number of reports sent.
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        index = self.index
+        view = self.view
+        header = ReportRecorder.RECORD.size
+        mapped = self.map
+        if speed is None:
+            for i in range(start, stop):
+                offset = index[2 * i] + header
+                send(view[offset:offset + mapped[offset - 1]])
+            return stop - start
+        if scheduler is None:
+            scheduler = ReportScheduler(send)
+        t0 = index[2 * start + 1] if stop > start else 0
+
+        def stream():
+            for i in range(start, stop):
+                offset = index[2 * i] + header
+                yield int((index[2 * i + 1] - t0) / speed), view[offset:offset + mapped[offset - 1]]
+
+        scheduler.run(stream())
+        return stop - start
+
+    def close(self):
+        if isinstance(self.index, memoryview):
+            self.index.release()
+        self.view.release()
+        self.map.close()
+        self.file.close()
+        if self._index_map is not None:
+            self._index_map.close()
+            self._index_file.close()
+
+
+REPORT_RING_MAGIC = b"BTRG"
+
+
+def _untracked_shared_memory(name, create=False, size=0):
+    # The owner unlinks the segment itself (ReportRing.close). Left to the
+    # resource tracker, a producer would unlink it when it exits, since
+    # before Python 3.13 attaching registers the segment as well.
+    try:
+        return shared_memory.SharedMemory(name, create, size, track=False)  # Python 3.13+
+    except TypeError:
+        shm = shared_memory.SharedMemory(name, create, size)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+class ReportRing(object):
+    """
+    Encoded reports in fixed-size slots of a multiprocessing.shared_memory
+    segment, so producer processes (trajectory math, replay parsing,
+    scripted automation) can feed one HID link from other cores, without
+    fighting the sender for the GIL or pickling every report through a
+    multiprocessing.Queue.
+
+    Every producer owns a lane: a single-producer/single-consumer ring
+    whose tail is only written by that producer and whose head only by
+    the consumer. That keeps it lock-free without atomic read-modify-write
+    (which Python doesn't have, so producers can't share one tail): a
+    report is copied into its slot before the tail is published, and a
+    slot is only reused once the head has moved past it. Head and tail
+    are 64-bit counters on cache lines of their own.
+
+    Usage:
+        ring = ReportRing("bthid", lanes=4)            # sender process
+        RingSender(ring, service.send).start()
+        ReportRing.attach("bthid").producer(0).put(report)  # producer 0
+    """
+    HEADER = struct.Struct("<4sIII")  # magic, lanes, slots per lane, slot size
+    LINE = 64
+
+    def __init__(self, name=None, lanes=4, slots=1024, slot_size=16, create=True):
+        if create:
+            if slots < 1 or slots & (slots - 1):
+                raise ValueError("slots must be a power of two")
+            if not 1 < slot_size <= 256:
+                raise ValueError("slot_size must be 2..256 (one length byte + the report)")
+            size = self.LINE * (1 + 2 * lanes) + lanes * slots * slot_size
+            self.shm = _untracked_shared_memory(name, True, size)
+            self.HEADER.pack_into(self.shm.buf, 0, REPORT_RING_MAGIC, lanes, slots, slot_size)
+        else:
+            self.shm = _untracked_shared_memory(name)
+            magic, lanes, slots, slot_size = self.HEADER.unpack_from(self.shm.buf, 0)
+            if magic != REPORT_RING_MAGIC:
+                raise Exception(f"Shared memory {name} is not a report ring")
+        self.owner = create
+        self.name = self.shm.name
+        self.lanes = lanes
+        self.slots = slots
+        self.slot_size = slot_size
+        self.buf = self.shm.buf
+        # Head of lane i in word 8 + 16 * i, its tail one cache line further
+        self.index = self.buf[:self.LINE * (1 + 2 * lanes)].cast("Q")
+        self.data = self.LINE * (1 + 2 * lanes)
+
+    @classmethod
+    def attach(cls, name):
+        """Open a ring created by another process"""
+        return cls(name, create=False)
+
+    def _lane(self, lane):
+        if not 0 <= lane < self.lanes:
+            raise ValueError(f"Lane must be 0..{self.lanes - 1}")
+        words = self.LINE // 8
+        return words + 2 * words * lane, self.data + lane * self.slots * self.slot_size
+
+    def producer(self, lane):
+        """Writer for one lane, at most one per lane at a time"""
+        return RingProducer(self, lane)
+
+    def pending(self):
+        index = self.index
+        words = self.LINE // 8
+        return sum(index[words * (2 * lane + 2)] - index[words * (2 * lane + 1)] for lane in range(self.lanes))
+
+    def drain(self, send, batch=64):
+        """
+        Pass up to batch reports of every lane to send(report), in order
+        within a lane. Reports are memoryviews into the ring that are only
+        valid during the call, send must copy what it keeps. If send
+        raises, that report stays queued. Returns the number sent.
+        """
+        index = self.index
+        buf = self.buf
+        mask = self.slots - 1
+        slot_size = self.slot_size
+        tail_offset = self.LINE // 8
+        total = 0
+        for lane in range(self.lanes):
+            head_word, base = self._lane(lane)
+            head = index[head_word]
+            end = min(index[head_word + tail_offset], head + batch)
+            seq = head
+            try:
+                while seq < end:
+                    offset = base + (seq & mask) * slot_size + 1
+                    send(buf[offset:offset + buf[offset - 1]])
+                    seq += 1
+            finally:
+                if seq != head:
+                    index[head_word] = seq
+                    total += seq - head
+        return total
+
+    def close(self):
+        """Detach; the creating process also removes the segment"""
+        self.index.release()
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            # Not SharedMemory.unlink(), that unregisters from the resource
+            # tracker the segment was kept out of
+            shared_memory._posixshmem.shm_unlink(self.shm._name)
+
+
+class RingProducer(object):
+    """One lane of a ReportRing, see ReportRing.producer()"""
+    IDLE = 0.0005
+
+    def __init__(self, ring, lane):
+        self.ring = ring
+        self.head_word, self.base = ring._lane(lane)
+        self.tail_word = self.head_word + ring.LINE // 8
+        self.index = ring.index
+        self.buf = ring.buf
+        self.slots = ring.slots
+        self.slot_size = ring.slot_size
+        self.mask = ring.slots - 1
+        self.tail = self.index[self.tail_word]  # resume where a previous producer stopped
+
+    def put(self, report, timeout=0):
+        """
+        Copy a report into the lane. Returns False if it is still full
+        after timeout seconds (0 doesn't wait, None waits for good).
+        """
+        tail = self.tail
+        if tail - self.index[self.head_word] >= self.slots:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while tail - self.index[self.head_word] >= self.slots:
+                if deadline is not None and time.monotonic() >= deadline:
+                    return False
+                time.sleep(self.IDLE)
+        size = len(report)
+        if size >= self.slot_size:
+            raise ValueError(f"Report of {size} bytes doesn't fit a {self.slot_size} byte slot")
+        offset = self.base + (tail & self.mask) * self.slot_size
+        buf = self.buf
+        buf[offset] = size
+        buf[offset + 1:offset + 1 + size] = report
+        self.tail = tail + 1
+        self.index[self.tail_word] = tail + 1
+        return True
+
+    def put_many(self, reports):
+        """
+        Copy as many reports as there are free slots and publish them at
+        once, returns how many were taken (the rest is up to the caller).
+        """
+        tail = self.tail
+        free = self.slots - (tail - self.index[self.head_word])
+        buf = self.buf
+        base = self.base
+        mask = self.mask
+        slot_size = self.slot_size
+        count = 0
+        for report in reports:
+            if count == free:
+                break
+            size = len(report)
+            if size >= slot_size:
+                raise ValueError(f"Report of {size} bytes doesn't fit a {slot_size} byte slot")
+            offset = base + ((tail + count) & mask) * slot_size
+            buf[offset] = size
+            buf[offset + 1:offset + 1 + size] = report
+            count += 1
+        self.tail = tail + count
+        self.index[self.tail_word] = tail + count
+        return count
+
+
+class RingSender(object):
+    """
+    Drains a ReportRing into send (BluetoothHIDService.send or
+    ReconnectSupervisor.send) from a single thread, batch reports per lane
+    at a time, napping idle seconds whenever every lane is empty.
+    """
+    def __init__(self, ring, send, batch=64, idle=0.0005):
+        self.ring = ring
+        self.send = send
+        self.batch = batch
+        self.idle = idle
+        self.running = False
+        self.sent = 0
+        self._thread = None
+
+    def serve_forever(self):
+        self.running = True
+        drain = self.ring.drain
+        send = self.send
+        batch = self.batch
+        idle = self.idle
+        while self.running:
+            count = drain(send, batch)
+            if count:
+                self.sent += count
+            else:
+                time.sleep(idle)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="report-ring", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+# Bluetooth HID transaction types, upper nibble of a control-channel message
+HIDP_HANDSHAKE = 0x0
+HIDP_HID_CONTROL = 0x1
+HIDP_GET_REPORT = 0x4
+HIDP_SET_REPORT = 0x5
+HIDP_GET_PROTOCOL = 0x6
+HIDP_SET_PROTOCOL = 0x7
+HIDP_GET_IDLE = 0x8
+HIDP_SET_IDLE = 0x9
+HIDP_DATA = 0xA
+
+# HANDSHAKE result codes
+HIDP_SUCCESSFUL = 0x0
+HIDP_ERR_INVALID_REPORT_ID = 0x2
+HIDP_ERR_UNSUPPORTED_REQUEST = 0x3
+HIDP_ERR_INVALID_PARAMETER = 0x4
+
+# HID_CONTROL operations
+HIDP_CTRL_HARD_RESET = 0x1
+HIDP_CTRL_SOFT_RESET = 0x2
+HIDP_CTRL_SUSPEND = 0x3
+HIDP_CTRL_EXIT_SUSPEND = 0x4
+HIDP_CTRL_VIRTUAL_CABLE_UNPLUG = 0x5
+
+# Report type in the low bits of GET_REPORT / SET_REPORT / DATA
+HIDP_REPORT_KINDS = {1: HID_INPUT, 2: HID_OUTPUT, 3: HID_FEATURE}
+
+HID_PROTOCOL_BOOT = 0
+HID_PROTOCOL_REPORT = 1
+
+# Boot protocol reports as the Bluetooth HID profile defines them, report ID included
+_BOOT_REPORTS = {
+    1: struct.Struct("<BBBxBBBBBB"),  # keyboard: modifiers, reserved, 6 keys
+    2: struct.Struct("<BBBbb"),       # mouse: 3 buttons, X, Y
+}
+
+
+def boot_report_converters(descriptor):
+    """
+    {report ID: converter} for the input reports that have a boot protocol
+    equivalent, converter being None when the report already is in boot
+    format. Reports without an entry aren't sent in boot protocol. A mouse
+    move beyond the -127..127 of a boot report (16-bit extended deltas) is
+    converted to a tuple of boot reports carrying all of it.
+    """
+    converters = {}
+    for report_id, boot in _BOOT_REPORTS.items():
+        layout = descriptor.reports.get((HID_INPUT, report_id))
+        if layout is None:
+            continue
+        if layout.message_struct is not None and layout.message_struct.format == boot.format:
+            converters[report_id] = None
+        elif report_id == 1:
+            def convert(report, layout=layout, pack=boot.pack):
+                values = layout.unpack(report[2:])
+                keys = (tuple(values.get("keys", ())) + (0,) * 6)[:6]
+                return pack(0xA1, 1, values.get("modifiers", 0) & 0xFF, *keys)
+            converters[report_id] = convert
+        else:
+            def convert(report, layout=layout, pack=boot.pack):
+                values = layout.unpack(report[2:])
+                buttons = values.get("buttons", 0) & 0x07
+                x = values.get("x", 0)
+                y = values.get("y", 0)
+                if -127 <= x <= 127 and -127 <= y <= 127:
+                    return pack(0xA1, 2, buttons, x, y)
+                # Split instead of clamping, the rest of the motion would be lost
+                reports = []
+                while x or y:
+                    dx = max(-127, min(127, x))
+                    dy = max(-127, min(127, y))
+                    reports.append(pack(0xA1, 2, buttons, dx, dy))
+                    x -= dx
+                    y -= dy
+                return tuple(reports)
+            converters[report_id] = convert
+    return converters
+
+
+class HIDControlHandler(object):
+    """
+    Answers the host on the HID control channel: GET/SET_REPORT,
+    GET/SET_PROTOCOL, GET/SET_IDLE and HID_CONTROL, and takes the output
+    reports (keyboard LEDs) a host writes on either channel.
+
+    A selectors (epoll) loop on its own thread watches both channels of the
+    service, so a request is answered as soon as it arrives, whatever the
+    sender is doing, and the interrupt-channel send path never touches the
+    control channel. handle_control() is the protocol itself, one message
+    in, the reply (or None) out.
+
+    The same loop notices the host going away (POLLHUP/POLLERR make a
+    channel readable, recv then returns 0 or fails) and tells the service
+    right away through BluetoothHIDService.lose_link().
+    """
+    REPLY_TIMEOUT = 0.05  # s, a host not reading its control channel can't stall the loop
+
+    def __init__(self, service, descriptor=HID_DESCRIPTOR):
+        self.service = service
+        self.descriptor = descriptor
+        self.idle_rate = 0
+        self.selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self.selector.register(self._wake_r, selectors.EVENT_READ, None)
+        self._buf = bytearray(1024)  # above any L2CAP MTU a host uses for HID
+        self._channels = {}
+        self._pending = None
+        self.running = False
+        self.thread = None
+
+    def attach(self, control, interrupt):
+        """Watch a freshly connected pair of channels, replacing the previous ones"""
+        self._pending = (control, interrupt)
+        if self.thread is None:
+            self.running = True
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        else:
+            self._wake_w.send(b"\0")
+
+    def stop(self):
+        if self.thread is not None:
+            self.running = False
+            self._wake_w.send(b"\0")
+            self.thread.join()
+            self.thread = None
+        self.selector.close()
+        self._wake_r.close()
+        self._wake_w.close()
+
+    def _switch_channels(self):
+        control, interrupt = self._pending
+        self._pending = None
+        for sock in list(self._channels):
+            self._unwatch(sock)
+        if control is not None:
+            try:
+                control.settimeout(self.REPLY_TIMEOUT)
+                self._watch(control, "control")
+            except OSError:
+                pass  # already closed again by a newer connection
+        if interrupt is not None:
+            self._watch(interrupt, "interrupt")
+
+    def _watch(self, sock, name):
+        try:
+            self.selector.register(sock, selectors.EVENT_READ, name)
+            self._channels[sock] = name
+        except (ValueError, OSError):
+            pass  # already closed again
+
+    def _unwatch(self, sock):
+        self._channels.pop(sock, None)
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError, OSError):
+            pass
+
+    def _run(self):
+        metrics = self.service.metrics
+        while self.running:
+            if self._pending is not None:
+                self._switch_channels()
+            for key, _ in self.selector.select():
+                if key.data is None:
+                    try:
+                        self._wake_r.recv(64)
+                    except BlockingIOError:
+                        pass
+                    continue
+                sock = key.fileobj
+                try:
+                    n = sock.recv_into(self._buf)
+                    reason = "closed by host"
+                except (BlockingIOError, InterruptedError, socket.timeout):
+                    continue
+                except OSError as e:
+                    n = 0
+                    reason = e
+                if n == 0:
+                    self._unwatch(sock)
+                    self.service.lose_link(f"{key.data} channel {reason}", sock)
+                    continue
+                start = time.perf_counter_ns()
+                message = bytes(self._buf[:n])
+                if key.data == "control":
+                    reply = self.handle_control(message)
+                    if reply is not None:
+                        try:
+                            sock.send(reply)
+                        except OSError as e:
+                            print(f"\n⚠️  Control reply failed: {e}")
+                    metrics.control_latency.record(time.perf_counter_ns() - start)
+                    metrics.counters["control_requests"] += 1
+                elif message[0] == (HIDP_DATA << 4 | 2):
+                    self._set_output(message[1], message[2:])
+
+    @staticmethod
+    def _handshake(code):
+        return bytes([HIDP_HANDSHAKE << 4 | code])
+
+    def handle_control(self, message):
+        """Process one control-channel message, returns the reply to send or None"""
+        kind = message[0] >> 4
+        param = message[0] & 0x0F
+        payload = message[1:]
+        service = self.service
+        if kind == HIDP_GET_REPORT:
+            return self._get_report(param, payload)
+        if kind == HIDP_SET_REPORT:
+            return self._set_report(param, payload)
+        if kind == HIDP_GET_PROTOCOL:
+            return bytes([HIDP_DATA << 4, service.protocol])
+        if kind == HIDP_SET_PROTOCOL:
+            service.set_protocol(param & 0x1)
+            return self._handshake(HIDP_SUCCESSFUL)
+        if kind == HIDP_GET_IDLE:
+            return bytes([HIDP_DATA << 4, self.idle_rate])
+        if kind == HIDP_SET_IDLE:
+            if not payload:
+                return self._handshake(HIDP_ERR_INVALID_PARAMETER)
+            self.idle_rate = payload[0]
+            return self._handshake(HIDP_SUCCESSFUL)
+        if kind == HIDP_HID_CONTROL:
+            # Never answered, not even with a handshake
+            self._hid_control(param)
+            return None
+        if kind == HIDP_DATA:
+            # Output report over the control channel (HID 1.0 hosts)
+            if param == 2 and payload:
+                self._set_output(payload[0], payload[1:])
+            return None
+        return self._handshake(HIDP_ERR_UNSUPPORTED_REQUEST)
+
+    def _get_report(self, param, payload):
+        kind = HIDP_REPORT_KINDS.get(param & 0x3)
+        if kind is None or not payload:
+            return self._handshake(HIDP_ERR_INVALID_PARAMETER)
+        report_id = payload[0]
+        layout = self.descriptor.reports.get((kind, report_id))
+        service = self.service
+        if layout is None or (kind == HID_INPUT and service.boot_protocol
+                              and report_id not in service.boot_converters):
+            return self._handshake(HIDP_ERR_INVALID_REPORT_ID)
+        if kind == HID_INPUT:
+            last = service.last_input.get(report_id)
+            if last is not None:
+                data = last[2:]
+            elif service.boot_protocol:
+                data = bytes(_BOOT_REPORTS[report_id].size - 2)
+            else:
+                data = bytes(layout.size)
+        else:
+            data = service.output_reports.get((kind, report_id)) or bytes(layout.size)
+        reply = bytes([HIDP_DATA << 4 | (param & 0x3), report_id]) + data
+        if param & 0x8 and len(payload) >= 3:
+            # Host gave its buffer size, the report ID counts against it
+            reply = reply[:1 + int.from_bytes(payload[1:3], "little")]
+        return reply
+
+    def _set_report(self, param, payload):
+        kind = HIDP_REPORT_KINDS.get(param & 0x3)
+        if kind is None or not payload:
+            return self._handshake(HIDP_ERR_INVALID_PARAMETER)
+        layout = self.descriptor.reports.get((kind, payload[0]))
+        if layout is None:
+            return self._handshake(HIDP_ERR_INVALID_REPORT_ID)
+        if kind != HID_OUTPUT:
+            return self._handshake(HIDP_ERR_UNSUPPORTED_REQUEST)
+        if len(payload) - 1 < layout.size:
+            return self._handshake(HIDP_ERR_INVALID_PARAMETER)
+        self._set_output(payload[0], payload[1:])
+        return self._handshake(HIDP_SUCCESSFUL)
+
+    def _set_output(self, report_id, data):
+        layout = self.descriptor.reports.get((HID_OUTPUT, report_id))
+        if layout is None or len(data) < layout.size:
+            return
+        data = bytes(data[:layout.size])
+        service = self.service
+        service.output_reports[(HID_OUTPUT, report_id)] = data
+        if service.on_output_report is not None:
+            service.on_output_report(report_id, layout.unpack(data))
+
+    def _hid_control(self, operation):
+        service = self.service
+        if operation == HIDP_CTRL_SUSPEND:
+            service.suspended = True
+        elif operation == HIDP_CTRL_EXIT_SUSPEND:
+            service.suspended = False
+        elif operation in (HIDP_CTRL_HARD_RESET, HIDP_CTRL_SOFT_RESET):
+            service.set_protocol(HID_PROTOCOL_REPORT)
+            service.output_reports.clear()
+            self.idle_rate = 0
+        elif operation == HIDP_CTRL_VIRTUAL_CABLE_UNPLUG:
+            # The host dropped the pairing: the link is gone and there is nothing
+            # to reconnect to until it pairs and connects in again
+            print(f"\n⚠️  Host {service.remote_mac} unplugged the virtual cable")
+            service.remote_mac = None
+            service.lose_link("virtual cable unplugged")
+            service.transport.close()
+
+
+class BluetoothHIDService(object):
+    PROFILE_PATH = "/org/bluez/bthid_profile_mouse"
+    DESCRIPTOR = HID_DESCRIPTOR
+
+    HOST = 0
+    PORT = 1
+
+    def __init__(self, service_record, MAC, remote_mac=None, transport=None, register_profile=True,
+                 bluez=None, timer=None, descriptor=None, watch_link=True):
+        self.P_CTRL = L2CAPTransport.P_CTRL
+        self.P_INTR = L2CAPTransport.P_INTR
+        self.SELFMAC = MAC
+        self.service_record = service_record
+        self.remote_mac = remote_mac
+        self.transport = transport if transport is not None else L2CAPTransport(MAC)
+        # register_profile=False when someone else (e.g. MultiHostHIDService) owns the profile
+        self.register_profile = register_profile and self.transport.uses_bluez
+        # Share the caller's BlueZContext (bus, proxies, discovery snapshot) if it has one
+        if bluez is None and self.register_profile:
+            bluez = BlueZContext()
+        self.bluez = bluez
+        self.bus = bluez.bus if bluez is not None else None
+        self.timer = timer if timer is not None else StartupTimer()
+        self.manager = None
+        self.ccontrol = None
+        self.cinter = None
+        self.connected = False
+        self.metrics = HIDMetrics()
+        self.recorder = None  # ReportRecorder capturing every report sent
+        # Host-controlled state, kept up to date by the control handler
+        self.protocol = HID_PROTOCOL_REPORT
+        self.boot_protocol = False
+        # Parsed form of the descriptor in service_record
+        self.descriptor = descriptor if descriptor is not None else self.DESCRIPTOR
+        self.boot_converters = boot_report_converters(self.descriptor)
+        self.suspended = False
+        self.last_input = {}       # report ID -> bytearray, last input report sent (GET_REPORT)
+        self.output_reports = {}   # (kind, report ID) -> data the host set
+        self.on_output_report = None  # callable(report_id, values), e.g. to follow keyboard LEDs
+        self.control_handler = HIDControlHandler(self, self.descriptor)
+        # Set when the link dropped before a send noticed (lose_link), until the next connection
+        self.link_lost = None
+        self.on_link_down = None  # callable(reason), ReconnectSupervisor hooks link_down() in here
+        self._link_lock = threading.Lock()  # channel switches against lose_link() from other threads
+        self._link_watch = None
+        if watch_link and self.bluez is not None:
+            self._watch_device()
+        
+        # Initial connection
+        self._connect()
+
+    def _watch_device(self):
+        # Device1.Connected going false is BlueZ's word that the host is gone,
+        # often before a send would fail. Dispatched by the bluez main loop thread.
+        self.bluez.start_loop()
+        self._link_watch = self.bus.add_signal_receiver(
+            self._device_changed, signal_name="PropertiesChanged", bus_name="org.bluez",
+            dbus_interface="org.freedesktop.DBus.Properties", arg0="org.bluez.Device1",
+            path_keyword="path")
+
+    def _device_changed(self, interface, changed, invalidated, path=None):
+        if changed.get("Connected", True) or not self.remote_mac:
+            return
+        if ProfileConnector.device_mac(path).upper() == self.remote_mac.upper():
+            self.lose_link("BlueZ reports the device disconnected")
+
+    def lose_link(self, reason, channel=None):
+        """
+        The link went away without a send failing (channel hangup, BlueZ
+        signal): stop sending into it and hand over to on_link_down at
+        once. Until the next connection send() raises ConnectionResetError,
+        so callers take their usual reconnect path and no report is
+        written into a dead socket. A channel that is no longer the
+        current one (we replaced or closed it ourselves) is ignored.
+        """
+        with self._link_lock:
+            if not self.connected or (channel is not None and channel is not self.ccontrol
+                                      and channel is not self.cinter):
+                return
+            self.connected = False
+            self.link_lost = reason
+        self.metrics.counters["link_losses"] += 1
+        if self.on_link_down is not None:
+            self.on_link_down(reason)
+        else:
+            print(f"\n⚠️  Link to {self.remote_mac or 'host'} lost: {reason}")
+
+    def _attach(self):
+        """Pick up the freshly opened channels from the transport"""
+        with self._link_lock:
+            self.ccontrol = self.transport.control
+            self.cinter = self.transport.interrupt
+            self.link_lost = None
+            self.connected = True
+        # Every new connection starts in report protocol
+        self.set_protocol(HID_PROTOCOL_REPORT)
+        self.control_handler.attach(self.ccontrol, self.cinter)
+
+    def set_protocol(self, protocol):
+        """Switch to HID_PROTOCOL_BOOT or HID_PROTOCOL_REPORT, as asked by the host"""
+        if protocol == self.protocol:
+            return
+        self.protocol = protocol
+        self.boot_protocol = protocol == HID_PROTOCOL_BOOT
+        self.last_input.clear()
+        print(f"Host switched to {'boot' if self.boot_protocol else 'report'} protocol")
+
+    def _keep_input(self, report):
+        """Remember a sent input report for GET_REPORT, copied into one buffer per report ID"""
+        last = self.last_input.get(report[1])
+        if last is not None and len(last) == len(report):
+            last[:] = report
+        else:
+            # First report of this ID, or its size changed with the protocol
+            self.last_input[report[1]] = bytearray(report)
+
+    def boot_report(self, report):
+        """report in boot protocol format (a tuple of them for a large mouse move), None if it has no boot equivalent"""
+        if report[0] != 0xA1 or report[1] not in self.boot_converters:
+            return None
+        convert = self.boot_converters[report[1]]
+        return report if convert is None else convert(report)
+
+    def _register_profile(self):
+        # Drop our own earlier registration, if any (e.g. _connect() called again)
+        self.cleanup_profile()
+        self.manager = register_hid_profile(self.bluez, self.service_record, self.PROFILE_PATH)
+    
+    def _connect(self):
+        """Internal method to establish connection"""
+        if self.register_profile:
+            with self.timer.phase("register profile"):
+                self._register_profile()
+
+        # Transport handed over already connected
+        if self.transport.interrupt is not None:
+            self._attach()
+            return
+
+        # If remote_mac is provided, try to connect to existing device
+        if self.remote_mac:
+            print(f"Attempting to connect to existing device: {self.remote_mac}")
+            try:
+                with self.timer.phase("connect"):
+                    self.transport.connect(self.remote_mac)
+                self._attach()
+                return
+            except Exception as e:
+                print(f"Failed to connect to existing device: {e}")
+                print("Falling back to waiting for incoming connection...")
+        
+        # Fall back to waiting for incoming connection
+        with self.timer.phase("wait for host"):
+            self.remote_mac = self.transport.accept()  # Save remote MAC for reconnection
+        self._attach()
+    
+    def attach_channels(self, control, interrupt):
+        """Take over channels the host opened itself (see ProfileConnector), replacing the current ones"""
+        # Forget the old channels first, their hangup is ours and not a lost link
+        self._drop_channels()
+        self.transport.control = control
+        self.transport.interrupt = interrupt
+        self._attach()
+
+    def _drop_channels(self):
+        with self._link_lock:
+            self.connected = False
+            self.ccontrol = None
+            self.cinter = None
+        self.transport.close()
+
+    def try_reconnect(self):
+        """Single reconnection attempt to the known host, no retries or sleeps. Raises on failure"""
+        self._drop_channels()
+        if not self.remote_mac:
+            raise ConnectionError("No remote device known to reconnect to")
+        self.transport.connect(self.remote_mac)
+        self._attach()
+
+    def reconnect(self, max_attempts=5, delay=2):
+        """Attempt to reconnect after connection loss"""
+        if not self.remote_mac:
+            print("\n✗ Connection lost and no host left to reconnect to")
+            return False
+        print(f"\n⚠️  Connection lost! Attempting to reconnect to {self.remote_mac}...")
+        
+        started = time.monotonic()
+        for attempt in range(1, max_attempts + 1):
+            try:
+                print(f"Reconnection attempt {attempt}/{max_attempts}...")
+                self.try_reconnect()
+                self.metrics.record_reconnect(time.monotonic() - started)
+                print("✓ Reconnection successful!\n")
+                return True
+                    
+            except Exception as e:
+                print(f"✗ Attempt {attempt} failed: {e}")
+                if attempt < max_attempts:
+                    print(f"Waiting {delay} seconds before retry...")
+                    time.sleep(delay)
+        
+        print(f"✗ Failed to reconnect after {max_attempts} attempts")
+        return False
+
+    def send(self, bytes_buf, motion=False):
+        """
+        Write one report to the interrupt channel. motion is accepted for
+        the same call as MultiHostHIDService.send() and not used here.
+        """
+        if self.link_lost is not None:
+            raise ConnectionResetError(f"Link lost: {self.link_lost}")
+        if self.cinter and self.connected:
+            bytes_buf = self._outgoing(bytes_buf)
+            if bytes_buf is None:
+                return
+            if type(bytes_buf) is tuple:
+                # Split by the boot conversion, see boot_report_converters()
+                for report in bytes_buf:
+                    self._write(report)
+            else:
+                self._write(bytes_buf)
+
+    def _write(self, report):
+        start = time.perf_counter_ns()
+        try:
+            self.cinter.send(report)
+        except (ConnectionResetError, BrokenPipeError, OSError) as e:
+            self._send_failed(e)
+            raise  # Re-raise to let caller handle reconnection
+        self._sent(report, start)
+
+    # Shared by send() and AsyncBluetoothHIDService, around the actual write
+
+    def _outgoing(self, report):
+        """report as it goes on the wire in the current protocol (see boot_report()), None if it isn't sent in it"""
+        if self.boot_protocol:
+            return self.boot_report(report)
+        return report
+
+    def _sent(self, report, start):
+        """Bookkeeping of a report written to the interrupt channel, start is perf_counter_ns() before the write"""
+        self.metrics.record_send(time.perf_counter_ns() - start, len(report))
+        self._keep_input(report)
+        if self.recorder is not None:
+            self.recorder.record(report)
+
+    def _send_failed(self, error):
+        self.metrics.send_errors += 1
+        print(f"\n⚠️  Send failed: {error}")
+        self.connected = False
+            
+    def cleanup_profile(self):
+        """Unregister the profile if it exists"""
+        if self.bluez is None or not self.register_profile:
+            return
+        try:
+            # UnregisterProfile only returns once BlueZ dropped it, no need to wait
+            self.bluez.profile_manager().UnregisterProfile(self.PROFILE_PATH)
+            print(f"Cleaned up existing profile at {self.PROFILE_PATH}")
+        except dbus.exceptions.DBusException as e:
+            if "Does Not Exist" not in str(e):
+                print(f"Note: {e}")
+        except Exception as e:
+            pass
+
+    def cleanup(self):
+        """Close all channels and drop the profile registration"""
+        if self._link_watch is not None:
+            self._link_watch.remove()
+            self._link_watch = None
+        self.control_handler.stop()
+        self.transport.shutdown()
+        self.ccontrol = None
+        self.cinter = None
+        self.connected = False
+        self.cleanup_profile()
+
+class MouseReportEncoder(object):
+    """
+    Packs report ID 2 mouse reports into preallocated buffers with a
+    precompiled struct, so encoding a report allocates nothing.
+
+    The buffers are reused: the returned bytearray/memoryview is only valid
+    until the next encode call, send it before encoding the next report.
+
+    Works with the mouse of HID_DESCRIPTOR (8-bit X/Y) and of
+    HID_DESCRIPTOR_EXTENDED (16-bit X/Y, wheel and pan). limit is the
+    largest delta per axis one report carries.
+    """
+    REPORT_ID = 0x02
+    # 0xA1 (DATA | Input), report ID, buttons, X, Y
+    REPORT = HID_DESCRIPTOR.report(REPORT_ID).message_struct
+
+    def __init__(self, batch_size=256, descriptor=HID_DESCRIPTOR):
+        self.descriptor = descriptor
+        layout = descriptor.report(self.REPORT_ID)
+        fields = {f.name: f for f in layout.fields}
+        self.REPORT = layout.message_struct
+        self.limit = fields["x"].logical_max
+        self.has_wheel = "wheel" in fields
+        if self.has_wheel:
+            self.encode = self._encode_wheel
+        self.buf = bytearray(self.REPORT.size)
+        self._batch = bytearray()
+        self._batch_view = memoryview(self._batch)
+        self.report_views = []
+        self._reserve(batch_size)
+
+    def _reserve(self, count):
+        """Grow the batch buffer so it can hold count reports"""
+        size = self.REPORT.size
+        if len(self.report_views) >= count:
+            return
+        self._batch_view.release()
+        self._batch = bytearray(size * count)
+        self._batch_view = memoryview(self._batch)
+        self.report_views = [self._batch_view[i:i + size] for i in range(0, size * count, size)]
+
+    def encode(self, buttons, dx, dy, wheel=0, pan=0):
+        """
+        Encode a single report, deltas are clamped to -limit..limit and the
+        wheels to -127..127. wheel/pan are ignored by a report without them.
+        """
+        limit = self.limit
+        low = -limit
+        if dx > limit:
+            dx = limit
+        elif dx < low:
+            dx = low
+        if dy > limit:
+            dy = limit
+        elif dy < low:
+            dy = low
+        self.REPORT.pack_into(self.buf, 0, 0xA1, self.REPORT_ID, buttons, dx, dy)
+        return self.buf
+
+    def _encode_wheel(self, buttons, dx, dy, wheel=0, pan=0):
+        # encode() of the extended report, bound in __init__
+        limit = self.limit
+        dx = max(-limit, min(dx, limit))
+        dy = max(-limit, min(dy, limit))
+        wheel = max(-127, min(wheel, 127))
+        pan = max(-127, min(pan, 127))
+        self.REPORT.pack_into(self.buf, 0, 0xA1, self.REPORT_ID, buttons, dx, dy, wheel, pan)
+        return self.buf
+
+    def encode_batch(self, moves):
+        """
+        Encode a sequence of (dx, dy, buttons) tuples back to back in one call.
+        Returns the number of reports; report i is self.report_views[i].
+        """
+        count = len(moves)
+        self._reserve(count)
+        pack_into = self.REPORT.pack_into
+        buf = self._batch
+        size = self.REPORT.size
+        report_id = self.REPORT_ID
+        limit = self.limit
+        offset = 0
+        if self.has_wheel:
+            # Wheel and pan stay 0
+            for dx, dy, buttons in moves:
+                dx = max(-limit, min(dx, limit))
+                dy = max(-limit, min(dy, limit))
+                pack_into(buf, offset, 0xA1, report_id, buttons, dx, dy, 0, 0)
+                offset += size
+            return count
+        low = -limit
+        for dx, dy, buttons in moves:
+            if dx > limit:
+                dx = limit
+            elif dx < low:
+                dx = low
+            if dy > limit:
+                dy = limit
+            elif dy < low:
+                dy = low
+            pack_into(buf, offset, 0xA1, report_id, buttons, dx, dy)
+            offset += size
+        return count
+
+
+class AbsolutePointerEncoder(object):
+    """
+    Packs report ID 4 absolute pointer reports (buttons, X, Y in
+    0..max_x/max_y logical units spanning the whole screen) into a reused
+    buffer.
+    """
+    REPORT_ID = 0x04
+
+    def __init__(self, descriptor=None):
+        if descriptor is None:
+            descriptor = parse_report_descriptor(HID_REPORT_DESCRIPTOR_ABSOLUTE)
+        layout = descriptor.report(self.REPORT_ID)
+        fields = {f.name: f for f in layout.fields}
+        # 0xA1 (DATA | Input), report ID, buttons, X, Y
+        self.REPORT = layout.message_struct
+        self.max_x = fields["x"].logical_max
+        self.max_y = fields["y"].logical_max
+        self.buf = bytearray(self.REPORT.size)
+
+    def encode(self, buttons, x, y):
+        """Encode a report, coordinates are clamped to the logical range"""
+        x = max(0, min(x, self.max_x))
+        y = max(0, min(y, self.max_y))
+        self.REPORT.pack_into(self.buf, 0, 0xA1, self.REPORT_ID, buttons, x, y)
+        return self.buf
+
+
+class MotionAccumulator(object):
+    """
+    Sums incoming mouse deltas and hands them out in report-sized chunks.
+    Whatever doesn't fit in one report (-127..127 per axis, the logical
+    range of the report descriptor) stays in the accumulator for the next
+    one, so no cursor distance is lost. Safe to feed from several threads.
+    """
+    LIMIT = 127
+
+    def __init__(self, limit=LIMIT):
+        self.limit = limit  # MouseReportEncoder.limit of the report the chunks go into
+        self.dx = 0
+        self.dy = 0
+        self.lock = threading.Lock()
+
+    def add(self, dx, dy):
+        with self.lock:
+            self.dx += dx
+            self.dy += dy
+
+    def pending(self):
+        return self.dx != 0 or self.dy != 0
+
+    def take(self):
+        """Remove and return the next (dx, dy) chunk that fits in one report"""
+        limit = self.limit
+        with self.lock:
+            dx = self.dx
+            dy = self.dy
+            if dx > limit:
+                dx = limit
+            elif dx < -limit:
+                dx = -limit
+            if dy > limit:
+                dy = limit
+            elif dy < -limit:
+                dy = -limit
+            self.dx -= dx
+            self.dy -= dy
+        return dx, dy
+
+
+class MotionPoller(object):
+    """
+    Flushes a MotionAccumulator into the HID link at a fixed report rate,
+    the way a host polls a USB mouse. However bursty the producers are,
+    the interrupt channel never sees more than rate_hz reports per second
+    and nothing is sent while there is no motion.
+
+    Usage:
+        poller = MotionPoller(emulator, rate_hz=500)
+        poller.start()
+        poller.move(1000, -20)   # returns immediately
+    """
+    def __init__(self, emulator, rate_hz=125):
+        self.emulator = emulator
+        self.rate_hz = rate_hz
+        self.period = 1.0 / rate_hz
+        self.accumulator = MotionAccumulator(emulator.encoder.limit)
+        # Own encoder, the emulator's buffer may be in use on another thread
+        self.encoder = MouseReportEncoder(descriptor=emulator.encoder.descriptor)
+        self.reports_sent = 0
+        self.running = False
+        self._thread = None
+
+    def move(self, dx, dy):
+        """Queue a relative move, it goes out over the next poll(s)"""
+        self.accumulator.add(dx, dy)
+
+    def start(self):
+        if self._thread is None:
+            self.running = True
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self.running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def wait_idle(self, timeout=None):
+        """Block until all queued motion has been sent, returns False on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.accumulator.pending():
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(self.period)
+        return True
+
+    def poll(self):
+        """Send one report if there is pending motion, returns True if it did"""
+        if not self.accumulator.pending():
+            return False
+        dx, dy = self.accumulator.take()
+        if not self.emulator.send_with_reconnect(self.encoder.encode(self.emulator.buttons, dx, dy), True):
+            raise Exception("Failed to send mouse movement after reconnection attempts")
+        self.reports_sent += 1
+        return True
+
+    def _run(self):
+        period = self.period
+        deadline = time.monotonic()
+        while self.running:
+            self.poll()
+            deadline += period
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -period:
+                # Fell behind (e.g. during a reconnect), don't burst to catch up
+                deadline = time.monotonic()
+
+
+class ReportScheduler(object):
+    """
+    Sends timestamped report streams against absolute
+    time.monotonic_ns() deadlines, so the cost of encoding and sending
+    never shifts later reports: step i goes out at start + offset_i, not
+    at "previous send + interval".
+
+    Waiting is hybrid: sleep() until spin_ns before the deadline (the OS
+    wakes up late by tens of microseconds or more), then spin on the
+    clock for the rest. spin_ns=0 only sleeps and saves the CPU.
+
+    Lateness of every report (send start - deadline) is kept for the last
+    max_samples reports, stats() has its percentiles, and it goes into
+    the schedule_lateness histogram of metrics if given.
+
+    Usage:
+        scheduler = ReportScheduler(service.send)
+        scheduler.run((i * 1_000_000, report) for i, report in enumerate(reports))  # 1 kHz
+        print(scheduler.stats())
+    """
+    SPIN_NS = 1_000_000
+
+    def __init__(self, send, metrics=None, spin_ns=SPIN_NS, max_samples=100000):
+        self.send = send
+        self.metrics = metrics
+        self.spin_ns = spin_ns
+        self.lateness = collections.deque(maxlen=max_samples)
+
+    def wait_until(self, deadline_ns):
+        """Wait for deadline_ns (time.monotonic_ns() clock), returns how late it woke up in ns"""
+        remaining = deadline_ns - time.monotonic_ns() - self.spin_ns
+        if remaining > 0:
+            time.sleep(remaining / 1e9)
+        now = time.monotonic_ns()
+        while now < deadline_ns:
+            # sleep(0) hands the GIL over, a tight loop would keep the other
+            # threads (control channel, reconnects, D-Bus) out until the deadline
+            time.sleep(0)
+            now = time.monotonic_ns()
+        return now - deadline_ns
+
+    def record(self, lateness_ns):
+        """Keep one report's lateness and feed it into the metrics"""
+        self.lateness.append(lateness_ns)
+        if self.metrics is not None:
+            self.metrics.schedule_lateness.record(lateness_ns)
+
+    def run(self, stream, start_ns=None, send=None):
+        """
+        Send every (offset_ns, report) of stream at start_ns + offset_ns,
+        start_ns defaults to now. send overrides self.send for this stream
+        (e.g. to pace move_mouse() steps). Returns the deadline of offset 0
+        used, so a follow-up stream can continue on the same time line.
+        """
+        if start_ns is None:
+            start_ns = time.monotonic_ns()
+        if send is None:
+            send = self.send
+        wait_until = self.wait_until
+        record = self.record
+        for offset, report in stream:
+            late = wait_until(start_ns + offset)
+            if send(report) is False:
+                raise Exception("Failed to send report after reconnection attempts")
+            record(late)
+        return start_ns
+
+    def stats(self):
+        """Lateness percentiles in microseconds over the kept samples"""
+        samples = sorted(self.lateness)
+        if not samples:
+            return {"reports": 0}
+        count = len(samples)
+
+        def percentile(q):
+            return samples[min(count - 1, int(q * count))] / 1000
+
+        mean = sum(samples) / count
+        return {
+            "reports": count,
+            "lateness_us": {
+                "mean": mean / 1000,
+                "p50": percentile(0.5),
+                "p90": percentile(0.9),
+                "p99": percentile(0.99),
+                "p999": percentile(0.999),
+                "max": samples[-1] / 1000,
+                # Standard deviation, i.e. how much the intervals wobble
+                "jitter": math.sqrt(sum((s - mean) ** 2 for s in samples) / count) / 1000,
+            },
+        }
+
+
+class ReconnectSupervisor(object):
+    """
+    Keeps a BluetoothHIDService connected from its own thread.
+
+    Producers call send() instead of service.send(). While the link is up
+    the report goes straight out; when a send fails the link is marked down,
+    the supervisor thread starts reconnecting with jittered exponential
+    backoff and send() keeps returning immediately, buffering reports as
+    decided by the outage policy:
+        KEEP_BUTTONS  keep only the latest button-state report per report ID,
+                      motion is discarded (stale motion is worse than none)
+        KEEP_ALL      keep everything, up to buffer_size reports
+        DROP_ALL      keep nothing
+    The buffer is flushed in order as soon as the link is back up.
+    The service also reports losses it notices before any send fails
+    (BluetoothHIDService.lose_link), so reconnecting starts right then.
+
+    State machine:  CONNECTED -> DOWN -> RECONNECTING -> CONNECTED
+                                     ^-------------'  (attempt failed)
+                    FAILED after max_attempts or with no host left to
+                    reconnect to (virtual cable unplug), CLOSED after stop()
+                    A host connecting in (hand_over) leaves FAILED again.
+    """
+    CONNECTED = "connected"
+    DOWN = "down"
+    RECONNECTING = "reconnecting"
+    FAILED = "failed"
+    CLOSED = "closed"
+
+    KEEP_BUTTONS = "keep-buttons"
+    KEEP_ALL = "keep-all"
+    DROP_ALL = "drop-all"
+
+    def __init__(self, service, outage_policy=KEEP_BUTTONS, initial_delay=0.1, max_delay=10.0,
+                 multiplier=2.0, jitter=0.5, max_attempts=None, buffer_size=1024):
+        if outage_policy not in (self.KEEP_BUTTONS, self.KEEP_ALL, self.DROP_ALL):
+            raise ValueError(f"Unknown outage policy {outage_policy!r}")
+        self.service = service
+        self.outage_policy = outage_policy
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.max_attempts = max_attempts
+        self.state = self.CONNECTED if service.connected else self.DOWN
+        self.buffer = collections.deque(maxlen=buffer_size)
+        self.button_reports = {}  # report ID -> latest button-state report while down
+        self._handover = None  # (control, interrupt) the host opened by itself
+
+        # Metrics
+        self.reconnects = 0
+        self.failed_attempts = 0
+        self.reports_dropped = 0
+        self.reconnect_durations = collections.deque(maxlen=100)
+        self.down_since = None
+
+        self.lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        service.metrics.add_gauge("outage_buffer_depth", lambda: len(self.buffer) + len(self.button_reports))
+        service.on_link_down = self._link_lost
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+            if self.state == self.DOWN:
+                self._wakeup.set()
+
+    def stop(self):
+        with self.lock:
+            self.state = self.CLOSED
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def is_up(self):
+        return self.state == self.CONNECTED
+
+    def link_down(self, reason=None):
+        """Mark the link as lost and wake up the reconnect thread, returns immediately"""
+        with self.lock:
+            self._mark_down(reason)
+
+    def _link_lost(self, reason):
+        # From the service (channel hangup, BlueZ signal) on another thread,
+        # maybe only after a failed send got us reconnected: then it's stale
+        with self.lock:
+            if not self.service.connected:
+                self._mark_down(reason)
+
+    def _mark_down(self, reason):
+        # Called with self.lock held
+        if self.state != self.CONNECTED:
+            return
+        self.state = self.DOWN
+        self.down_since = time.monotonic()
+        self.service.connected = False
+        print(f"\n⚠️  Link down{': ' + str(reason) if reason else ''}, reconnecting in background")
+        self._wakeup.set()
+
+    def hand_over(self, control, interrupt):
+        """
+        The host came back by itself with new channels (ProfileConnector):
+        reconnect on those instead of connecting out. Returns immediately.
+        """
+        with self.lock:
+            if self.state == self.CLOSED:
+                control.close()
+                interrupt.close()
+                return
+            if self._handover is not None:
+                for sock in self._handover:
+                    sock.close()
+            self._handover = (control, interrupt)
+            if self.state == self.CONNECTED:
+                self._mark_down("host reconnected")
+            elif self.state == self.FAILED:
+                self.state = self.DOWN
+        self._wakeup.set()
+
+    def _buffer(self, data, motion):
+        # Called with self.lock held
+        if self.outage_policy == self.KEEP_ALL:
+            if len(self.buffer) == self.buffer.maxlen:
+                self.reports_dropped += 1
+            self.buffer.append(bytes(data))
+        elif self.outage_policy == self.KEEP_BUTTONS and not motion:
+            self.button_reports[data[1]] = bytes(data)
+        else:
+            self.reports_dropped += 1
+
+    def send(self, data, motion=False):
+        """
+        Send a report or buffer it while the link is down. Never blocks on
+        reconnection; returns False only once the supervisor has given up.
+        """
+        with self.lock:
+            if self.state == self.CONNECTED:
+                try:
+                    self.service.send(data)
+                    return True
+                except (ConnectionResetError, BrokenPipeError, OSError) as e:
+                    self._mark_down(e)
+            if self.state in (self.FAILED, self.CLOSED):
+                return False
+            self._buffer(data, motion)
+            return True
+
+    def _flush(self):
+        # Called with self.lock held, right after reconnecting
+        pending = list(self.button_reports.values()) + list(self.buffer)
+        self.button_reports.clear()
+        self.buffer.clear()
+        for report in pending:
+            self.service.send(report)
+
+    def _backoff(self, attempt):
+        delay = min(self.max_delay, self.initial_delay * self.multiplier ** attempt)
+        return delay * random.uniform(1.0 - self.jitter, 1.0)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            with self.lock:
+                if self.state == self.CLOSED:
+                    return
+                if self.state != self.DOWN:
+                    continue
+                self.state = self.RECONNECTING
+
+            attempt = 0
+            while True:
+                try:
+                    with self.lock:
+                        handover = self._handover
+                        self._handover = None
+                    if handover is not None:
+                        self.service.attach_channels(*handover)
+                    elif not self.service.remote_mac:
+                        print("✗ No host left to reconnect to, waiting for one to connect in")
+                        with self.lock:
+                            if self.state != self.CLOSED:
+                                self.state = self.FAILED
+                        break
+                    else:
+                        self.service.try_reconnect()
+                except Exception as e:
+                    self.failed_attempts += 1
+                    attempt += 1
+                    if self.max_attempts is not None and attempt >= self.max_attempts:
+                        print(f"✗ Failed to reconnect after {attempt} attempts: {e}")
+                        with self.lock:
+                            if self.state != self.CLOSED:
+                                self.state = self.FAILED
+                        break
+                    # wait() instead of sleep() so stop() interrupts the backoff
+                    self._wakeup.wait(self._backoff(attempt - 1))
+                    self._wakeup.clear()
+                    if self.state == self.CLOSED:
+                        return
+                    continue
+
+                with self.lock:
+                    if self.state == self.CLOSED:
+                        return
+                    if self._handover is not None:
+                        # The host connected in while we were connecting out, use its channels
+                        self.service.attach_channels(*self._handover)
+                        self._handover = None
+                    try:
+                        self._flush()
+                    except (ConnectionResetError, BrokenPipeError, OSError):
+                        # Lost it again straight away, go round once more
+                        continue
+                    self.state = self.CONNECTED
+                    self.reconnects += 1
+                    duration = time.monotonic() - self.down_since
+                    self.reconnect_durations.append(duration)
+                    self.service.metrics.record_reconnect(duration)
+                print(f"✓ Reconnected in {duration * 1000:.0f} ms")
+                break
+
+    def stats(self):
+        """Time-to-reconnect and outage metrics as a dict"""
+        durations = list(self.reconnect_durations)
+        return {
+            "state": self.state,
+            "reconnects": self.reconnects,
+            "failed_attempts": self.failed_attempts,
+            "reports_dropped": self.reports_dropped,
+            "reports_buffered": len(self.buffer) + len(self.button_reports),
+            "reconnect_last_s": durations[-1] if durations else None,
+            "reconnect_mean_s": sum(durations) / len(durations) if durations else None,
+            "reconnect_max_s": max(durations) if durations else None,
+        }
+
+
+class Trajectory(object):
+    """
+    A path compiled to integer mouse deltas. Built once from float points,
+    replayed any number of times without float or trig work.
+
+    Points are quantized to whole pixels before taking differences, so the
+    rounding error of one step is carried into the next instead of piling
+    up: the deltas always sum to exactly the rounded end point (zero for
+    closed shapes like circles).
+    """
+    def __init__(self, points):
+        dx = array.array("i")
+        dy = array.array("i")
+        prev_x = round(points[0][0])
+        prev_y = round(points[0][1])
+        for x, y in points[1:]:
+            x = round(x)
+            y = round(y)
+            dx.append(x - prev_x)
+            dy.append(y - prev_y)
+            prev_x = x
+            prev_y = y
+        self.dx = dx
+        self.dy = dy
+        self.moves = tuple(zip(dx, dy))
+        self._batches = {}
+
+    def __len__(self):
+        return len(self.moves)
+
+    def __iter__(self):
+        return iter(self.moves)
+
+    def total(self):
+        """Net (dx, dy) of the whole path"""
+        return sum(self.dx), sum(self.dy)
+
+    def batch(self, buttons=0):
+        """(dx, dy, buttons) tuples for MouseEmulator.move_batch(), cached per button state"""
+        batch = self._batches.get(buttons)
+        if batch is None:
+            batch = self._batches[buttons] = [(dx, dy, buttons) for dx, dy in self.moves]
+        return batch
+
+
+@functools.lru_cache(maxsize=256)
+def compile_circle(radius, steps, start_angle=0.0):
+    """Closed circle of the given radius, starting and ending at the current position"""
+    if steps < 1:
+        raise ValueError(f"steps must be at least 1, got {steps}")
+    cx = -radius * math.cos(start_angle)
+    cy = -radius * math.sin(start_angle)
+    points = []
+    for step in range(steps + 1):
+        angle = start_angle + (2 * math.pi * step) / steps
+        points.append((cx + radius * math.cos(angle), cy + radius * math.sin(angle)))
+    return Trajectory(points)
+
+
+@functools.lru_cache(maxsize=256)
+def compile_line(dx, dy, steps):
+    """Straight line to (dx, dy) in equal steps"""
+    if steps < 1:
+        raise ValueError(f"steps must be at least 1, got {steps}")
+    return Trajectory([(dx * step / steps, dy * step / steps) for step in range(steps + 1)])
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_bezier(control_points, steps):
+    degree = len(control_points) - 1
+    coefficients = [math.comb(degree, i) for i in range(degree + 1)]
+    x0, y0 = control_points[0]
+    points = []
+    for step in range(steps + 1):
+        t = step / steps
+        x = y = 0.0
+        for i, (px, py) in enumerate(control_points):
+            weight = coefficients[i] * t ** i * (1 - t) ** (degree - i)
+            x += weight * px
+            y += weight * py
+        points.append((x - x0, y - y0))
+    return Trajectory(points)
+
+
+def compile_bezier(control_points, steps):
+    """
+    Bezier curve of any degree through control_points [(x, y), ...], relative
+    to the first control point (which is the current cursor position)
+    """
+    if steps < 1:
+        raise ValueError(f"steps must be at least 1, got {steps}")
+    if not control_points:
+        raise ValueError("A Bezier curve needs at least one control point")
+    return _compile_bezier(tuple((x, y) for x, y in control_points), steps)
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_polyline(points, max_step):
+    x0, y0 = points[0]
+    path = [(0.0, 0.0)]
+    for (ax, ay), (bx, by) in zip(points, points[1:]):
+        steps = max(1, math.ceil(max(abs(bx - ax), abs(by - ay)) / max_step))
+        for step in range(1, steps + 1):
+            path.append((ax - x0 + (bx - ax) * step / steps, ay - y0 + (by - ay) * step / steps))
+    return Trajectory(path)
+
+
+def compile_polyline(points, max_step=MotionAccumulator.LIMIT):
+    """
+    Straight segments through points [(x, y), ...], relative to the first one.
+    Each segment is cut into steps of at most max_step pixels per axis.
+    """
+    if not points:
+        raise ValueError("A polyline needs at least one point")
+    return _compile_polyline(tuple((x, y) for x, y in points), max_step)
+
+
+def send_with_retries(service, data, motion=False, max_retries=3):
+    """
+    service.send(data), reconnecting in between on failure (blocking, see
+    BluetoothHIDService.reconnect()). Returns False when it gave up.
+    """
+    for retry in range(max_retries):
+        try:
+            service.send(data, motion)
+            return True
+        except (ConnectionResetError, BrokenPipeError, OSError) as e:
+            if retry < max_retries - 1:
+                print(f"Attempting to reconnect (retry {retry + 1}/{max_retries})...")
+                if service.reconnect():
+                    continue  # Try sending again
+                else:
+                    print("Reconnection failed!")
+                    return False
+            else:
+                print("Max retries reached!")
+                return False
+    return False
+
+
+class MouseEmulator:
+    def __init__(self, bthid_service, supervisor=None, descriptor=None, screen=None):
+        self.bthid_service = bthid_service
+        self.supervisor = supervisor
+        self.metrics = getattr(bthid_service, "metrics", None) or HIDMetrics()
+        # The service's descriptor decides the report format (e.g. HID_DESCRIPTOR_EXTENDED)
+        if descriptor is None:
+            descriptor = getattr(bthid_service, "descriptor", HID_DESCRIPTOR)
+        self.encoder = MouseReportEncoder(descriptor=descriptor)
+        # Absolute pointer, only with a descriptor that has report ID 4 (move_to)
+        self.absolute = None
+        if (HID_INPUT, AbsolutePointerEncoder.REPORT_ID) in descriptor.reports:
+            self.absolute = AbsolutePointerEncoder(descriptor)
+        self.screen = screen  # (width, height) in pixels for move_to(), None for logical units
+        self.position = None  # last move_to() target while no relative move happened since
+        self.buttons = 0x00  # in this byte XXXXX(button2)(button1)(button0)
+        # Paces play_trajectory(), click() and the demos against absolute deadlines
+        self.scheduler = ReportScheduler(self.send_with_reconnect, self.metrics)
+    
+    def send_with_reconnect(self, data, motion=False):
+        """
+        Send data with automatic reconnection on failure. With a
+        ReconnectSupervisor this never blocks, reconnection happens in the
+        background and motion=True reports may be dropped during an outage.
+        """
+        if self.supervisor is not None:
+            return self.supervisor.send(data, motion)
+        return send_with_retries(self.bthid_service, data, motion)
+        
+    def move_mouse(self, x_displacement, y_displacement):
+        """
+        Move mouse by specified displacement
+        x_displacement: horizontal movement (negative is left, positive is right)
+        y_displacement: vertical movement (negative is up, positive is down)
+        A report carries -127..127 per axis (-32767..32767 with the extended
+        descriptor), larger moves are split across consecutive reports
+        instead of being truncated.
+        """
+        self.metrics.counters["mouse_moves"] += 1
+        self.position = None
+        limit = self.encoder.limit
+        while True:
+            dx = x_displacement
+            dy = y_displacement
+            if dx > limit:
+                dx = limit
+            elif dx < -limit:
+                dx = -limit
+            if dy > limit:
+                dy = limit
+            elif dy < -limit:
+                dy = -limit
+            if not self.send_with_reconnect(self.encoder.encode(self.buttons, dx, dy), True):
+                raise Exception("Failed to send mouse movement after reconnection attempts")
+            x_displacement -= dx
+            y_displacement -= dy
+            if not x_displacement and not y_displacement:
+                break
+
+    def move_to(self, x, y):
+        """
+        Put the pointer at (x, y) with a single absolute report, regardless
+        of where it was and of the host's pointer acceleration. x, y are
+        pixels of self.screen, or logical units (0..32767 on both axes,
+        spanning the whole screen) without one. Needs the absolute pointer
+        (HID_REPORT_DESCRIPTOR_ABSOLUTE, --absolute).
+        """
+        absolute = self.absolute
+        if absolute is None:
+            raise Exception("This device has no absolute pointer, use HID_REPORT_DESCRIPTOR_ABSOLUTE (--absolute)")
+        if self.screen is not None:
+            width, height = self.screen
+            x = (x * absolute.max_x + (width - 1) // 2) // max(width - 1, 1)
+            y = (y * absolute.max_y + (height - 1) // 2) // max(height - 1, 1)
+        self.metrics.counters["mouse_moves"] += 1
+        self.position = (x, y)
+        if not self.send_with_reconnect(absolute.encode(self.buttons, x, y), True):
+            raise Exception("Failed to send pointer position after reconnection attempts")
+
+    def _button_report(self):
+        # After move_to() buttons go out on the absolute report, so the click lands exactly there
+        if self.position is not None:
+            return self.absolute.encode(self.buttons, *self.position)
+        return self.encoder.encode(self.buttons, 0, 0)
+
+    def scroll(self, vertical=0, horizontal=0):
+        """
+        Turn the wheel by vertical detents (positive is up) and the
+        horizontal wheel (AC Pan) by horizontal detents (positive is
+        right). Needs the extended descriptor; split across reports like
+        move_mouse beyond -127..127.
+        """
+        if not self.encoder.has_wheel:
+            raise Exception("This mouse report has no wheel, use HID_DESCRIPTOR_EXTENDED (--extended-mouse)")
+        self.metrics.counters["mouse_scrolls"] += 1
+        while True:
+            wheel = max(-127, min(vertical, 127))
+            pan = max(-127, min(horizontal, 127))
+            if not self.send_with_reconnect(self.encoder.encode(self.buttons, 0, 0, wheel, pan), True):
+                raise Exception("Failed to send mouse scroll after reconnection attempts")
+            vertical -= wheel
+            horizontal -= pan
+            if not vertical and not horizontal:
+                break
+
+    def move_batch(self, moves):
+        """
+        Send a batch of (dx, dy, buttons) tuples, encoded in a single call
+        """
+        encoder = self.encoder
+        count = encoder.encode_batch(moves)
+        views = encoder.report_views
+        for i in range(count):
+            if not self.send_with_reconnect(views[i], True):
+                raise Exception("Failed to send mouse movement after reconnection attempts")
+        if count:
+            self.buttons = moves[-1][2]
+        
+    def click(self, button=1):
+        """
+        Click a mouse button (1=left, 2=right, 3=middle)
+        """
+        self.metrics.counters["mouse_clicks"] += 1
+        start = time.monotonic_ns()
+        self.press(button)
+        # Held 50 ms from the press, however long sending it took
+        self.scheduler.record(self.scheduler.wait_until(start + 50_000_000))
+        self.release(button)
+
+    def press(self, button=1):
+        """Hold a mouse button down"""
+        self.buttons |= 1 << (button - 1)
+        if not self.send_with_reconnect(self._button_report()):
+            raise Exception("Failed to send mouse click after reconnection attempts")
+
+    def release(self, button=1):
+        self.buttons &= ~(1 << (button - 1))
+        if not self.send_with_reconnect(self._button_report()):
+            raise Exception("Failed to send mouse release after reconnection attempts")
+        
+    def play_trajectory(self, trajectory, interval=0, start_ns=None):
+        """
+        Move along a compiled Trajectory. With interval=0 the whole path is
+        encoded in one batch and sent back to back, otherwise step i is
+        sent at start_ns + i * interval seconds (start_ns defaults to now).
+        Returns the deadline following the last step, pass it as start_ns
+        to chain trajectories without drift.
+        """
+        if not interval:
+            self.move_batch(trajectory.batch(self.buttons))
+            return None
+        step = int(interval * 1e9)
+        moves = trajectory.moves
+        start_ns = self.scheduler.run(((i * step, move) for i, move in enumerate(moves)),
+                                      start_ns, lambda move: self.move_mouse(*move))
+        return start_ns + len(moves) * step
+
+    def demo_movement(self):
+        """
+        Demo: Draw circles with the mouse continuously
+        """
+        print("\n=== Starting Infinite Circle Demo ===")
+        print("Drawing circles continuously... Press Ctrl+C to stop")
+        
+        # Draw circles - 3x larger radius, 36 steps to complete the circle.
+        # Compiled once and cached, the loop itself does no trig at all.
+        circle = compile_circle(60, 36)
+        
+        circle_num = 0
+        deadline = None
+        try:
+            while True:  # Infinite loop
+                circle_num += 1
+                print(f"Circle {circle_num}")
+                # One step every 50 ms, circles chained on the same time line
+                # so there is no pause (or drift) between them
+                deadline = self.play_trajectory(circle, 0.05, deadline)
+                
+        except KeyboardInterrupt:
+            print(f"\n=== Demo stopped after {circle_num} circles ===")
+        self._print_schedule()
+
+    def _print_schedule(self):
+        stats = self.scheduler.stats()
+        if stats["reports"]:
+            late = stats["lateness_us"]
+            print(f"Pacing of {stats['reports']} reports: lateness p50 {late['p50']:.0f} µs, "
+                  f"p99 {late['p99']:.0f} µs, max {late['max']:.0f} µs, jitter {late['jitter']:.0f} µs")
+        
+    def continuous_demo(self):
+        """
+        Continuously move mouse in a pattern every few seconds
+        """
+        print("\n=== Starting Continuous Mouse Demo ===")
+        print("Press Ctrl+C to stop")
+        
+        # Three steps 0.3 s apart, then a 2 s pause, on absolute deadlines
+        right = compile_polyline([(0, 0), (90, 0)], 30)
+        left = compile_polyline([(0, 0), (-90, 0)], 30)
+        deadline = None
+        try:
+            while True:
+                print("\nMoving RIGHT...")
+                deadline = self.play_trajectory(right, 0.3, deadline) + 2_000_000_000
+                
+                print("Moving LEFT...")
+                deadline = self.play_trajectory(left, 0.3, deadline) + 2_000_000_000
+                
+        except KeyboardInterrupt:
+            print("\n\nDemo stopped by user")
+        self._print_schedule()
+
+
+# Modifier bits of the keyboard report (usages 0xE0..0xE7)
+MOD_LEFT_CTRL = 0x01
+MOD_LEFT_SHIFT = 0x02
+MOD_LEFT_ALT = 0x04
+MOD_LEFT_GUI = 0x08
+MOD_RIGHT_CTRL = 0x10
+MOD_RIGHT_SHIFT = 0x20
+MOD_RIGHT_ALT = 0x40
+MOD_RIGHT_GUI = 0x80
+
+# Keyboard usage IDs of named keys
+KEY_ENTER = 0x28
+KEY_ESCAPE = 0x29
+KEY_BACKSPACE = 0x2A
+KEY_TAB = 0x2B
+KEY_SPACE = 0x2C
+
+
+def _us_layout():
+    layout = {}
+    for i, c in enumerate("abcdefghijklmnopqrstuvwxyz"):
+        layout[c] = (0, 0x04 + i)
+        layout[c.upper()] = (MOD_LEFT_SHIFT, 0x04 + i)
+    for i, (c, shifted) in enumerate(zip("1234567890", "!@#$%^&*()")):
+        layout[c] = (0, 0x1E + i)
+        layout[shifted] = (MOD_LEFT_SHIFT, 0x1E + i)
+    for keycode, c, shifted in ((0x2D, "-", "_"), (0x2E, "=", "+"), (0x2F, "[", "{"), (0x30, "]", "}"),
+                                (0x31, "\\", "|"), (0x33, ";", ":"), (0x34, "'", '"'), (0x35, "`", "~"),
+                                (0x36, ",", "<"), (0x37, ".", ">"), (0x38, "/", "?")):
+        layout[c] = (0, keycode)
+        layout[shifted] = (MOD_LEFT_SHIFT, keycode)
+    layout["\n"] = (0, KEY_ENTER)
+    layout["\t"] = (0, KEY_TAB)
+    layout[" "] = (0, KEY_SPACE)
+    layout["\b"] = (0, KEY_BACKSPACE)
+    layout["\x1b"] = (0, KEY_ESCAPE)
+    return layout
+
+
+# Character -> (modifiers, keycode) tables, built once at import
+KEYBOARD_LAYOUTS = {
+    "us": _us_layout(),
+}
+
+
+class KeyboardReportEncoder(object):
+    """Packs report ID 1 (boot-style keyboard) reports into a reused buffer"""
+    REPORT_ID = 0x01
+    # 0xA1 (DATA | Input), report ID, modifiers, reserved, 6 keycodes
+    REPORT = HID_DESCRIPTOR.report(REPORT_ID).message_struct
+    MAX_KEYS = 6
+
+    def __init__(self):
+        self.buf = bytearray(self.REPORT.size)
+
+    def encode(self, modifiers, keys=()):
+        """Encode a report with up to six pressed keys"""
+        if len(keys) > self.MAX_KEYS:
+            raise ValueError(f"At most {self.MAX_KEYS} keys per report, got {len(keys)}")
+        padded = tuple(keys) + (0,) * (self.MAX_KEYS - len(keys))
+        self.REPORT.pack_into(self.buf, 0, 0xA1, self.REPORT_ID, modifiers, *padded)
+        return self.buf
+
+
+COMPILE_TEXT_CACHE_CHARS = 64  # longer texts aren't cached, they'd keep their whole stream alive
+
+
+def compile_text(text, layout="us", max_keys=KeyboardReportEncoder.MAX_KEYS):
+    """
+    Turn text into a pre-encoded stream of keyboard reports, concatenated
+    in one bytes object (KeyboardReportEncoder.REPORT.size bytes each).
+    Texts up to COMPILE_TEXT_CACHE_CHARS characters are cached, so typing
+    the same short strings again costs a lookup.
+
+    Consecutive characters that share a modifier and don't repeat a key are
+    pressed together, up to max_keys per report; hosts register them in
+    report order. Going from one group straight to the next releases the
+    old keys and presses the new ones in the same report, an all-up report
+    is only needed when a key repeats or the modifier changes. Use
+    max_keys=1 for hosts that don't like chorded typing.
+    """
+    if len(text) <= COMPILE_TEXT_CACHE_CHARS:
+        return _compile_text_cached(text, layout, max_keys)
+    return _compile_text(text, layout, max_keys)
+
+
+def _compile_text(text, layout, max_keys):
+    table = KEYBOARD_LAYOUTS[layout]
+    groups = []
+    modifiers = None
+    keys = []
+    for c in text:
+        try:
+            char_modifiers, keycode = table[c]
+        except KeyError:
+            raise ValueError(f"Character {c!r} is not in the {layout!r} keyboard layout")
+        if keys and (char_modifiers != modifiers or keycode in keys or len(keys) >= max_keys):
+            groups.append((modifiers, keys))
+            keys = []
+        modifiers = char_modifiers
+        keys.append(keycode)
+    if keys:
+        groups.append((modifiers, keys))
+
+    pack = KeyboardReportEncoder.REPORT.pack
+    report_id = KeyboardReportEncoder.REPORT_ID
+    release = pack(0xA1, report_id, 0, 0, 0, 0, 0, 0, 0)
+    stream = []
+    prev_modifiers = None
+    prev_keys = ()
+    for group_modifiers, group_keys in groups:
+        if prev_keys and (group_modifiers != prev_modifiers or set(group_keys) & set(prev_keys)):
+            stream.append(release)
+        padded = group_keys + [0] * (KeyboardReportEncoder.MAX_KEYS - len(group_keys))
+        stream.append(pack(0xA1, report_id, group_modifiers, *padded))
+        prev_modifiers = group_modifiers
+        prev_keys = group_keys
+    if prev_keys:
+        stream.append(release)
+    return b"".join(stream)
+
+
+_compile_text_cached = functools.lru_cache(maxsize=256)(_compile_text)
+
+
+class KeyboardEmulator:
+    """
+    Keyboard on report ID 1 of the embedded descriptor. Shares the
+    BluetoothHIDService (and optional ReconnectSupervisor) with MouseEmulator.
+    """
+    def __init__(self, bthid_service, supervisor=None, layout="us"):
+        self.bthid_service = bthid_service
+        self.supervisor = supervisor
+        self.layout = layout
+        self.encoder = KeyboardReportEncoder()
+        self.modifiers = 0x00
+        self.keys = []
+        self.report_size = KeyboardReportEncoder.REPORT.size
+        self.scheduler = ReportScheduler(self.send_with_reconnect, getattr(bthid_service, "metrics", None))
+
+    def send_with_reconnect(self, data):
+        if self.supervisor is not None:
+            return self.supervisor.send(data)
+        return send_with_retries(self.bthid_service, data)
+
+    def _send_state(self):
+        if not self.send_with_reconnect(self.encoder.encode(self.modifiers, self.keys)):
+            raise Exception("Failed to send keyboard report after reconnection attempts")
+
+    def press(self, keycode=0, modifiers=0):
+        """Hold down a key and/or modifiers, on top of what is already held"""
+        self.modifiers |= modifiers
+        if keycode and keycode not in self.keys:
+            if len(self.keys) >= KeyboardReportEncoder.MAX_KEYS:
+                raise ValueError(f"At most {KeyboardReportEncoder.MAX_KEYS} keys can be held at once")
+            self.keys.append(keycode)
+        self._send_state()
+
+    def release(self, keycode=0, modifiers=0):
+        self.modifiers &= ~modifiers
+        if keycode in self.keys:
+            self.keys.remove(keycode)
+        self._send_state()
+
+    def release_all(self):
+        self.modifiers = 0
+        self.keys = []
+        self._send_state()
+
+    def tap(self, keycode, modifiers=0):
+        """Press and release a key (with modifiers), e.g. tap(0x06, MOD_LEFT_CTRL) for Ctrl+C"""
+        self.press(keycode, modifiers)
+        self.release(keycode, modifiers)
+
+    def type_text(self, text, interval=0, max_keys=KeyboardReportEncoder.MAX_KEYS):
+        """
+        Type text using the precompiled report stream from compile_text().
+        interval spaces the reports (on absolute deadlines) for slow hosts.
+        """
+        stream = memoryview(compile_text(text, self.layout, max_keys))
+        size = self.report_size
+        if interval:
+            step = int(interval * 1e9)
+            self.scheduler.run((offset // size * step, stream[offset:offset + size])
+                               for offset in range(0, len(stream), size))
+        else:
+            for offset in range(0, len(stream), size):
+                if not self.send_with_reconnect(stream[offset:offset + size]):
+                    raise Exception("Failed to send keyboard report after reconnection attempts")
+        self.modifiers = 0
+        self.keys = []
+
+
+# Linux input events (linux/input-event-codes.h)
+EV_SYN = 0x00
+EV_KEY = 0x01
+EV_REL = 0x02
+SYN_REPORT = 0
+SYN_DROPPED = 3
+REL_X = 0x00
+REL_Y = 0x01
+REL_HWHEEL = 0x06
+REL_WHEEL = 0x08
+
+# struct input_event: struct timeval, __u16 type, __u16 code, __s32 value, native layout
+_INPUT_EVENT = struct.Struct("@llHHi")
+_EVIOCGRAB = 0x40044590  # _IOW('E', 0x90, int)
+
+# BTN_LEFT, BTN_RIGHT, BTN_MIDDLE, BTN_SIDE, BTN_EXTRA -> button bit (the last two
+# only exist in the extended mouse report)
+_EVDEV_BUTTONS = {0x110: 0x01, 0x111: 0x02, 0x112: 0x04, 0x113: 0x08, 0x114: 0x10}
+
+# KEY_LEFTCTRL, KEY_LEFTSHIFT, ... -> modifier bit
+_EVDEV_MODIFIERS = {
+    29: MOD_LEFT_CTRL, 42: MOD_LEFT_SHIFT, 56: MOD_LEFT_ALT, 125: MOD_LEFT_GUI,
+    97: MOD_RIGHT_CTRL, 54: MOD_RIGHT_SHIFT, 100: MOD_RIGHT_ALT, 126: MOD_RIGHT_GUI,
+}
+
+HID_KEY_ROLLOVER = 0x01  # ErrorRollOver, reported in every slot when too many keys are held
+
+
+def _evdev_keycodes():
+    """Linux KEY_* code -> HID keyboard usage"""
+    table = {}
+    for first, row in ((16, "qwertyuiop"), (30, "asdfghjkl"), (44, "zxcvbnm")):
+        for i, c in enumerate(row):
+            table[first + i] = 0x04 + ord(c) - ord("a")
+    for i in range(9):
+        table[2 + i] = 0x1E + i  # KEY_1..KEY_9
+    for i in range(10):
+        table[59 + i] = 0x3A + i  # KEY_F1..KEY_F10
+    for i, code in enumerate((79, 80, 81, 75, 76, 77, 71, 72, 73)):
+        table[code] = 0x59 + i  # KEY_KP1..KEY_KP9
+    table.update({
+        11: 0x27, 1: KEY_ESCAPE, 12: 0x2D, 13: 0x2E, 14: KEY_BACKSPACE, 15: KEY_TAB,
+        26: 0x2F, 27: 0x30, 28: KEY_ENTER, 39: 0x33, 40: 0x34, 41: 0x35, 43: 0x31,
+        51: 0x36, 52: 0x37, 53: 0x38, 55: 0x55, 57: KEY_SPACE, 58: 0x39, 69: 0x53, 70: 0x47,
+        74: 0x56, 78: 0x57, 82: 0x62, 83: 0x63, 86: 0x64, 87: 0x44, 88: 0x45, 96: 0x58,
+        98: 0x54, 99: 0x46, 102: 0x4A, 103: 0x52, 104: 0x4B, 105: 0x50, 106: 0x4F, 107: 0x4D,
+        108: 0x51, 109: 0x4E, 110: 0x49, 111: 0x4C, 119: 0x48, 127: 0x65,
+    })
+    return table
+
+
+_EVDEV_KEYCODES = _evdev_keycodes()
+
+
+class _EvdevSource(object):
+    """One device or event file, with the frame it is in the middle of"""
+    def __init__(self, path, fd, is_file):
+        self.path = path
+        self.fd = fd
+        self.is_file = is_file
+        self.dx = 0
+        self.dy = 0
+        self.wheel = 0
+        self.pan = 0
+        self.mouse_changed = False
+        self.keys_changed = False
+        self.dropping = False  # after SYN_DROPPED, until the next SYN_REPORT
+
+
+class EvdevBridge(object):
+    """
+    Forwards local Linux input devices (/dev/input/event*) or recorded
+    event files (raw struct input_event dumps, e.g. from
+    `cat /dev/input/event5 > mouse.evdev`) to a MouseEmulator and/or
+    KeyboardEmulator.
+
+    REL_WHEEL/REL_HWHEEL go to the wheel and AC Pan of the extended mouse
+    report and are dropped with the standard one.
+
+    Events are read in bulk into a preallocated buffer and unpacked with
+    one precompiled struct. Everything up to a SYN_REPORT is one frame and
+    becomes at most one mouse and one keyboard report: REL_X/REL_Y are
+    summed over the frame, so a 1000 Hz gaming mouse costs at most 1000
+    reports/s however many events it generates. Motion and scrolling
+    beyond the -127..127 of one report go out with the following frames,
+    or once the device has nothing more to read.
+
+    Usage:
+        bridge = EvdevBridge(MouseEmulator(service), KeyboardEmulator(service))
+        bridge.add_device("/dev/input/event5", grab=True)
+        bridge.run()
+    """
+    READ_EVENTS = 64  # events per read() call
+
+    def __init__(self, mouse=None, keyboard=None):
+        self.mouse = mouse
+        self.keyboard = keyboard
+        self.accumulator = MotionAccumulator(mouse.encoder.limit if mouse is not None else MotionAccumulator.LIMIT)
+        self.wheel_left = 0  # scrolling that did not fit in the last report
+        self.pan_left = 0
+        self.selector = selectors.DefaultSelector()
+        self.sources = []
+        self._buf = bytearray(_INPUT_EVENT.size * self.READ_EVENTS)
+        self._view = memoryview(self._buf)
+        self.events = 0
+        self.frames = 0
+        self.reports_sent = 0
+        self.running = False
+
+    def add_device(self, path, grab=False):
+        """
+        Forward a device node, or a regular file of recorded events (played
+        back as fast as possible by run()). grab=True takes the device
+        away from the local desktop (EVIOCGRAB).
+        """
+        fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        is_file = stat.S_ISREG(os.fstat(fd).st_mode)
+        if grab and not is_file:
+            fcntl.ioctl(fd, _EVIOCGRAB, 1)
+        source = _EvdevSource(path, fd, is_file)
+        self.sources.append(source)
+        if not is_file:
+            self.selector.register(fd, selectors.EVENT_READ, source)
+        return source
+
+    def _remove(self, source):
+        if not source.is_file:
+            self.selector.unregister(source.fd)
+        os.close(source.fd)
+        self.sources.remove(source)
+
+    def run(self):
+        """Play the event files, then forward the devices until stop() or they all go away"""
+        self.running = True
+        for source in [s for s in self.sources if s.is_file]:
+            self._read(source)
+            self._remove(source)
+        while self.running and self.sources:
+            for key, _ in self.selector.select(0.5):
+                self._read(key.data)
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        self.running = False
+        for source in list(self.sources):
+            self._remove(source)
+        self.selector.close()
+
+    def _read(self, source):
+        """Read and process everything available right now"""
+        size = _INPUT_EVENT.size
+        pending = 0  # bytes of an incomplete event left at the front of the buffer (files only)
+        while True:
+            try:
+                n = os.readv(source.fd, [self._view[pending:]])
+            except BlockingIOError:
+                break
+            except OSError as e:
+                print(f"⚠️  {source.path}: {e}, no longer forwarding it")
+                self._remove(source)
+                break
+            if n == 0:
+                if not source.is_file:
+                    # Writer side gone (e.g. a FIFO), nothing more will come
+                    self._remove(source)
+                break
+            n += pending
+            whole = n - n % size
+            self.feed(self._view[:whole], source)
+            pending = n - whole
+            if pending:
+                self._buf[:pending] = self._buf[whole:n]
+        self.flush_motion()
+
+    def feed(self, data, source=None):
+        """Process a buffer of whole input_event structs"""
+        if source is None:
+            source = self.sources[0] if self.sources else _EvdevSource(None, -1, True)
+        mouse = self.mouse
+        keyboard = self.keyboard
+        dx = source.dx
+        dy = source.dy
+        wheel = source.wheel
+        pan = source.pan
+        mouse_changed = source.mouse_changed
+        keys_changed = source.keys_changed
+        dropping = source.dropping
+        count = 0
+        for _, _, type_, code, value in _INPUT_EVENT.iter_unpack(data):
+            count += 1
+            if type_ == EV_SYN:
+                if code == SYN_REPORT:
+                    if dropping:
+                        # The frame is incomplete, key/button states are kept as they were
+                        dropping = False
+                    elif dx or dy or wheel or pan or mouse_changed or keys_changed:
+                        self._frame(dx, dy, wheel, pan, mouse_changed, keys_changed)
+                    dx = dy = wheel = pan = 0
+                    mouse_changed = keys_changed = False
+                elif code == SYN_DROPPED:
+                    dropping = True
+            elif dropping:
+                continue
+            elif type_ == EV_REL:
+                if code == REL_X:
+                    dx += value
+                elif code == REL_Y:
+                    dy += value
+                elif code == REL_WHEEL:
+                    wheel += value
+                elif code == REL_HWHEEL:
+                    pan += value
+            elif type_ == EV_KEY and value != 2:  # 2 is autorepeat, the host repeats by itself
+                if code in _EVDEV_BUTTONS:
+                    if mouse is not None:
+                        if value:
+                            mouse.buttons |= _EVDEV_BUTTONS[code]
+                        else:
+                            mouse.buttons &= ~_EVDEV_BUTTONS[code]
+                        mouse_changed = True
+                elif keyboard is None:
+                    continue
+                elif code in _EVDEV_MODIFIERS:
+                    if value:
+                        keyboard.modifiers |= _EVDEV_MODIFIERS[code]
+                    else:
+                        keyboard.modifiers &= ~_EVDEV_MODIFIERS[code]
+                    keys_changed = True
+                elif code in _EVDEV_KEYCODES:
+                    usage = _EVDEV_KEYCODES[code]
+                    if value and usage not in keyboard.keys:
+                        keyboard.keys.append(usage)
+                    elif not value and usage in keyboard.keys:
+                        keyboard.keys.remove(usage)
+                    keys_changed = True
+        source.dx = dx
+        source.dy = dy
+        source.wheel = wheel
+        source.pan = pan
+        source.mouse_changed = mouse_changed
+        source.keys_changed = keys_changed
+        source.dropping = dropping
+        self.events += count
+
+    def _frame(self, dx, dy, wheel, pan, mouse_changed, keys_changed):
+        """One SYN_REPORT worth of changes: at most one mouse and one keyboard report"""
+        self.frames += 1
+        mouse = self.mouse
+        if mouse is not None and (dx or dy or wheel or pan or mouse_changed):
+            self.accumulator.add(dx, dy)
+            dx, dy = self.accumulator.take()
+            wheel, pan = self._take_scroll(wheel, pan)
+            report = mouse.encoder.encode(mouse.buttons, dx, dy, wheel, pan)
+            # Button changes must not be dropped during an outage, pure motion may
+            if not mouse.send_with_reconnect(report, not mouse_changed):
+                raise Exception("Failed to send mouse movement after reconnection attempts")
+            self.reports_sent += 1
+        keyboard = self.keyboard
+        if keyboard is not None and keys_changed:
+            keys = keyboard.keys
+            if len(keys) > KeyboardReportEncoder.MAX_KEYS:
+                keys = (HID_KEY_ROLLOVER,) * KeyboardReportEncoder.MAX_KEYS
+            if not keyboard.send_with_reconnect(keyboard.encoder.encode(keyboard.modifiers, keys)):
+                raise Exception("Failed to send keyboard report after reconnection attempts")
+            self.reports_sent += 1
+
+    def _take_scroll(self, wheel, pan):
+        """
+        Add wheel/pan to what earlier frames left over and return the part
+        one report carries, the rest stays for the next one
+        """
+        if not self.mouse.encoder.has_wheel:
+            return 0, 0
+        wheel += self.wheel_left
+        pan += self.pan_left
+        take_wheel = max(-127, min(wheel, 127))
+        take_pan = max(-127, min(pan, 127))
+        self.wheel_left = wheel - take_wheel
+        self.pan_left = pan - take_pan
+        return take_wheel, take_pan
+
+    def flush_motion(self):
+        """Send the motion and scrolling left over from frames beyond one report's range"""
+        mouse = self.mouse
+        while mouse is not None and (self.accumulator.pending() or self.wheel_left or self.pan_left):
+            dx, dy = self.accumulator.take()
+            wheel, pan = self._take_scroll(0, 0)
+            if not mouse.send_with_reconnect(mouse.encoder.encode(mouse.buttons, dx, dy, wheel, pan), True):
+                raise Exception("Failed to send mouse movement after reconnection attempts")
+            self.reports_sent += 1
+
+
+class ReportQueueFull(Exception):
+    pass
+
+
+class ReportQueue(object):
+    """
+    Bounded outbound report queue for the asyncio API. What happens when it
+    is full is picked by the overflow policy:
+        BLOCK               put() waits for room
+        DROP_OLDEST_MOTION  the oldest queued motion-only report is dropped
+                            (button changes are never dropped, if there is no
+                            motion to drop put() waits like BLOCK)
+        ERROR               put() raises ReportQueueFull
+    Once the consumer fails the queue (fail()), put() and join() raise.
+    """
+    BLOCK = "block"
+    DROP_OLDEST_MOTION = "drop-oldest-motion"
+    ERROR = "error"
+    POLICIES = (BLOCK, DROP_OLDEST_MOTION, ERROR)
+
+    def __init__(self, maxsize=64, policy=BLOCK):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown overflow policy {policy!r}, expected one of {self.POLICIES}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.items = collections.deque()
+        self.dropped = 0
+        self.error = None  # set by fail(), nothing is taken off the queue any more
+        self._changed = asyncio.Condition()
+
+    def __len__(self):
+        return len(self.items)
+
+    def _drop_oldest_motion(self):
+        for i, (report, motion) in enumerate(self.items):
+            if motion:
+                del self.items[i]
+                self.dropped += 1
+                return True
+        return False
+
+    def _check(self):
+        if self.error is not None:
+            raise Exception(f"Report queue failed: {self.error}") from self.error
+
+    async def put(self, report, motion=False):
+        async with self._changed:
+            self._check()
+            while len(self.items) >= self.maxsize:
+                if self.policy == self.ERROR:
+                    raise ReportQueueFull(f"Report queue full ({self.maxsize} reports)")
+                if self.policy == self.DROP_OLDEST_MOTION and self._drop_oldest_motion():
+                    break
+                await self._changed.wait()
+                self._check()
+            self.items.append((report, motion))
+            self._changed.notify_all()
+
+    async def get(self):
+        async with self._changed:
+            while not self.items:
+                await self._changed.wait()
+            report, motion = self.items.popleft()
+            self._changed.notify_all()
+            return report
+
+    async def join(self):
+        """Wait until the queue is empty"""
+        async with self._changed:
+            while self.items:
+                await self._changed.wait()
+            self._check()
+
+    async def fail(self, error):
+        """The consumer is gone: drop what is queued and make put() and join() raise error"""
+        async with self._changed:
+            self.error = error
+            self.dropped += len(self.items)
+            self.items.clear()
+            self._changed.notify_all()
+
+
+class AsyncBluetoothHIDService(object):
+    """
+    asyncio front end for a connected BluetoothHIDService. Reports are put
+    on a bounded ReportQueue and written by a sender task through the event
+    loop on the non-blocking interrupt socket, so producers never block on
+    the link. Don't mix with the blocking send() of the same service.
+    When reconnecting fails the sender task stops and fails the queue, so
+    send() and drain() raise from then on instead of hanging.
+
+    Usage:
+        service = await AsyncBluetoothHIDService.create(HID_SERVICE_RECORD, mac, remote_mac)
+        mouse = AsyncMouseEmulator(service)
+        await mouse.move_mouse(10, 0)
+    """
+    def __init__(self, service, maxsize=64, policy=ReportQueue.BLOCK):
+        self.service = service
+        self.queue = ReportQueue(maxsize, policy)
+        service.metrics.add_gauge("queue_depth", self.queue.__len__)
+        self.reports_sent = 0
+        self.error = None  # why the sender task stopped, send() and drain() raise from then on
+        self._sender_task = None
+        self._sending = False
+
+    @classmethod
+    async def create(cls, service_record, MAC, remote_mac=None, transport=None,
+                     maxsize=64, policy=ReportQueue.BLOCK, descriptor=None):
+        """Set up the connection in an executor so the loop keeps running meanwhile"""
+        loop = asyncio.get_running_loop()
+        service = await loop.run_in_executor(
+            None, lambda: BluetoothHIDService(service_record, MAC, remote_mac, transport, descriptor=descriptor))
+        self = cls(service, maxsize, policy)
+        self.start()
+        return self
+
+    def start(self):
+        if self._sender_task is None:
+            self._sender_task = asyncio.get_running_loop().create_task(self._sender())
+
+    async def send(self, report, motion=False):
+        """
+        Queue a report, report must not be modified afterwards (pass bytes).
+        motion=True marks it as droppable under the DROP_OLDEST_MOTION policy.
+        Raises once the sender task stopped (reconnecting failed).
+        """
+        await self.queue.put(report, motion)
+
+    async def _send_now(self, loop, report):
+        service = self.service
+        while True:
+            if service.cinter and service.connected:
+                wire = service._outgoing(report)
+                if wire is None:
+                    return
+                for part in wire if type(wire) is tuple else (wire,):
+                    start = time.perf_counter_ns()
+                    try:
+                        await loop.sock_sendall(service.cinter, part)
+                    except (ConnectionResetError, BrokenPipeError, OSError) as e:
+                        service._send_failed(e)
+                        break
+                    service._sent(part, start)
+                else:
+                    return
+            # The blocking reconnect runs in an executor, producers keep queueing
+            if not await loop.run_in_executor(None, service.reconnect):
+                raise Exception("Failed to send report after reconnection attempts")
+            service.cinter.setblocking(False)
+
+    async def _sender(self):
+        loop = asyncio.get_running_loop()
+        if self.service.cinter:
+            self.service.cinter.setblocking(False)
+        while True:
+            report = await self.queue.get()
+            self._sending = True
+            try:
+                await self._send_now(loop, report)
+                self.reports_sent += 1
+            except Exception as e:
+                # Nothing will write the queue any more: fail it, so producers
+                # waiting for room and drain() raise instead of hanging
+                print(f"✗ Report sender stopped: {e}")
+                self.error = e
+                await self.queue.fail(e)
+                return
+            finally:
+                self._sending = False
+
+    async def drain(self):
+        """Wait until every queued report has been written, raises if the sender stopped"""
+        await self.queue.join()
+        while self._sending:
+            await asyncio.sleep(0)
+
+    async def close(self):
+        """Flush the queue, stop the sender and clean up the service"""
+        if self._sender_task is not None:
+            if self.error is None:
+                await self.drain()
+            self._sender_task.cancel()
+            try:
+                await self._sender_task
+            except asyncio.CancelledError:
+                pass
+            self._sender_task = None
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.service.cleanup)
+
+
+class AsyncMouseEmulator(object):
+    """MouseEmulator for asyncio, every call only waits for queue space"""
+    def __init__(self, async_service):
+        self.async_service = async_service
+        self.buttons = 0x00
+        self.encoder = MouseReportEncoder(descriptor=async_service.service.descriptor)
+
+    async def _send(self, dx, dy, motion):
+        # Queued reports outlive the encoder buffer, hence the copy
+        await self.async_service.send(bytes(self.encoder.encode(self.buttons, dx, dy)), motion)
+
+    async def move_mouse(self, x_displacement, y_displacement):
+        """Relative move, split across reports like MouseEmulator.move_mouse"""
+        limit = self.encoder.limit
+        while True:
+            dx = max(-limit, min(x_displacement, limit))
+            dy = max(-limit, min(y_displacement, limit))
+            await self._send(dx, dy, True)
+            x_displacement -= dx
+            y_displacement -= dy
+            if not x_displacement and not y_displacement:
+                break
+
+    async def press(self, button=1):
+        self.buttons |= 1 << (button - 1)
+        await self._send(0, 0, False)
+
+    async def release(self, button=1):
+        self.buttons &= ~(1 << (button - 1))
+        await self._send(0, 0, False)
+
+    async def click(self, button=1, hold=0.05):
+        """Click a mouse button (1=left, 2=right, 3=middle) without blocking the loop"""
+        await self.press(button)
+        await asyncio.sleep(hold)
+        await self.release(button)
+
+    async def demo_movement(self, circles=None, interval=0.05):
+        """Async version of MouseEmulator.demo_movement, circles=None runs forever"""
+        circle = compile_circle(60, 36)
+        circle_num = 0
+        while circles is None or circle_num < circles:
+            circle_num += 1
+            for dx, dy in circle.moves:
+                await self.move_mouse(dx, dy)
+                await asyncio.sleep(interval)
+
+
+class HostSession(object):
+    """
+    One host of a MultiHostHIDService with its own bounded outbound queue.
+    Producers wait when it is full; while the host is reconnecting its
+    supervisor drains the queue by its outage policy, so a lost host
+    doesn't hold up the others.
+    """
+    def __init__(self, service, supervisor, queue_size):
+        self.service = service
+        self.supervisor = supervisor
+        self.remote_mac = service.remote_mac
+        self.controller_mac = service.SELFMAC
+        self.queue = collections.deque()
+        self.queue_size = queue_size
+        self.reports_sent = 0
+        self.reports_dropped = 0
+
+    def is_up(self):
+        return self.supervisor.is_up()
+
+
+class _AdapterWorker(object):
+    """Writes out the queues of every session on one adapter"""
+    def __init__(self, controller_mac):
+        self.controller_mac = controller_mac
+        self.sessions = []
+        self.cond = threading.Condition()
+        self.busy = False
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.running and not any(s.queue for s in self.sessions):
+                    self.busy = False
+                    self.cond.notify_all()
+                    self.cond.wait()
+                if not self.running:
+                    return
+                self.busy = True
+                batches = []
+                for session in self.sessions:
+                    if session.queue:
+                        batches.append((session, list(session.queue)))
+                        session.queue.clear()
+                # Wake up producers waiting for queue space
+                self.cond.notify_all()
+            # Send outside the lock so producers can keep queueing
+            for session, reports in batches:
+                send = session.supervisor.send
+                for report, motion in reports:
+                    if send(report, motion):
+                        session.reports_sent += 1
+                    else:
+                        session.reports_dropped += 1
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.thread.join()
+
+
+class MultiHostHIDService(object):
+    """
+    Serves several hosts from one process, across one or more adapters.
+
+    Every host gets a HostSession (its own BluetoothHIDService, transport,
+    ReconnectSupervisor and bounded queue). One worker thread per adapter
+    writes the queues out, so hosts on different adapters never wait on
+    each other. The HID profile is registered once for all of them.
+
+    broadcast() copies the encoded report once and queues that same bytes
+    object on every session. send() is an alias for broadcast(), so the
+    pool can be handed to MouseEmulator/KeyboardEmulator in place of a
+    BluetoothHIDService to drive all hosts at once.
+
+    Usage:
+        pool = MultiHostHIDService(HID_SERVICE_RECORD)
+        for host_mac, adapter_mac in get_connected_devices():
+            pool.add_host(adapter_mac, host_mac)
+        MouseEmulator(pool).move_mouse(10, 0)   # moves on every host
+    """
+    def __init__(self, service_record, transport_factory=None, queue_size=256, bluez=None,
+                 event_driven=False, descriptor=HID_DESCRIPTOR):
+        self.service_record = service_record
+        self.descriptor = descriptor
+        # transport_factory(controller_mac) -> transport, default is L2CAP
+        # with one shared pair of listening sockets per adapter
+        self.transport_factory = transport_factory
+        self.queue_size = queue_size
+        self.sessions = {}
+        self.workers = {}
+        self.listeners = {}
+        self.lock = threading.Lock()
+        self.metrics = HIDMetrics()
+        self.metrics.add_gauge("queue_depth", lambda: sum(len(s.queue) for s in list(self.sessions.values())))
+        self.metrics.add_gauge("hosts", lambda: len(self.sessions))
+        self.recorder = None  # ReportRecorder of the broadcast reports (send_to() ones aren't logged)
+        self._record_lock = threading.Lock()  # broadcast() is called from several producer threads
+        self.host_added = threading.Condition(self.lock)
+        self.bluez = None
+        self.manager = None
+        self.connector = None
+        if transport_factory is None or getattr(transport_factory, "uses_bluez", False):
+            self.bluez = bluez if bluez is not None else BlueZContext()
+            if event_driven:
+                # Hosts are taken over as BlueZ hands them in, see adopt_host()
+                self.connector = ProfileConnector(self.bluez, service_record, self.adopt_host,
+                                                  on_disconnect=self._host_disconnected)
+                self.manager = self.connector.manager
+            else:
+                self.manager = register_hid_profile(self.bluez, service_record, BluetoothHIDService.PROFILE_PATH)
+
+    def _new_transport(self, controller_mac):
+        if self.transport_factory is not None:
+            return self.transport_factory(controller_mac)
+        listener = self.listeners.get(controller_mac)
+        if listener is None:
+            listener = self.listeners[controller_mac] = L2CAPTransport(controller_mac)
+        return L2CAPTransport(controller_mac, listener)
+
+    def _add_session(self, controller_mac, transport, remote_mac):
+        # Sharing the pool's BlueZContext lets the session watch its host's Device1
+        service = BluetoothHIDService(self.service_record, controller_mac, remote_mac, transport,
+                                      register_profile=False, bluez=self.bluez, descriptor=self.descriptor)
+        supervisor = ReconnectSupervisor(service)
+        supervisor.start()
+        session = HostSession(service, supervisor, self.queue_size)
+        with self.lock:
+            worker = self.workers.get(controller_mac)
+            if worker is None:
+                worker = self.workers[controller_mac] = _AdapterWorker(controller_mac)
+            with worker.cond:
+                worker.sessions.append(session)
+            self.sessions[session.remote_mac] = session
+            self.host_added.notify_all()
+        print(f"Session added: {session.remote_mac} via {controller_mac} ({len(self.sessions)} hosts)")
+        return session
+
+    def add_host(self, controller_mac, remote_mac):
+        """Connect out to an already paired host through the given adapter"""
+        transport = self._new_transport(controller_mac)
+        transport.connect(remote_mac)
+        return self._add_session(controller_mac, transport, remote_mac)
+
+    def accept_host(self, controller_mac):
+        """Wait for the next host to connect to the given adapter"""
+        transport = self._new_transport(controller_mac)
+        remote_mac = transport.accept()
+        return self._add_session(controller_mac, transport, remote_mac)
+
+    def adopt_host(self, remote_mac, controller_mac, control, interrupt):
+        """
+        Take a host whose channels are already open (ProfileConnector
+        callback). A host we already have gets the new channels handed to
+        its supervisor instead of a second session.
+        """
+        session = self.sessions.get(remote_mac)
+        if session is not None:
+            session.service.remote_mac = remote_mac  # again, after a virtual cable unplug
+            session.supervisor.hand_over(control, interrupt)
+            return session
+        transport = L2CAPTransport(controller_mac)
+        transport.control = control
+        transport.interrupt = interrupt
+        return self._add_session(controller_mac, transport, remote_mac)
+
+    def wait_for_host(self, timeout=None):
+        """Wait until at least one host is connected, returns False on timeout"""
+        with self.host_added:
+            return bool(self.host_added.wait_for(lambda: self.sessions, timeout))
+
+    def remove_host(self, remote_mac):
+        self._close_session(self._pop_session(remote_mac))
+
+    def _pop_session(self, remote_mac):
+        with self.lock:
+            session = self.sessions.pop(remote_mac)
+            worker = self.workers[session.controller_mac]
+            with worker.cond:
+                worker.sessions.remove(session)
+        return session
+
+    def _close_session(self, session):
+        session.supervisor.stop()
+        session.service.cleanup()
+
+    def _host_disconnected(self, remote_mac):
+        """BlueZ wants the connection to remote_mac back (ProfileConnector), close its session"""
+        try:
+            session = self._pop_session(remote_mac)
+        except KeyError:
+            return
+        print(f"Session removed: {remote_mac} (disconnection requested)")
+        # Not on the GLib loop thread this is called from, joining the
+        # supervisor and control channel threads may take a while
+        threading.Thread(target=self._close_session, args=(session,), daemon=True).start()
+
+    def _enqueue(self, session, report, motion):
+        worker = self.workers[session.controller_mac]
+        with worker.cond:
+            # Backpressure: wait for the worker rather than dropping reports
+            while len(session.queue) >= session.queue_size and worker.running:
+                worker.cond.notify_all()
+                worker.cond.wait()
+            session.queue.append((report, motion))
+            worker.cond.notify_all()
+
+    def send_to(self, remote_mac, report, motion=False):
+        """Queue a report for one host"""
+        self._enqueue(self.sessions[remote_mac], bytes(report), motion)
+
+    def broadcast(self, report, motion=False):
+        """Queue a report for every host, the report is copied once and shared"""
+        report = bytes(report)
+        self.metrics.counters["broadcasts"] += 1
+        if self.recorder is not None:
+            with self._record_lock:
+                self.recorder.record(report)
+        for session in list(self.sessions.values()):
+            self._enqueue(session, report, motion)
+
+    def send(self, bytes_buf, motion=False):
+        self.broadcast(bytes_buf, motion)
+
+    def flush(self, timeout=None):
+        """Wait until every queued report has been handed to its host, returns False on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for worker in list(self.workers.values()):
+            with worker.cond:
+                while worker.busy or any(s.queue for s in worker.sessions):
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    worker.cond.wait(remaining)
+        return True
+
+    def metrics_sources(self):
+        """
+        MetricsServer sources: the pool's own metrics (broadcasts, queue
+        depth, hosts) as "mouse" and each host's link metrics under its MAC
+        """
+        sources = {"mouse": self.metrics}
+        for mac, session in list(self.sessions.items()):
+            sources[mac] = session.service.metrics
+        return sources
+
+    def stats(self):
+        return {mac: {"adapter": s.controller_mac, "state": s.supervisor.state, "queued": len(s.queue),
+                      "sent": s.reports_sent, "dropped": s.reports_dropped}
+                for mac, s in self.sessions.items()}
+
+    def cleanup_profile(self):
+        if self.bluez is None:
+            return
+        try:
+            self.bluez.profile_manager().UnregisterProfile(BluetoothHIDService.PROFILE_PATH)
+        except dbus.exceptions.DBusException as e:
+            if "Does Not Exist" not in str(e):
+                print(f"Note: {e}")
+
+    def cleanup(self):
+        """Stop the workers, disconnect every host and drop the profile"""
+        for worker in self.workers.values():
+            worker.stop()
+        self.workers = {}
+        for session in self.sessions.values():
+            session.supervisor.stop()
+            session.service.cleanup()
+        self.sessions = {}
+        for listener in self.listeners.values():
+            listener.shutdown()
+        self.listeners = {}
+        if self.connector is not None:
+            self.connector.close()
+        self.cleanup_profile()
+
+
+def get_controller_mac(bluez=None):
+    """Get MAC address of the local Bluetooth adapter"""
+    try:
+        bluez = bluez if bluez is not None else BlueZContext()
+        for path, adapter in bluez.adapters().items():
+            mac = adapter.get("Address")
+            name = adapter.get("Name", "Unknown")
+            print(f"Found Bluetooth adapter: {name} ({mac})")
+            return str(mac)
+        return None
+    except Exception as e:
+        print(f"Error finding Bluetooth adapter: {e}")
+        return None
+
+
+def get_connected_device_mac(bluez=None):
+    """Get MAC address of connected Bluetooth device"""
+    try:
+        bluez = bluez if bluez is not None else BlueZContext()
+        for path, device in bluez.devices().items():
+            mac = device.get("Address")
+            name = device.get("Name", "Unknown")
+            print(f"Found connected device: {name} ({mac})")
+            return str(mac)
+        return None
+    except Exception as e:
+        print(f"Error finding connected device: {e}")
+        return None
+
+
+def get_adapters(bluez=None):
+    """Addresses of all local Bluetooth adapters, keyed by their D-Bus object path"""
+    try:
+        bluez = bluez if bluez is not None else BlueZContext()
+        return {path: str(adapter.get("Address")) for path, adapter in bluez.adapters().items()}
+    except Exception as e:
+        print(f"Error finding Bluetooth adapters: {e}")
+        return {}
+
+
+def get_connected_devices(bluez=None):
+    """(device MAC, adapter MAC) of every connected Bluetooth device, across all adapters"""
+    try:
+        bluez = bluez if bluez is not None else BlueZContext()
+        adapters = get_adapters(bluez)
+        devices = []
+        for path, device in bluez.devices().items():
+            adapter_mac = adapters.get(str(device.get("Adapter")))
+            if adapter_mac:
+                print(f"Found connected device: {device.get('Name', 'Unknown')} ({device.get('Address')}) on {adapter_mac}")
+                devices.append((str(device.get("Address")), adapter_mac))
+        return devices
+    except Exception as e:
+        print(f"Error finding connected devices: {e}")
+        return []
+
+
+def cleanup_profile(bluez=None):
+    """Cleanup any existing Bluetooth profile registration"""
+    PROFILE_PATH = "/org/bluez/bthid_profile_mouse"
+    try:
+        bluez = bluez if bluez is not None else BlueZContext()
+        bluez.profile_manager().UnregisterProfile(PROFILE_PATH)
+        print("Cleaned up existing profile registration")
+    except Exception:
+        pass  # Profile wasn't registered, which is fine
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        sources = self.server.sources
+        if callable(sources):
+            sources = sources()
+        if self.path.startswith("/metrics"):
+            lines = []
+            for name, metrics in sources.items():
+                lines.extend(metrics.prometheus(f'source="{name}"'))
+            body = ("\n".join(lines) + "\n").encode()
+            content_type = "text/plain; version=0.0.4"
+        elif self.path.startswith("/stats"):
+            body = json.dumps({name: m.snapshot() for name, m in sources.items()}, indent=2).encode()
+            content_type = "application/json"
+        else:
+            self.send_error(404, "Try /metrics (Prometheus) or /stats (JSON)")
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class MetricsServer(object):
+    """
+    Serves HIDMetrics over HTTP: GET /metrics (Prometheus text) and
+    GET /stats (JSON). address is ("127.0.0.1", port) for TCP or a path for
+    a Unix socket (curl --unix-socket PATH http://localhost/stats).
+    sources is {name: HIDMetrics}, or a callable returning one on every
+    scrape when the links come and go (MultiHostHIDService.metrics_sources).
+    Runs on a daemon thread, scrapes never touch the send path.
+    """
+    def __init__(self, sources, address):
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.unlink(address)
+            self.httpd = _UnixHTTPServer(address, _MetricsHandler)
+        else:
+            self.httpd = http.server.ThreadingHTTPServer(address, _MetricsHandler)
+        self.httpd.sources = sources
+        self.address = address
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+
+def parse_metrics_address(value):
+    """'host:port' or ':port' -> TCP address, anything else is a Unix socket path"""
+    host, sep, port = value.rpartition(":")
+    if sep and port.isdigit() and "/" not in value:
+        return (host or "127.0.0.1", int(port))
+    return value
+
+
+# Command protocol of CommandServer. Opcodes and their little-endian arguments:
+CMD_MOVE = 0x01           # int16 dx, int16 dy (split across reports if needed)
+CMD_CLICK = 0x02          # uint8 button
+CMD_PRESS = 0x03          # uint8 button
+CMD_RELEASE = 0x04        # uint8 button
+CMD_KEY_PRESS = 0x05      # uint8 keycode, uint8 modifiers
+CMD_KEY_RELEASE = 0x06    # uint8 keycode, uint8 modifiers
+CMD_KEY_TAP = 0x07        # uint8 keycode, uint8 modifiers
+CMD_TYPE = 0x08           # uint16 length, UTF-8 text
+CMD_CIRCLE = 0x09         # int16 radius, uint16 steps, uint16 interval_ms
+CMD_LINE = 0x0A           # int16 dx, int16 dy, uint16 steps, uint16 interval_ms
+CMD_POLYLINE = 0x0B       # uint16 interval_ms, uint8 n, n * (int16 x, int16 y)
+CMD_BEZIER = 0x0C         # uint16 steps, uint16 interval_ms, uint8 n, n * (int16 x, int16 y)
+CMD_SLEEP = 0x0D          # uint32 microseconds
+CMD_SCROLL = 0x0E         # int16 vertical, int16 horizontal (extended mouse only)
+CMD_MOVE_TO = 0x0F        # uint16 x, uint16 y (absolute pointer only)
+
+_CMD_ARGS = {
+    CMD_MOVE: struct.Struct("<hh"),
+    CMD_CLICK: struct.Struct("<B"),
+    CMD_PRESS: struct.Struct("<B"),
+    CMD_RELEASE: struct.Struct("<B"),
+    CMD_KEY_PRESS: struct.Struct("<BB"),
+    CMD_KEY_RELEASE: struct.Struct("<BB"),
+    CMD_KEY_TAP: struct.Struct("<BB"),
+    CMD_TYPE: struct.Struct("<H"),
+    CMD_CIRCLE: struct.Struct("<hHH"),
+    CMD_LINE: struct.Struct("<hhHH"),
+    CMD_POLYLINE: struct.Struct("<HB"),
+    CMD_BEZIER: struct.Struct("<HHB"),
+    CMD_SLEEP: struct.Struct("<I"),
+    CMD_SCROLL: struct.Struct("<hh"),
+    CMD_MOVE_TO: struct.Struct("<HH"),
+}
+_CMD_POINT = struct.Struct("<hh")
+_CMD_FRAME = struct.Struct("<I")
+_CMD_REPLY = struct.Struct("<BIH")  # status (0 ok), commands executed, error message length
+
+
+class _CommandHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server.command_server
+        read = self.rfile.read
+        while True:
+            head = read(4)
+            if len(head) < 4:
+                return
+            (length,) = _CMD_FRAME.unpack(head)
+            body = read(length)
+            if len(body) < length:
+                return
+            executed, error = server.execute(body)
+            message = error.encode()[:0xFFFF] if error else b""
+            self.wfile.write(_CMD_REPLY.pack(1 if error else 0, executed, len(message)) + message)
+            self.wfile.flush()
+
+
+class _UnixCommandServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class CommandServer(object):
+    """
+    Long-running control socket for the emulators (--daemon PATH).
+
+    Clients connect to a Unix stream socket and send frames: uint32 length
+    followed by any number of commands back to back, each an opcode byte
+    plus its fixed arguments (see the CMD_* constants). Every frame gets one
+    reply in order: uint8 status (0 ok, 1 error), uint32 commands executed,
+    uint16 length and the error message. Clients may pipeline: keep sending
+    frames and read the replies later. Commands from all connections are
+    executed one at a time. CommandClient implements the client side.
+    """
+    def __init__(self, mouse, keyboard, path):
+        self.mouse = mouse
+        self.keyboard = keyboard
+        self.path = path
+        self.lock = threading.Lock()
+        self.commands_executed = 0
+        if os.path.exists(path):
+            os.unlink(path)
+        self.server = _UnixCommandServer(path, _CommandHandler)
+        self.server.command_server = self
+        self._thread = None
+
+    def execute(self, body):
+        """Run every command of a frame, returns (commands executed, error message or None)"""
+        view = memoryview(body)
+        offset = 0
+        executed = 0
+        mouse = self.mouse
+        keyboard = self.keyboard
+        with self.lock:
+            try:
+                while offset < len(view):
+                    opcode = view[offset]
+                    fmt = _CMD_ARGS.get(opcode)
+                    if fmt is None:
+                        raise ValueError(f"unknown opcode 0x{opcode:02x} at offset {offset}")
+                    args = fmt.unpack_from(view, offset + 1)
+                    offset += 1 + fmt.size
+                    if opcode == CMD_MOVE:
+                        mouse.move_mouse(*args)
+                    elif opcode == CMD_CLICK:
+                        mouse.click(args[0])
+                    elif opcode == CMD_PRESS:
+                        mouse.press(args[0])
+                    elif opcode == CMD_RELEASE:
+                        mouse.release(args[0])
+                    elif opcode == CMD_KEY_PRESS:
+                        keyboard.press(*args)
+                    elif opcode == CMD_KEY_RELEASE:
+                        keyboard.release(*args)
+                    elif opcode == CMD_KEY_TAP:
+                        keyboard.tap(*args)
+                    elif opcode == CMD_TYPE:
+                        text = bytes(view[offset:offset + args[0]]).decode("utf-8")
+                        offset += args[0]
+                        keyboard.type_text(text)
+                    elif opcode == CMD_CIRCLE:
+                        radius, steps, interval_ms = args
+                        mouse.play_trajectory(compile_circle(radius, steps), interval_ms / 1000)
+                    elif opcode == CMD_LINE:
+                        dx, dy, steps, interval_ms = args
+                        mouse.play_trajectory(compile_line(dx, dy, steps), interval_ms / 1000)
+                    elif opcode in (CMD_POLYLINE, CMD_BEZIER):
+                        count = args[-1]
+                        points = [_CMD_POINT.unpack_from(view, offset + i * 4) for i in range(count)]
+                        offset += count * 4
+                        if opcode == CMD_POLYLINE:
+                            mouse.play_trajectory(compile_polyline(points), args[0] / 1000)
+                        else:
+                            mouse.play_trajectory(compile_bezier(points, args[0]), args[1] / 1000)
+                    elif opcode == CMD_SLEEP:
+                        time.sleep(args[0] / 1e6)
+                    elif opcode == CMD_SCROLL:
+                        mouse.scroll(*args)
+                    elif opcode == CMD_MOVE_TO:
+                        mouse.move_to(*args)
+                    executed += 1
+            except Exception as e:
+                return executed, f"{type(e).__name__}: {e}"
+            finally:
+                self.commands_executed += executed
+        return executed, None
+
+    def start(self):
+        """Serve on a daemon thread"""
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def close(self):
+        if self._thread is not None:
+            self.server.shutdown()
+        self.server.server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class CommandClient(object):
+    """
+    Client for CommandServer. Calls only append to the current frame;
+    send() ships it and returns at once, so several frames can be in
+    flight; wait() collects the replies. execute() = send() + wait().
+
+        client = CommandClient("/run/bthid.sock")
+        client.move(100, 0).click(1).type_text("hello\\n")
+        client.execute()
+    """
+    def __init__(self, path, window=256):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.rfile = self.sock.makefile("rb")
+        self.frame = bytearray()
+        # Frames in flight before send() stops to read replies, keeps the
+        # unread replies small enough that the server never blocks on them
+        self.window = window
+        self.in_flight = 0
+        self.executed = 0
+        self.error = None
+
+    def _add(self, opcode, *args):
+        self.frame.append(opcode)
+        self.frame += _CMD_ARGS[opcode].pack(*args)
+        return self
+
+    def move(self, dx, dy):
+        return self._add(CMD_MOVE, dx, dy)
+
+    def click(self, button=1):
+        return self._add(CMD_CLICK, button)
+
+    def scroll(self, vertical, horizontal=0):
+        return self._add(CMD_SCROLL, vertical, horizontal)
+
+    def move_to(self, x, y):
+        return self._add(CMD_MOVE_TO, x, y)
+
+    def press(self, button=1):
+        return self._add(CMD_PRESS, button)
+
+    def release(self, button=1):
+        return self._add(CMD_RELEASE, button)
+
+    def key_press(self, keycode, modifiers=0):
+        return self._add(CMD_KEY_PRESS, keycode, modifiers)
+
+    def key_release(self, keycode, modifiers=0):
+        return self._add(CMD_KEY_RELEASE, keycode, modifiers)
+
+    def key_tap(self, keycode, modifiers=0):
+        return self._add(CMD_KEY_TAP, keycode, modifiers)
+
+    def type_text(self, text):
+        data = text.encode("utf-8")
+        self._add(CMD_TYPE, len(data))
+        self.frame += data
+        return self
+
+    def circle(self, radius, steps, interval_ms=0):
+        return self._add(CMD_CIRCLE, radius, steps, interval_ms)
+
+    def line(self, dx, dy, steps, interval_ms=0):
+        return self._add(CMD_LINE, dx, dy, steps, interval_ms)
+
+    def polyline(self, points, interval_ms=0):
+        self._add(CMD_POLYLINE, interval_ms, len(points))
+        for x, y in points:
+            self.frame += _CMD_POINT.pack(x, y)
+        return self
+
+    def bezier(self, points, steps, interval_ms=0):
+        self._add(CMD_BEZIER, steps, interval_ms, len(points))
+        for x, y in points:
+            self.frame += _CMD_POINT.pack(x, y)
+        return self
+
+    def sleep(self, seconds):
+        return self._add(CMD_SLEEP, int(seconds * 1e6))
+
+    def send(self):
+        """Ship the commands collected so far as one frame, without waiting"""
+        if self.frame:
+            if self.in_flight >= self.window:
+                self._read_replies(self.window // 2)
+            self.sock.sendall(_CMD_FRAME.pack(len(self.frame)) + self.frame)
+            self.frame = bytearray()
+            self.in_flight += 1
+
+    def _read_replies(self, keep):
+        while self.in_flight > keep:
+            status, executed, length = _CMD_REPLY.unpack(self.rfile.read(_CMD_REPLY.size))
+            message = self.rfile.read(length).decode()
+            self.in_flight -= 1
+            self.executed += executed
+            if status and self.error is None:
+                self.error = message
+
+    def wait(self):
+        """
+        Read the replies of all frames in flight. Returns the number of
+        commands executed since the last wait(), raises on the first error.
+        """
+        self._read_replies(0)
+        executed, error = self.executed, self.error
+        self.executed = 0
+        self.error = None
+        if error:
+            raise Exception(f"Command failed: {error}")
+        return executed
+
+    def execute(self):
+        self.send()
+        return self.wait()
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+
+def benchmark_encoder(count=200000):
+    """
+    Micro-benchmark of report encoding: the old per-call bytearray/bytes path
+    against MouseReportEncoder.encode() and encode_batch(). Prints reports/s.
+    """
+    moves = [((i % 255) - 127, 127 - (i % 255), i & 0x07) for i in range(1024)]
+    rounds = max(1, count // len(moves))
+    total = rounds * len(moves)
+
+    def legacy():
+        # What move_mouse used to do per report, minus print() and the send
+        state = bytearray([0xA1, 0x02, 0x00, 0x00, 0x00])
+        for _ in range(rounds):
+            for dx, dy, buttons in moves:
+                state[2] = buttons
+                dx = max(-128, min(dx, 127))
+                dy = max(-128, min(dy, 127))
+                state[3] = dx if dx >= 0 else (256 + dx)
+                state[4] = dy if dy >= 0 else (256 + dy)
+                bytes(state)
+                state[3] = 0x00
+                state[4] = 0x00
+
+    encoder = MouseReportEncoder(batch_size=len(moves))
+
+    def single():
+        encode = encoder.encode
+        for _ in range(rounds):
+            for dx, dy, buttons in moves:
+                encode(buttons, dx, dy)
+
+    def batch():
+        encode_batch = encoder.encode_batch
+        for _ in range(rounds):
+            encode_batch(moves)
+
+    def generated():
+        pack = HID_DESCRIPTOR.encoder(MouseReportEncoder.REPORT_ID)
+        for _ in range(rounds):
+            for dx, dy, buttons in moves:
+                pack(buttons, dx, dy)
+
+    print(f"Encoding {total} mouse reports")
+    baseline = None
+    for name, func in (("bytearray + bytes()", legacy), ("encode()", single), ("encode_batch()", batch),
+                       ("descriptor pack()", generated)):
+        start = time.perf_counter()
+        func()
+        rate = total / (time.perf_counter() - start)
+        baseline = baseline or rate
+        print(f"  {name:<20} {rate:>12,.0f} reports/s  ({rate / baseline:.2f}x)")
+
+
+def _latency_percentiles(samples):
+    """p50/p99/max in microseconds of a list of ns values"""
+    samples = sorted(samples)
+    if not samples:
+        return {"p50": None, "p99": None, "max": None}
+    count = len(samples)
+    return {"p50": samples[count // 2] / 1000,
+            "p99": samples[min(count - 1, int(0.99 * count))] / 1000,
+            "max": samples[-1] / 1000}
+
+
+def benchmark_link(descriptor=HID_DESCRIPTOR, count=20000, clicks=20, circles=10, reconnects=20):
+    """
+    End-to-end benchmark over a LoopbackTransport with a HostSimulator on
+    the far end, no Bluetooth needed. For move_mouse(), click(), the demo
+    circle (batched, and paced at 1 kHz) and failover after the host drops
+    the link it reports reports/s, send-to-arrival latency percentiles and
+    where the host's cursor ended up against the intended path. Prints a
+    table, returns the results as a dict.
+    """
+    transport = LoopbackTransport()
+    service = BluetoothHIDService(build_service_record(descriptor.data), None, transport=transport,
+                                  descriptor=descriptor)
+    host = HostSimulator(transport, descriptor, keep_trace=True).start()
+    mouse = MouseEmulator(service)
+    sent = array.array("q")
+    send = service.send
+
+    def stamped_send(report, motion=False):
+        start = time.perf_counter_ns()
+        send(report, motion)
+        sent.append(start)
+
+    service.send = stamped_send
+    results = {}
+
+    def path_error(moves):
+        # Largest distance (per axis) between the host's cursor and the
+        # intended one after each report, None if reports went missing
+        trace = host.trace
+        if len(trace) != 2 * len(moves):
+            return None
+        error = 0
+        x = y = 0
+        for i, (dx, dy) in enumerate(moves):
+            x += dx
+            y += dy
+            error = max(error, abs(trace[2 * i] - x), abs(trace[2 * i + 1] - y))
+        return error
+
+    def measure(name, run, check):
+        host.reset()
+        del sent[:]
+        run()
+        host.wait_for(len(sent))
+        arrivals = host.arrivals
+        elapsed = arrivals[-1] - sent[0] if len(arrivals) and len(sent) else 0
+        result = {
+            "reports": host.reports,
+            "reports_per_s": host.reports * 1e9 / elapsed if elapsed else None,
+            "latency_us": _latency_percentiles([a - s for a, s in zip(arrivals, sent)]),
+        }
+        result.update(check())
+        results[name] = result
+
+    moves = [((i % 41) - 20, (i * 7) % 41 - 20) for i in range(count)]
+    measure("move_mouse", lambda: [mouse.move_mouse(dx, dy) for dx, dy in moves],
+            lambda: {"position_error": path_error(moves)})
+    measure("click", lambda: [mouse.click(1) for _ in range(clicks)],
+            lambda: {"missed_clicks": clicks - host.presses, "buttons_left": host.buttons})
+    circle = compile_circle(60, 36)
+    rounds = max(1, count // len(circle.moves))
+    measure("circle (batched)", lambda: [mouse.play_trajectory(circle) for _ in range(rounds)],
+            lambda: {"position_error": path_error(circle.moves * rounds)})
+
+    def paced():
+        mouse.scheduler.lateness.clear()
+        deadline = None
+        for _ in range(circles):
+            deadline = mouse.play_trajectory(circle, 0.001, deadline)
+
+    measure("circle (1 kHz)", paced,
+            lambda: {"position_error": path_error(circle.moves * circles),
+                     "lateness_us": mouse.scheduler.stats()["lateness_us"]})
+
+    # The host drops the link; how long until a report sent right then arrives
+    supervisor = ReconnectSupervisor(service, ReconnectSupervisor.KEEP_ALL, initial_delay=0.001)
+    supervisor.start()
+    supervised = MouseEmulator(service, supervisor)
+    host.reset()
+    failover = []
+    for _ in range(reconnects):
+        arrived = host.reports
+        start = time.perf_counter_ns()
+        transport.hang_up()
+        supervised.move_mouse(1, 0)
+        if host.wait_for(arrived + 1):
+            failover.append(host.arrivals[-1] - start)
+    supervisor.stop()
+    results["reconnect"] = {"reconnects": reconnects, "failover_us": _latency_percentiles(failover),
+                            "lost_reports": reconnects - host.x}
+    host.stop()
+    service.cleanup()
+
+    print(f"End-to-end over loopback, {count} reports per run")
+    print(f"  {'scenario':<18} {'reports':>8} {'reports/s':>12} {'p50 µs':>9} {'p99 µs':>9} {'max µs':>9}  check")
+    for name, result in results.items():
+        if name == "reconnect":
+            continue
+        latency = result["latency_us"]
+        checks = ", ".join(f"{key}={value}" for key, value in result.items()
+                           if key not in ("reports", "reports_per_s", "latency_us", "lateness_us"))
+        rate = result["reports_per_s"] or 0
+        print(f"  {name:<18} {result['reports']:>8} {rate:>12,.0f} {latency['p50'] or 0:>9.1f} "
+              f"{latency['p99'] or 0:>9.1f} {latency['max'] or 0:>9.1f}  {checks}")
+    lateness = results["circle (1 kHz)"]["lateness_us"]
+    print(f"  1 kHz pacing lateness p50 {lateness['p50']:.1f} µs, p99 {lateness['p99']:.1f} µs")
+    reconnect = results["reconnect"]
+    failover = reconnect["failover_us"]
+    print(f"  failover after {reconnects} link drops: p50 {(failover['p50'] or 0) / 1000:.2f} ms, "
+          f"p99 {(failover['p99'] or 0) / 1000:.2f} ms, max {(failover['max'] or 0) / 1000:.2f} ms, "
+          f"lost_reports={reconnect['lost_reports']}")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Bluetooth HID mouse emulator")
+    parser.add_argument("--loopback", action="store_true",
+                        help="use a local AF_UNIX socket pair instead of Bluetooth (no BlueZ or radio needed)")
+    parser.add_argument("--all-hosts", action="store_true",
+                        help="drive every connected host on every adapter at once")
+    parser.add_argument("--event-loop", action="store_true",
+                        help="take host connections from BlueZ on a GLib main loop instead of blocking in accept(), "
+                             "serving every host that connects")
+    parser.add_argument("--extended-mouse", action="store_true",
+                        help="present a mouse with 16-bit X/Y, a wheel and a horizontal wheel "
+                             "(re-pair the host after switching)")
+    parser.add_argument("--absolute", action="store_true",
+                        help="add an absolute pointer for one-report move_to() (re-pair the host after switching)")
+    parser.add_argument("--metrics", metavar="ADDR",
+                        help="serve /metrics (Prometheus) and /stats (JSON) on host:port or a Unix socket path")
+    parser.add_argument("--record", metavar="PATH",
+                        help="append every report sent to a binary log")
+    parser.add_argument("--replay", metavar="PATH",
+                        help="replay a recorded log instead of running the demo")
+    parser.add_argument("--replay-speed", type=float, default=1.0,
+                        help="replay speed factor, 0 sends as fast as the link allows (default 1.0)")
+    parser.add_argument("--daemon", metavar="PATH",
+                        help="instead of the demo, serve the binary command protocol on a Unix socket")
+    parser.add_argument("--ring", metavar="NAME",
+                        help="instead of the demo, send the reports producer processes put into "
+                             "the shared-memory ReportRing NAME")
+    parser.add_argument("--ring-lanes", type=int, default=4,
+                        help="number of producers the --ring can take at once (default 4)")
+    parser.add_argument("--evdev", metavar="PATH", action="append",
+                        help="instead of the demo, forward a local input device (/dev/input/eventN) "
+                             "or a recorded event file; repeat for several")
+    parser.add_argument("--evdev-grab", action="store_true",
+                        help="take the --evdev devices away from the local desktop while forwarding")
+    parser.add_argument("--bench-encoder", action="store_true",
+                        help="run the report encoder micro-benchmark and exit")
+    parser.add_argument("--bench-link", action="store_true",
+                        help="run the end-to-end loopback benchmark against a simulated host and exit")
+    args = parser.parse_args()
+
+    if args.bench_encoder:
+        benchmark_encoder()
+        sys.exit(0)
+
+    report_descriptor = HID_REPORT_DESCRIPTOR_EXTENDED if args.extended_mouse else HID_REPORT_DESCRIPTOR
+    if args.absolute:
+        report_descriptor += _ABSOLUTE_POINTER_DESCRIPTOR
+    if args.bench_link:
+        benchmark_link(parse_report_descriptor(report_descriptor))
+        sys.exit(0)
+
+    def terminate(signum, frame):
+        # kill / systemctl stop: leave through the same cleanup as Ctrl+C
+        # (sockets unlinked, recorder flushed); a second SIGTERM kills at once
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, terminate)
+    DBusGMainLoop(set_as_default=True)
+    service_record = build_service_record(report_descriptor)
+    descriptor = parse_report_descriptor(report_descriptor)
+    timer = StartupTimer()
+    
+    # One bus connection and object snapshot for every D-Bus call below.
+    # No profile cleanup up front: BlueZ drops a profile as soon as the
+    # process that registered it leaves the bus.
+    bluez = None
+    multi_host = args.all_hosts or args.event_loop
+    bthid_srv = None
+    supervisor = None
+    metrics_server = None
+    try:
+        print("Initializing Bluetooth HID Service...")
+        
+        if not args.loopback:
+            with timer.phase("bluez"):
+                bluez = BlueZContext()
+                if not bluez.wait_for_bluez():
+                    print("ERROR: bluetoothd is not running!")
+                    sys.exit(1)
+            with timer.phase("adapter"):
+                if not (CONTROLLER_MAC or bluez.wait_for_adapter()):
+                    print("ERROR: Could not detect Bluetooth adapter MAC address!")
+                    sys.exit(1)
+        
+        if args.loopback:
+            transport = LoopbackTransport()
+            bthid_srv = BluetoothHIDService(service_record, None, transport=transport, timer=timer,
+                                            descriptor=descriptor)
+            transport.start_drain()
+        elif args.event_loop:
+            with timer.phase("register profile"):
+                bthid_srv = MultiHostHIDService(service_record, bluez=bluez, event_driven=True,
+                                                descriptor=descriptor)
+            print("Waiting for hosts to connect...")
+            with timer.phase("wait for host"):
+                bthid_srv.wait_for_host()
+        elif args.all_hosts:
+            with timer.phase("register profile"):
+                bthid_srv = MultiHostHIDService(service_record, bluez=bluez, descriptor=descriptor)
+            for remote_mac, adapter_mac in get_connected_devices(bluez):
+                try:
+                    bthid_srv.add_host(adapter_mac, remote_mac)
+                except Exception as e:
+                    print(f"Could not connect to {remote_mac}: {e}")
+            if not bthid_srv.sessions:
+                with timer.phase("wait for host"):
+                    bthid_srv.accept_host(CONTROLLER_MAC or get_controller_mac(bluez))
+        else:
+            # Auto-detect controller MAC if not specified
+            controller_mac = CONTROLLER_MAC
+            if not controller_mac:
+                controller_mac = get_controller_mac(bluez)
+                if not controller_mac:
+                    print("ERROR: Could not detect Bluetooth adapter MAC address!")
+                    sys.exit(1)
+            
+            # Try to find already connected device
+            remote_mac = get_connected_device_mac(bluez)
+            
+            bthid_srv = BluetoothHIDService(service_record, controller_mac, remote_mac,
+                                            bluez=bluez, timer=timer, descriptor=descriptor)
+        
+        print("\nBluetooth HID Service connected!")
+        print(timer.report())
+        if not multi_host:
+            # The multi-host service runs a supervisor per host itself
+            supervisor = ReconnectSupervisor(bthid_srv)
+            supervisor.start()
+        emulator = MouseEmulator(bthid_srv, supervisor)
+        if args.metrics:
+            sources = bthid_srv.metrics_sources if multi_host else {"mouse": bthid_srv.metrics}
+            metrics_server = MetricsServer(sources, parse_metrics_address(args.metrics))
+            print(f"Serving metrics on {args.metrics}")
+        
+        if args.record:
+            # With several hosts that is what was broadcast to all of them
+            bthid_srv.recorder = ReportRecorder(args.record)
+            print(f"Recording reports to {args.record}")
+        
+        if args.replay:
+            replayer = ReportReplayer(args.replay)
+            print(f"Replaying {len(replayer)} reports ({replayer.duration():.1f} s) from {args.replay}")
+            send = supervisor.send if supervisor else bthid_srv.send
+            scheduler = ReportScheduler(send, bthid_srv.metrics)
+            started = time.monotonic()
+            sent = replayer.replay(send, speed=args.replay_speed or None, scheduler=scheduler)
+            print(f"Replayed {sent} reports in {time.monotonic() - started:.2f} s")
+            if args.replay_speed:
+                late = scheduler.stats()["lateness_us"]
+                print(f"Lateness p50 {late['p50']:.0f} µs, p99 {late['p99']:.0f} µs, max {late['max']:.0f} µs")
+            sys.exit(0)
+        
+        if args.evdev:
+            bridge = EvdevBridge(emulator, KeyboardEmulator(bthid_srv, supervisor))
+            for path in args.evdev:
+                bridge.add_device(path, grab=args.evdev_grab)
+            print(f"Forwarding {', '.join(args.evdev)}, Ctrl+C to stop")
+            try:
+                bridge.run()
+            finally:
+                bridge.close()
+                print(f"Forwarded {bridge.events} events in {bridge.frames} frames as {bridge.reports_sent} reports")
+            sys.exit(0)
+        
+        if args.ring:
+            ring = ReportRing(args.ring, lanes=args.ring_lanes)
+            sender = RingSender(ring, supervisor.send if supervisor else bthid_srv.send)
+            print(f"Sending reports from ring {ring.name} ({ring.lanes} lanes), Ctrl+C to stop")
+            try:
+                sender.serve_forever()
+            finally:
+                print(f"Sent {sender.sent} reports from the ring")
+                ring.close()
+            sys.exit(0)
+        
+        if args.daemon:
+            keyboard = KeyboardEmulator(bthid_srv, supervisor)
+            command_server = CommandServer(emulator, keyboard, args.daemon)
+            print(f"Listening for commands on {args.daemon}, Ctrl+C to stop")
+            try:
+                command_server.serve_forever()
+            finally:
+                command_server.close()
+            sys.exit(0)
         
         # Run the demo
         emulator.demo_movement()
@@ -553,7 +5103,14 @@ if __name__ == '__main__':
         import traceback
         traceback.print_exc()
     finally:
+        if metrics_server:
+            metrics_server.close()
+        if supervisor:
+            supervisor.stop()
         if bthid_srv:
+            if getattr(bthid_srv, "recorder", None):
+                bthid_srv.recorder.close()
             bthid_srv.cleanup()
-        cleanup_profile()
+        elif bluez is not None:
+            cleanup_profile(bluez)
         print("Exit")
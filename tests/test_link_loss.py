@@ -0,0 +1,121 @@
+"""
+Link-loss handling against a mock BlueZ Device1, no adapter needed.
+
+Needs python-dbus and PyGObject, and takes the org.bluez name on the
+session bus, so run it on a private one:
+
+    dbus-run-session -- python3 -m unittest discover -s tests -v
+"""
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+try:
+    import dbus
+    import dbus.service
+    from dbus.mainloop.glib import DBusGMainLoop
+    import main
+except ImportError as e:
+    raise unittest.SkipTest(f"python-dbus/PyGObject not available: {e}")
+
+if not os.environ.get("DBUS_SESSION_BUS_ADDRESS"):
+    raise unittest.SkipTest("no session bus, run under dbus-run-session")
+
+REMOTE_MAC = "AA:BB:CC:DD:EE:FF"
+OTHER_MAC = "11:22:33:44:55:66"
+TIMEOUT = 2.0
+
+
+class MockBlueZDevice(dbus.service.Object):
+    """
+    Stand-in for the org.bluez.Device1 object BlueZ keeps for a host.
+    set_connected(False) emits PropertiesChanged the way bluetoothd does
+    when the host goes away.
+    """
+    def __init__(self, bus, remote_mac, adapter="hci0"):
+        self.path = f"/org/bluez/{adapter}/dev_{remote_mac.replace(':', '_')}"
+        self.bus_name = dbus.service.BusName("org.bluez", bus)
+        super(MockBlueZDevice, self).__init__(bus, self.path)
+        self.properties = {"Address": remote_mac, "Connected": True}
+
+    @dbus.service.method("org.freedesktop.DBus.Properties", in_signature="ss", out_signature="v")
+    def Get(self, interface, name):
+        return self.properties[name]
+
+    @dbus.service.method("org.freedesktop.DBus.Properties", in_signature="s", out_signature="a{sv}")
+    def GetAll(self, interface):
+        return self.properties
+
+    @dbus.service.signal("org.freedesktop.DBus.Properties", signature="sa{sv}as")
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
+
+    def set_connected(self, connected):
+        self.properties["Connected"] = connected
+        self.PropertiesChanged("org.bluez.Device1", {"Connected": dbus.Boolean(connected)}, [])
+
+
+class LinkLossTest(unittest.TestCase):
+    """A service on a LoopbackTransport watching the mock's Device1"""
+
+    def setUp(self):
+        DBusGMainLoop(set_as_default=True)
+        self.bus = dbus.SessionBus()
+        self.bluez = main.BlueZContext(self.bus)
+        self.device = MockBlueZDevice(self.bus, REMOTE_MAC)
+        self.other = MockBlueZDevice(self.bus, OTHER_MAC)
+        self.service = main.BluetoothHIDService(main.HID_SERVICE_RECORD, None, REMOTE_MAC,
+                                                transport=main.LoopbackTransport(), bluez=self.bluez)
+        self.supervisor = main.ReconnectSupervisor(self.service, initial_delay=0.01)
+        self.lost = threading.Event()
+        self.reasons = []
+        link_lost = self.service.on_link_down
+
+        def on_link_down(reason):
+            link_lost(reason)
+            self.reasons.append(reason)
+            self.lost.set()
+
+        self.service.on_link_down = on_link_down
+        self.supervisor.start()
+
+    def tearDown(self):
+        self.supervisor.stop()
+        self.service.cleanup()
+        self.device.remove_from_connection()
+        self.other.remove_from_connection()
+        self.bluez.stop_loop()
+
+    def wait_up(self):
+        deadline = time.monotonic() + TIMEOUT
+        while not self.supervisor.is_up() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return self.supervisor.is_up()
+
+    def test_disconnect_loses_link(self):
+        self.device.set_connected(False)
+        self.assertTrue(self.lost.wait(TIMEOUT), "Connected=false never reached lose_link()")
+        self.assertEqual(self.reasons, ["BlueZ reports the device disconnected"])
+        self.assertIsNotNone(self.supervisor.down_since)
+
+    def test_other_device_ignored(self):
+        # signals are delivered in order, so by the time our own device's
+        # disconnect arrives the other one has been seen (and ignored)
+        self.other.set_connected(False)
+        self.device.set_connected(False)
+        self.assertTrue(self.lost.wait(TIMEOUT))
+        self.assertEqual(len(self.reasons), 1)
+
+    def test_supervisor_reconnects(self):
+        self.device.set_connected(False)
+        self.assertTrue(self.lost.wait(TIMEOUT))
+        self.assertTrue(self.wait_up(), "supervisor did not reconnect")
+        self.assertEqual(self.supervisor.reconnects, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()